@@ -0,0 +1,75 @@
+"""
+Shared state for the fake omreport and omconfig binaries used by the
+benchmarks. The state is a json file, named by the SWIFT_DRIVE_BENCH_STATE
+environment variable, that describes the controllers and the latency model:
+
+{
+    "latency": {"omreport": 0.05, "per_record": 0.001, "omconfig": 0.2},
+    "controllers": {
+        "1": {"slot": "1",
+              "pdisks": [{"target": 0, "serial": "BENCH1N0", "vdisk": 1},
+                         {"target": 1, "serial": "BENCH1N1", "vdisk": 0},
+                         {"target": 2, "serial": "FOREIGN", "used": 1}],
+              "vdisks": [0, 1]}
+    }
+}
+
+Every vdisk is a RAID-0 on the pdisk that names it. A pdisk with "used" and
+no vdisk is in use by something else, like a foreign configuration. The
+pdisks are in enclosure 0, unless their "enclosure" is null.
+
+Every call is appended to the file named by SWIFT_DRIVE_BENCH_CALLS, if
+set, so the benchmarks can count the processes spawned.
+"""
+from __future__ import print_function
+import fcntl
+import json
+import os
+import sys
+import time
+
+
+def parse_args(argv):
+    """
+    Split the omtools arguments into the object and the key=value options.
+    """
+    args = dict([a.split('=', 1) for a in argv if '=' in a])
+    objects = [a for a in argv if '=' not in a and not a.startswith('-')]
+    return objects, args
+
+
+def log_call(binary, argv):
+    path = os.environ.get('SWIFT_DRIVE_BENCH_CALLS')
+    if path:
+        with open(path, 'a') as f:
+            f.write('%s %s\n' % (binary, ' '.join(argv)))
+
+
+class State(object):
+    """
+    The state file, locked for the whole life of the object so concurrent
+    omconfig calls don't lose each other's changes.
+    """
+    def __init__(self):
+        self.path = os.environ['SWIFT_DRIVE_BENCH_STATE']
+        self.f = open(self.path, 'r+')
+        fcntl.flock(self.f, fcntl.LOCK_EX)
+        self.data = json.load(self.f)
+
+    def save(self):
+        self.f.seek(0)
+        self.f.truncate()
+        json.dump(self.data, self.f)
+
+    def close(self):
+        self.f.close()
+
+
+def sleep(seconds):
+    if seconds > 0:
+        time.sleep(seconds)
+
+
+def main_exit(code=0):
+    sys.stdout.flush()
+    sys.exit(code)
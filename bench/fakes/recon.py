@@ -0,0 +1,63 @@
+"""
+Fake swift-recon server for the benchmarks. It runs in a thread and serves
+the endpoints from a dictionary that can be changed while it's running.
+"""
+import BaseHTTPServer
+import SocketServer
+import threading
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+class ReconHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep the connections open, like the object server does
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        endpoint = self.path.split('/recon/', 1)[-1]
+        if endpoint in self.server.endpoints:
+            code = 200
+            body = json.dumps(self.server.endpoints[endpoint])
+        else:
+            code = 404
+            body = 'Not Found'
+        self.server.requests += 1
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeRecon(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, endpoints=None, port=0):
+        """
+        :param endpoints: The data to return for each endpoint, eg.
+                          {'unmounted': [{'device': 'c1u0'}]}
+        :param port: The port to listen on. 0 picks a free one.
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                           ReconHandler)
+        self.endpoints = endpoints or {'unmounted': [], 'diskusage': [],
+                                       'driveaudit': {}, 'replication': {}}
+        self.requests = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,176 @@
+"""
+Fake Swift server for the benchmarks and for trying the swift backend
+without a cluster. It runs in a thread and keeps the objects in memory.
+
+It implements what the swift backend uses: the v1 auth, PUT of a container,
+GET, HEAD, PUT and DELETE of an object, with the If-None-Match and If-Match
+conditions (on PUT too). The requests are counted by method and status, and
+the object bytes sent and received are counted too.
+"""
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import threading
+import urllib
+
+
+class SwiftHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep the connections open, like the proxy server does
+    protocol_version = 'HTTP/1.1'
+    # Send every response at once, not a header at a time
+    wbufsize = -1
+
+    def reply(self, code, body='', headers=None):
+        server = self.server
+        with server.lock:
+            key = '%s %d' % (self.command, code)
+            server.requests[key] = server.requests.get(key, 0) + 1
+            server.bytes_sent += len(body)
+        self.send_response(code)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        body = self.rfile.read(length)
+        with self.server.lock:
+            self.server.bytes_received += len(body)
+        return body
+
+    def parse(self):
+        """
+        :returns: A tuple (container, object), None if missing, or None if
+                  the request can't go on (the reply has been sent).
+        """
+        if self.path.startswith('/auth/'):
+            return self.auth()
+        token = self.headers.getheader('x-auth-token')
+        if token != self.server.token:
+            self.read_body()
+            return self.reply(401, 'Unauthorized')
+        path = urllib.unquote(self.path.split('?')[0])
+        parts = path.split('/', 4)[3:]
+        if not parts or not parts[0]:
+            self.read_body()
+            return self.reply(400, 'Bad Request')
+        return parts[0], parts[1] if len(parts) > 1 else None
+
+    def auth(self):
+        user = self.headers.getheader('x-auth-user')
+        key = self.headers.getheader('x-auth-key')
+        if (user, key) != (self.server.user, self.server.key):
+            return self.reply(401, 'Unauthorized')
+        self.reply(200, headers={
+            'X-Storage-Url': 'http://127.0.0.1:%d/v1/AUTH_test' %
+                             self.server.port,
+            'X-Auth-Token': self.server.token})
+
+    def matches(self, header, etag):
+        values = self.headers.getheader(header)
+        if values is None:
+            return None
+        values = [a.strip().strip('"') for a in values.split(',')]
+        return '*' in values and etag is not None or etag in values
+
+    def do_GET(self):
+        parsed = self.parse()
+        if parsed is None:
+            return
+        container, name = parsed
+        with self.server.lock:
+            stored = self.server.objects.get((container, name))
+        if stored is None:
+            return self.reply(404, 'Not Found')
+        etag, body = stored
+        if self.matches('if-none-match', etag):
+            return self.reply(304, headers={'Etag': etag})
+        if self.matches('if-match', etag) is False:
+            return self.reply(412, 'Precondition Failed')
+        self.reply(200, body, {'Etag': etag})
+
+    do_HEAD = do_GET
+
+    def do_PUT(self):
+        parsed = self.parse()
+        if parsed is None:
+            return
+        container, name = parsed
+        body = self.read_body()
+        with self.server.lock:
+            if name is None:
+                created = container not in self.server.containers
+                self.server.containers.add(container)
+                return self.reply(201 if created else 202)
+            if container not in self.server.containers:
+                return self.reply(404, 'Not Found')
+            etag = self.server.objects.get((container, name), (None,))[0]
+            if self.matches('if-none-match', etag) or \
+                    self.matches('if-match', etag) is False:
+                return self.reply(412, 'Precondition Failed')
+            etag = hashlib.md5(body).hexdigest()
+            self.server.objects[(container, name)] = (etag, body)
+        self.reply(201, headers={'Etag': etag})
+
+    def do_DELETE(self):
+        parsed = self.parse()
+        if parsed is None:
+            return
+        with self.server.lock:
+            if self.server.objects.pop(parsed, None) is None:
+                return self.reply(404, 'Not Found')
+        self.reply(204)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeSwift(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, user='test:tester', key='testing', port=0):
+        """
+        :param user: The user accepted by the auth.
+        :param key: The key accepted by the auth.
+        :param port: The port to listen on. 0 picks a free one.
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                           SwiftHandler)
+        self.user = user
+        self.key = key
+        self.token = 'AUTH_tk0'
+        self.lock = threading.RLock()
+        self.containers = set()
+        # {(container, object): (etag, body)}
+        self.objects = {}
+        # {'METHOD status': count}
+        self.requests = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    @property
+    def auth_url(self):
+        return 'http://127.0.0.1:%d/auth/v1.0' % self.port
+
+    def expire_token(self):
+        """
+        Make the current token invalid, as if it expired.
+        """
+        self.token = 'AUTH_tk%d' % (int(self.token[7:]) + 1)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
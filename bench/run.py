@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+"""
+Benchmarks for swift-drive.
+
+The controller is simulated by the fake omreport and omconfig binaries in
+bench/fakes (configured through controller_binaries in the [perc800]
+section), with a configurable latency model, and swift-recon and Swift by
+local fake servers. Every run happens in a temporary directory with its own
+config file and sqlite db.
+
+It measures:
+- init: Init.main, for every combination of controllers and drives. The
+  drives must be recorded on the right devices, or the run fails;
+- remove: RemoveDrives.main with three unmounted drives, on the same nodes;
+- backend: the sqlite get_event and get_drive lookups, for every events
+  table size;
+- swift: the swift backend writes, and the reads of a state that didn't
+  change, with the object bytes transferred;
+- coldstart: a whole no-op removal (nothing unmounted) in a new process,
+  against a time budget. The run fails if the budget is exceeded.
+
+The results are printed as json (or written to --output), one entry per
+measure, so they can be compared between revisions.
+
+Usage:
+    python bench/run.py [--quick] [--output results.json]
+"""
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import time
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+FAKES_DIR = os.path.join(BENCH_DIR, 'fakes')
+sys.path.insert(0, FAKES_DIR)
+# The fakes are also the omtools found in $PATH
+os.environ['PATH'] = FAKES_DIR + os.pathsep + os.environ.get('PATH', '')
+
+from recon import FakeRecon
+from swift import FakeSwift
+from swift_drive.common import config
+
+CONFIG = '''
+[common]
+controller = perc800
+backend = sqlite
+cache_file = %(tmpdir)s/inventory.json
+
+[recon]
+recon_port = %(recon_port)d
+
+[perc800]
+controller_binaries = %(fakes)s/omconfig, %(fakes)s/omreport
+
+[sqlite]
+sqlite_db = %(tmpdir)s/swift-drive.db
+'''
+
+SWIFT_CONFIG = '''
+[swift]
+swift_auth_url = %(auth_url)s
+swift_user = test:tester
+swift_key = testing
+swift_prefix = bench
+# Check the objects at every read
+swift_cache_ttl = 0
+'''
+
+
+class Quiet(object):
+    """
+    Hide what the commands print while they are being measured.
+    """
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+class Node(object):
+    """
+    A temporary node: config file, fake controller state, fake recon and db.
+    """
+    def __init__(self, controllers, drives, latency):
+        self.tmpdir = tempfile.mkdtemp(prefix='swift-drive-bench-')
+        self.recon = FakeRecon().start()
+        self.calls = os.path.join(self.tmpdir, 'calls')
+        state = {'latency': latency, 'controllers': {}}
+        for n in range(controllers):
+            controller_id = str(n + 1)
+            count = drives // controllers + (n < drives % controllers)
+            # As after some swaps, the vdisk ids don't follow the targets.
+            # The last pdisk is in use by a foreign configuration and the
+            # last vdisk has lost its pdisk, so the counts still match.
+            pdisks = [{'target': a, 'serial': 'BENCH%sN%d' %
+                       (controller_id, a), 'vdisk': count - 1 - a}
+                      for a in range(count)]
+            if n % 2:
+                # A backplane without an enclosure
+                for pdisk in pdisks:
+                    pdisk['enclosure'] = None
+            pdisks.append({'target': count, 'serial': 'FOREIGN%s' %
+                           controller_id, 'used': 1, 'state': 4194304})
+            state['controllers'][controller_id] = {
+                'slot': str(n + 1),
+                'pdisks': pdisks,
+                'vdisks': range(count + 1),
+            }
+        self.state = state
+        state_file = os.path.join(self.tmpdir, 'state.json')
+        with open(state_file, 'w') as f:
+            json.dump(state, f)
+        os.environ['SWIFT_DRIVE_BENCH_STATE'] = state_file
+        os.environ['SWIFT_DRIVE_BENCH_CALLS'] = self.calls
+
+        config_file = os.path.join(self.tmpdir, 'swift-drive.conf')
+        with open(config_file, 'w') as f:
+            f.write(CONFIG % {'tmpdir': self.tmpdir,
+                              'recon_port': self.recon.port,
+                              'fakes': FAKES_DIR})
+        self.config_file = config_file
+        config.reload_config(config_file)
+
+    def mapping_errors(self, drives):
+        """
+        Returns how many drives are recorded on the wrong device, or on a
+        device without a drive.
+
+        :param drives: The drives, by device name, as the backend has them.
+        """
+        serials = {}
+        for controller_id, controller in self.state['controllers'].items():
+            for pdisk in controller['pdisks']:
+                if pdisk.get('vdisk') is not None:
+                    serials['c%su%d' % (controller_id, pdisk['vdisk'])] = \
+                        pdisk['serial']
+        return len([a for a in drives
+                    if drives[a]['serial'] != serials.get(a)])
+
+    def count_calls(self):
+        """
+        Returns how many omtools processes ran since the last call.
+        """
+        try:
+            with open(self.calls) as f:
+                calls = len(f.readlines())
+            os.remove(self.calls)
+        except IOError:
+            calls = 0
+        return calls
+
+    def close(self):
+        self.recon.stop()
+        shutil.rmtree(self.tmpdir)
+
+
+def bench_node(controllers, drives, latency):
+    """
+    Measure init and remove on a node.
+    """
+    from swift_drive.commands import init, remove
+    from swift_drive.plugins import get_plugin
+    # Nobody is there to confirm, and we don't need to be root
+    init.confirm = lambda message: True
+    remove.getuid = lambda: 0
+
+    results = []
+    node = Node(controllers, drives, latency)
+    try:
+        start = time()
+        with Quiet():
+            init.Init().main()
+        results.append({'benchmark': 'init', 'controllers': controllers,
+                        'drives': drives, 'seconds': time() - start,
+                        'processes': node.count_calls(),
+                        'mapping_errors': node.mapping_errors(
+                            get_plugin('backend').get_drives())})
+
+        # The first drive of each controller, up to 3 of them
+        unmounted = sorted(node.state['controllers'])[:3]
+        node.recon.endpoints['unmounted'] = [{'device': 'c%su0' % a}
+                                             for a in unmounted]
+        start = time()
+        with Quiet():
+            try:
+                remove.RemoveDrives().main()
+            except SystemExit:
+                pass
+        results.append({'benchmark': 'remove', 'controllers': controllers,
+                        'drives': drives, 'unmounted': len(unmounted),
+                        'seconds': time() - start,
+                        'processes': node.count_calls(),
+                        'recon_requests': node.recon.requests})
+    finally:
+        node.close()
+    return results
+
+
+def percentile(values, n):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * n / 100.0))]
+
+
+def bench_backend(events, lookups=1000):
+    """
+    Measure the backend lookups with a populated events table.
+    """
+    from swift_drive.plugins.backend.sqlite import Backend
+
+    node = Node(0, 0, {})
+    try:
+        backend = Backend()
+        backend.init_schema()
+        serials = ['BENCH%06d' % a for a in range(max(1, events // 100))]
+        start = time()
+        with backend.transaction():
+            backend.add_drives(('c%du%d' % (a % 4, a), serial, a, 'MODEL',
+                                'FW', '3.00 TB', 'active')
+                               for a, serial in enumerate(serials))
+            step = 100000
+            for first in range(0, events, step):
+                backend.add_events(
+                    (a, serials[a % len(serials)], 'failed',
+                     random.choice(['new', 'inprogress', 'closed']), 0)
+                    for a in range(first, min(events, first + step)))
+        results = [{'benchmark': 'backend_populate', 'events': events,
+                    'seconds': time() - start}]
+
+        queries = {
+            'get_event_status': lambda a: backend.get_event(serials[a],
+                                                            status='new'),
+            'get_event_time': lambda a: backend.get_event(
+                serials[a], time=events - 86400),
+            'get_drive': lambda a: backend.get_drive('c%du%d' % (a % 4, a)),
+        }
+        for name in sorted(queries):
+            query = queries[name]
+            timings = []
+            for n in range(lookups):
+                index = random.randrange(len(serials))
+                start = time()
+                query(index)
+                timings.append(time() - start)
+            results.append({'benchmark': 'backend_%s' % name,
+                            'events': events, 'lookups': lookups,
+                            'mean_ms': sum(timings) / len(timings) * 1000,
+                            'p50_ms': percentile(timings, 50) * 1000,
+                            'p95_ms': percentile(timings, 95) * 1000})
+    finally:
+        node.close()
+    return results
+
+
+def bench_swift(drives, operations=100):
+    """
+    Measure the swift backend against the fake Swift server.
+    """
+    from swift_drive.plugins.backend.swift import Backend
+
+    node = Node(0, 0, {})
+    server = FakeSwift().start()
+    try:
+        with open(node.config_file, 'a') as f:
+            f.write(SWIFT_CONFIG % {'auth_url': server.auth_url})
+        config.reload_config(node.config_file)
+        backend = Backend()
+        backend.init_schema()
+        start = time()
+        backend.add_drives(('c%du%d' % (a % 4, a), 'BENCH%06d' % a, a,
+                            'MODEL', 'FW', '3.00 TB', 'active')
+                           for a in range(drives))
+        results = [{'benchmark': 'swift_populate', 'drives': drives,
+                    'seconds': time() - start,
+                    'object_bytes': server.bytes_received}]
+
+        benchmarks = {
+            'read_unchanged': lambda a: backend.get_drive('c%du%d' %
+                                                          (a % 4, a)),
+            'update': lambda a: backend.update_drive(
+                'c%du%d' % (a % 4, a), 'BENCH%06d' % a, last_update=a + 1),
+        }
+        for name in sorted(benchmarks):
+            operation = benchmarks[name]
+            timings = []
+            server.requests.clear()
+            sent, received = server.bytes_sent, server.bytes_received
+            for n in range(operations):
+                index = random.randrange(drives)
+                start = time()
+                operation(index)
+                timings.append(time() - start)
+            results.append({'benchmark': 'swift_%s' % name,
+                            'drives': drives, 'operations': operations,
+                            'mean_ms': sum(timings) / len(timings) * 1000,
+                            'p95_ms': percentile(timings, 95) * 1000,
+                            'requests': dict(server.requests),
+                            'bytes_sent': server.bytes_sent - sent,
+                            'bytes_received': server.bytes_received -
+                            received})
+        backend.close()
+    finally:
+        server.stop()
+        node.close()
+    return results
+
+
+# Runs a no-op removal in a new process, then reports the modules it loaded
+COLDSTART = '''
+import sys
+sys.path.insert(0, %(root)r)
+from swift_drive.commands import remove
+remove.getuid = lambda: 0
+remove.main()
+print ' '.join(sorted([a for a in sys.modules if sys.modules[a] is not None
+                       and (a.startswith('swift_drive.plugins.') or
+                            a in ['smtplib', 'sqlite3'])]))
+'''
+
+
+def bench_coldstart(runs, budget):
+    """
+    Measure a no-op removal, from the start of the interpreter to its exit.
+    """
+    node = Node(0, 0, {})
+    try:
+        script = COLDSTART % {'root': os.path.dirname(BENCH_DIR)}
+        env = dict(os.environ, SWIFT_DRIVE_CONFIG=node.config_file)
+        timings = []
+        for n in range(runs):
+            start = time()
+            output = subprocess.check_output([sys.executable, '-c', script],
+                                             env=env)
+            timings.append(time() - start)
+        lines = output.splitlines()
+        loaded = lines[-1].split() if lines else []
+    finally:
+        node.close()
+    return [{'benchmark': 'coldstart', 'runs': runs,
+             'mean_s': sum(timings) / len(timings),
+             'p95_s': percentile(timings, 95), 'budget_s': budget,
+             'within_budget': percentile(timings, 95) <= budget,
+             'plugins_loaded': loaded}]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='swift-drive benchmarks')
+    parser.add_argument('--quick', action='store_true',
+                        help='run only the smallest cases')
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--omreport-latency', type=float, default=0.05,
+                        help='seconds for every omreport call')
+    parser.add_argument('--record-latency', type=float, default=0.001,
+                        help='extra seconds for every record returned')
+    parser.add_argument('--omconfig-latency', type=float, default=0.2,
+                        help='seconds for every omconfig call')
+    parser.add_argument('--coldstart-budget', type=float, default=0.25,
+                        help='seconds a no-op removal is allowed to take')
+    args = parser.parse_args()
+
+    latency = {'omreport': args.omreport_latency,
+               'per_record': args.record_latency,
+               'omconfig': args.omconfig_latency}
+    if args.quick:
+        nodes = [(1, 12)]
+        events = [10000]
+        swift_drives = [12]
+        runs = 5
+    else:
+        nodes = [(c, d) for c in (1, 2, 4) for d in (12, 36, 90)]
+        events = [10000, 1000000]
+        swift_drives = [12, 90, 360]
+        runs = 20
+
+    results = []
+    for controllers, drives in nodes:
+        results += bench_node(controllers, drives, latency)
+    for count in events:
+        results += bench_backend(count)
+    for drives in swift_drives:
+        results += bench_swift(drives)
+    results += bench_coldstart(runs, args.coldstart_budget)
+
+    output = json.dumps({'latency': latency, 'results': results}, indent=2,
+                        sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+    if not all([a['within_budget'] for a in results
+                if a['benchmark'] == 'coldstart']):
+        sys.exit('The cold start is over budget')
+    if [a for a in results if a.get('mapping_errors')]:
+        sys.exit('Some drives have been recorded on the wrong device')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+import signal
+from time import sleep, strftime, time
+from swift_drive.commands.maintenance import Maintenance
+from swift_drive.commands.remove import RemoveDrives
+from swift_drive.commands.sync import Sync
+from swift_drive.common import config as config_file
+from swift_drive.common.config import get_config, reload_config
+from swift_drive.common.metrics import metrics
+from swift_drive.common.outbox import queue_notification
+
+# Default polling intervals, in seconds
+RECON_INTERVAL = 10
+SYNC_INTERVAL = 60
+OUTBOX_INTERVAL = 30
+RETENTION_INTERVAL = 3600
+# How many seconds the retention task can take at most, the rest is done at
+# the next run
+RETENTION_TIME_LIMIT = 10
+
+
+class Daemon():
+    """
+    Keeps running, polling swift-recon for unmounted drives, syncing the
+    backend with the controllers, delivering the notifications queued in
+    the outbox and applying the retention policy. The plugins are loaded
+    once and reused, so every poll only costs the queries themselves.
+
+    SIGHUP reloads the config file and the plugins, SIGTERM and SIGINT stop
+    the daemon once the task in progress is completed.
+    """
+    def __init__(self):
+        self.running = False
+        self.reload_requested = False
+        # Why the last removal stopped, None if it completed. It's kept
+        # across the reloads, so they don't notify again.
+        self.recon_failure = None
+        # The kernel errors swift-drive-audit found so far, None if unknown
+        self.drive_audit_errors = None
+        self.load()
+
+    def load(self):
+        """
+        Load the config and the plugins, and schedule the tasks.
+        """
+        config = {}
+        try:
+            config = get_config('daemon')
+        except Exception:
+            # The section is optional
+            pass
+        self.remover = RemoveDrives()
+        # The notifications are delivered by their own task
+        self.remover.drain_outbox = False
+        # The same failure would be notified at every poll, check_recon
+        # notifies the changes only
+        self.remover.notify = False
+        # The drive audit tells about the drives that are going to fail
+        self.remover.recon_endpoints = ['unmounted', 'driveaudit']
+        self.syncer = Sync(controller=self.remover.controller,
+                           backend=self.remover.backend)
+        self.maintenance = Maintenance(backend=self.remover.backend)
+        self.retention_time_limit = config.get('retention_time_limit',
+                                               RETENTION_TIME_LIMIT)
+        # Every task is a list: [name, interval, function, next run]
+        self.tasks = [
+            ['recon', config.get('recon_interval', RECON_INTERVAL),
+             self.check_recon, 0],
+            ['sync', config.get('sync_interval', SYNC_INTERVAL),
+             self.syncer.main, 0],
+            ['outbox', config.get('outbox_interval', OUTBOX_INTERVAL),
+             self.drain_outbox, 0],
+            ['retention', config.get('retention_interval',
+                                     RETENTION_INTERVAL),
+             self.apply_retention, 0],
+        ]
+
+    def check_recon(self):
+        """
+        Remove the unmounted drives reported by swift-recon. A notification
+        is queued when the removal stops for a new reason, and the recovery
+        is logged. The new errors found by swift-drive-audit are logged too.
+        """
+        # The controller plugin lives as long as the daemon: drop the
+        # snapshots of the previous polls, the drives may have changed since
+        self.remover.controller.forget()
+        try:
+            self.remover.main()
+        finally:
+            audit = self.remover.recon_status.get('driveaudit') or {}
+            errors = audit.get('drive_audit_errors')
+            if errors is not None:
+                if self.drive_audit_errors is not None and \
+                        errors > self.drive_audit_errors:
+                    self.log('recon: swift-drive-audit found %d new kernel '
+                             'errors' % (errors - self.drive_audit_errors))
+                self.drive_audit_errors = errors
+            failure = self.remover.failure
+            if failure != self.recon_failure:
+                if failure is not None:
+                    queue_notification('', failure, self.remover.backend)
+                else:
+                    self.log('recon: the removal completes again')
+                self.recon_failure = failure
+
+    def drain_outbox(self):
+        """
+        Deliver the notifications queued in the outbox.
+        """
+        if not self.remover.notifications:
+            return
+        sent, failed = self.remover.outbox.drain()
+        if sent or failed:
+            self.log('outbox: %d notifications sent, %d failed' %
+                     (sent, failed))
+
+    def apply_retention(self):
+        """
+        Expire the old events, tickets and notifications, for a limited time.
+        """
+        if not hasattr(self.remover.backend, 'expire_events'):
+            return
+        expired, done = self.maintenance.run(self.retention_time_limit)
+        if sum(expired.values()):
+            self.log('retention: %d events, %d tickets and %d notifications '
+                     'expired%s' % (expired['events'], expired['tickets'],
+                                    expired['notifications'],
+                                    '' if done else ', more to go'))
+
+    def reload(self):
+        """
+        Read the config file again and reload the plugins with it. If
+        anything goes wrong we keep running with the old ones.
+        """
+        self.log('Reloading the configuration')
+        remover, syncer, tasks = self.remover, self.syncer, self.tasks
+        snapshot = config_file.conf
+        try:
+            reload_config()
+            self.load()
+            # The plugins are loaded on first use, make sure the new ones
+            # can be loaded before dropping the old ones
+            self.remover.controller.instance()
+            self.remover.backend.instance()
+            metrics.configure()
+        except Exception, e:
+            self.log('Failed to reload the configuration: %s' % e)
+            config_file.conf = snapshot
+            self.remover, self.syncer, self.tasks = remover, syncer, tasks
+            return
+        if remover.backend.loaded and hasattr(remover.backend, 'close'):
+            remover.backend.close()
+
+    def log(self, message):
+        print '%s %s' % (strftime('%Y-%m-%d %H:%M:%S'), message)
+
+    def handle_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self.reload_requested = True
+        else:
+            self.running = False
+
+    def run_task(self, task):
+        """
+        Run a task. Its failures are logged, they never stop the daemon.
+
+        :param task: The task to run.
+        """
+        name, interval, function, next_run = task
+        start = time()
+        try:
+            function()
+        except SystemExit, e:
+            # The commands exit when they can't go any further. They have
+            # already printed the reason.
+            if e.code:
+                self.log('%s stopped with exit code %s' % (name, e.code))
+        except Exception, e:
+            self.log('%s failed: %s' % (name, e))
+        task[3] = start + interval
+        # Publish the metrics collected so far
+        metrics.flush()
+
+    def main(self):
+        signal.signal(signal.SIGHUP, self.handle_signal)
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        signal.signal(signal.SIGINT, self.handle_signal)
+        self.running = True
+        self.log('swift-drive daemon started')
+        while self.running:
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+            for task in self.tasks:
+                if not self.running:
+                    break
+                if task[3] <= time():
+                    self.run_task(task)
+            # Sleep until the next task is due. Signals wake us up earlier.
+            wait = min([task[3] for task in self.tasks]) - time()
+            if wait > 0 and self.running and not self.reload_requested:
+                sleep(wait)
+        if self.remover.backend.loaded and \
+                hasattr(self.remover.backend, 'close'):
+            self.remover.backend.close()
+        self.log('swift-drive daemon stopped')
+
+
+def main():
+    """
+    Main entry point to the daemon; just calls `Daemon().main()`.
+    """
+    return Daemon().main()
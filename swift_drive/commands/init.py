@@ -1,58 +1,91 @@
+from swift_drive.common.cache import CachedController
 from swift_drive.common.config import get_config
-from swift_drive.common.utils import exit, confirm
+from swift_drive.common.utils import exit, confirm, run_parallel
+from swift_drive.plugins import get_plugin
 from time import time
 
 
 class Init():
-    def __init__(self):
+    def __init__(self, controller=None, backend=None):
+        """
+        :param controller: The controller plugin to use. If not given, the
+                           one in the config file is loaded.
+        :param backend: The backend plugin to use. If not given, the one in
+                        the config file is loaded.
+        """
         self.now = int(time())
-        # Load the controller module
-        try:
-            conf_controller = get_config()['controller']
-            controller = getattr(__import__('swift_drive.plugins.controller',
-                                 fromlist=[conf_controller]), conf_controller)
-            self.controller = controller.Controller()
-        except:
-            raise Exception('Failed to load %s controller module'
-                            % conf_controller)
-
-        # Load the ticketing module
-        try:
-            conf_backend = get_config()['backend']
-            backend = getattr(__import__('swift_drive.plugins.backend',
-                              fromlist=[conf_backend]), conf_backend)
-            self.backend = backend.Backend()
-        except:
-            raise Exception('Failed to load %s backend module' % conf_backend)
+        self.controller = controller
+        self.backend = backend
+        # The plugins are loaded on first use
+        if self.controller is None:
+            self.controller = CachedController(get_plugin('controller'))
+        if self.backend is None:
+            self.backend = get_plugin('backend')
+
+    def discover(self, controllers, verbose=True):
+        """
+        Fetch the ports and the drives from all the controllers at the same
+        time. A controller that fails is reported and skipped, the others
+        are still returned.
+
+        :param controllers: A dictionary with the controller ids and slots.
+        :param verbose: Report the timing for every controller.
+        :returns: A dictionary with the information for each controller.
+                  Format: {controller_id: (ports, drives)}
+        """
+        def inspect(controller_id):
+            return (self.controller.get_ports(controller_id),
+                    self.controller.get_all_drives(controller_id))
+
+        max_workers = get_config().get('discovery_workers', 4)
+        controller_ids = sorted(controllers)
+        results = run_parallel(inspect, controller_ids, max_workers)
+        inventory = {}
+        for controller_id, result in zip(controller_ids, results):
+            info, error, duration = result
+            if error is not None:
+                print 'Controller %s (slot %s): discovery failed after ' \
+                      '%.2fs: %s' % (controller_id, controllers[controller_id],
+                                     duration, error)
+                continue
+            ports, drives = info
+            if verbose:
+                print 'Controller %s (slot %s): %d ports and %d drives in ' \
+                      '%.2fs' % (controller_id, controllers[controller_id],
+                                 len(ports), len(drives), duration)
+            inventory[controller_id] = info
+        return inventory
 
     def main(self):
-        # Wipe the current data in the backend
         msg = 'This will wipe out all the data in the backend! Are you sure?'
-        if confirm(msg):
-            self.backend.init_schema()
-        else:
-            exit('OK, I am stopping here.')
+        if not confirm(msg):
+            exit('OK, I am stopping here.', notify=False)
 
-        # Fetch all the information from the controllers and put them into the
-        # backend
+        # Fetch all the information from the controllers before touching the
+        # backend, so we don't wipe it if none of them can be inspected.
+        # Ignore what we have cached, on disk and in memory, we want the
+        # current state.
+        self.controller.invalidate()
         controllers = self.controller.get_controllers()
-        for controller_id in controllers:
-            self.backend.add_controller(controller_id,
-                                        controllers[controller_id])
-            # For each controller get the list of the ports and put them into
-            # the backend
-            ports = self.controller.get_ports(controller_id)
-            for port in ports:
-                port_status, drive_serial = ports[port]
-                self.backend.add_port(port, controller_id, drive_serial,
-                                      port_status)
-            # Now let's move to the drives
-            drives = self.controller.get_all_drives(controller_id)
-            for drive in drives:
-                d = drives[drive]
-                self.backend.add_drive(drive, d['serial'], self.now,
-                                       d['model'], d['firmware'],
-                                       d['capacity'], d['status'])
+        inventory = self.discover(controllers)
+        if controllers and not inventory:
+            exit('Failed to inspect all the controllers. The backend has not '
+                 'been changed.')
+
+        # Wipe the current data in the backend and put the information into it
+        # with a single transaction
+        self.backend.init_schema()
+        with self.backend.transaction():
+            self.backend.add_controllers(controllers.items())
+            for controller_id in inventory:
+                ports, drives = inventory[controller_id]
+                self.backend.add_ports(
+                    (port, controller_id, ports[port][1], ports[port][0])
+                    for port in ports)
+                self.backend.add_drives(
+                    (drive, d['serial'], self.now, d['model'], d['firmware'],
+                     d['capacity'], d['status'])
+                    for drive, d in drives.items())
         print 'Backend initialisation completed!'
 
 
@@ -0,0 +1,91 @@
+from time import sleep, time
+from swift_drive.common.config import get_config
+from swift_drive.common.utils import exit
+from swift_drive.plugins import get_plugin
+
+# Default retention policy
+RETENTION_DAYS = 365
+BATCH_SIZE = 500
+VACUUM_PAGES = 100
+# Seconds to wait between two batches, so a removal waiting for the db gets
+# it in the meantime
+PAUSE = 0.05
+# What expires, see the expire_* methods of the backend
+EXPIRING = ['events', 'tickets', 'notifications']
+
+
+class Maintenance():
+    """
+    Applies the retention policy: the closed events and tickets older than
+    retention_days are summarised per drive and deleted, along with the old
+    notifications, then the space freed is given back to the filesystem.
+    Everything is done in small steps, so the removals are never held up.
+    """
+    def __init__(self, backend=None):
+        self.backend = backend or get_plugin('backend')
+        config = get_config()
+        self.retention_days = config.get('retention_days', RETENTION_DAYS)
+        self.batch_size = config.get('retention_batch_size', BATCH_SIZE)
+        self.vacuum_pages = config.get('vacuum_pages', VACUUM_PAGES)
+
+    def run(self, time_limit=None):
+        """
+        Expire the old rows and vacuum the db.
+
+        :param time_limit: How many seconds to work for at most. The rest is
+                           left for the next run. None means until done.
+        :returns: A tuple with a dictionary with how many rows expired, by
+                  kind, and True if nothing is left to do.
+        """
+        deadline = None
+        if time_limit is not None:
+            deadline = time() + time_limit
+        expired = dict.fromkeys(EXPIRING, 0)
+        if self.retention_days > 0:
+            before = int(time()) - self.retention_days * 86400
+            for kind in EXPIRING:
+                expire = getattr(self.backend, 'expire_%s' % kind)
+                while True:
+                    count = expire(before, self.batch_size)
+                    expired[kind] += count
+                    if count < self.batch_size:
+                        break
+                    if deadline is not None and time() >= deadline:
+                        return expired, False
+                    sleep(PAUSE)
+
+        free_pages = self.backend.vacuum(self.vacuum_pages)
+        while free_pages:
+            if deadline is not None and time() >= deadline:
+                return expired, False
+            sleep(PAUSE)
+            left = self.backend.vacuum(self.vacuum_pages)
+            if left >= free_pages:
+                # Nothing has been given back, the incremental vacuum is off
+                break
+            free_pages = left
+        return expired, True
+
+    def main(self):
+        """
+        Applies the retention policy once, until done.
+        """
+        if not hasattr(self.backend, 'expire_events'):
+            exit('The backend does not support the retention policy.',
+                 notify=False)
+        expired = self.run()[0]
+        print 'Expired %d events, %d tickets and %d notifications.' % (
+              expired['events'], expired['tickets'],
+              expired['notifications'])
+        if getattr(self.backend, 'needs_full_vacuum', None) and \
+                self.backend.needs_full_vacuum():
+            print ('The space freed can\'t be given back until the '
+                   'incremental vacuum is on. Run swift-drive migrate to '
+                   'turn it on.')
+
+
+def main():
+    """
+    Main entry point to the maintenance; just calls `Maintenance().main()`.
+    """
+    return Maintenance().main()
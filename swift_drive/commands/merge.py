@@ -0,0 +1,76 @@
+import argparse
+import os
+import sys
+from time import time
+from swift_drive.common.fleet import Fleet, CHUNK_SIZE
+from swift_drive.common.utils import exit
+
+
+def parse_node(value):
+    """
+    Parse a node db argument: host=path, or just the path if the file is
+    named after the host (eg. /srv/swift-drive/nodes/node01.db).
+
+    :returns: A tuple (host, path).
+    """
+    if '=' in value:
+        return tuple(value.split('=', 1))
+    return os.path.splitext(os.path.basename(value))[0], value
+
+
+class Merge():
+    def __init__(self, args=None):
+        """
+        :param args: The command line arguments. Defaults to the ones after
+                     the command name.
+        """
+        parser = argparse.ArgumentParser(
+            prog='swift-drive merge',
+            description='Merge the backends of many nodes into a fleet db.')
+        parser.add_argument('fleet_db', help='the fleet db, created if '
+                            'missing')
+        parser.add_argument('node_dbs', nargs='+', metavar='[host=]node_db',
+                            type=parse_node,
+                            help='the sqlite db of a node. The host defaults '
+                            'to the file name without the extension')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                            help='how many rows to copy in every transaction')
+        parser.add_argument('--debug', action='store_true',
+                            help=argparse.SUPPRESS)
+        if args is None:
+            args = sys.argv[2:]
+        self.args = parser.parse_args(args)
+
+    def main(self):
+        """
+        Merges the node dbs into the fleet db, one at a time. A node that
+        fails doesn't stop the others.
+        """
+        fleet = Fleet(self.args.fleet_db, self.args.chunk_size)
+        failures = []
+        try:
+            for host, path in self.args.node_dbs:
+                start = time()
+                try:
+                    copied = fleet.merge(host, path)
+                except Exception, e:
+                    print '%s: failed (%s)' % (host, e)
+                    failures.append(host)
+                    continue
+                print '%s: %s in %.2fs' % (
+                      host, ', '.join(['%d %s' % (copied[a], a)
+                                       for a in sorted(copied)]),
+                      time() - start)
+        finally:
+            fleet.close()
+        if failures:
+            exit('Failed to merge %d nodes: %s' % (len(failures),
+                                                   ', '.join(failures)),
+                 notify=False)
+
+
+def main():
+    """
+    Main entry point to the merge; just calls `Merge().main()`.
+    """
+    return Merge().main()
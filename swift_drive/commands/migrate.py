@@ -0,0 +1,46 @@
+from swift_drive.common.utils import exit
+from swift_drive.plugins import get_plugin
+
+
+class Migrate():
+    def __init__(self):
+        # Load the backend module
+        self.backend = get_plugin('backend').instance()
+
+    def main(self):
+        """
+        Upgrades the backend schema to the latest version without losing the
+        data.
+        """
+        if not hasattr(self.backend, 'migrate_schema'):
+            exit('The backend does not support schema migrations.',
+                 notify=False)
+        old_version, new_version = self.backend.migrate_schema()
+        if old_version == new_version:
+            print 'The backend schema is already up to date (version %d).' % \
+                  new_version
+        else:
+            print 'Backend schema upgraded from version %d to %d.' % \
+                  (old_version, new_version)
+        if getattr(self.backend, 'needs_full_vacuum', None) and \
+                self.backend.needs_full_vacuum():
+            # The schema is up to date already, a failure here only delays
+            # the incremental vacuum to the next run
+            print ('Rewriting the whole db to turn on the incremental vacuum. '
+                   'The db is locked until it\'s done: the other commands '
+                   'and the daemon wait for it, or fail after '
+                   'sqlite_busy_timeout seconds.')
+            try:
+                self.backend.full_vacuum()
+            except Exception, e:
+                exit('Failed to rewrite the db: %s\nThe schema is up to date, '
+                     'run swift-drive migrate again to retry.' % e,
+                     notify=False)
+            print 'The incremental vacuum is on.'
+
+
+def main():
+    """
+    Main entry point to the schema migration; just calls `Migrate().main()`.
+    """
+    return Migrate().main()
@@ -1,112 +1,107 @@
-from threading import Thread
 from time import time
+from swift_drive.common.cache import CachedController
 from swift_drive.common.config import get_config
-from swift_drive.common.utils import exit
+from swift_drive.common.outbox import Outbox
+from swift_drive.common.recon import ReconClient
+from swift_drive.common.utils import exit, run_parallel
+from swift_drive.plugins import get_plugin, get_plugins
 from os import getuid
-from urllib2 import urlopen
-try:
-    import simplejson as json
-except ImportError:
-    import json
 
 
 class RemoveDrives():
     def __init__(self):
         self.now = int(time())
-        # Load the controller module
-        try:
-            conf_controller = get_config()['controller']
-            controller = getattr(__import__('swift_drive.plugins.controller',
-                                 fromlist=[conf_controller]), conf_controller)
-            self.controller = controller.Controller()
-        except:
-            # A controller is necessary
-            raise Exception('Failed to load %s controller module'
-                            % conf_controller)
-
-        # Load the backend module
-        try:
-            conf_backend = get_config()['backend']
-            backend = getattr(__import__('swift_drive.plugins.backend',
-                              fromlist=[conf_backend]), conf_backend)
-            self.backend = backend.Backend()
-        except:
-            # A backend is necessary
-            raise Exception('Failed to load %s backend module' % conf_backend)
-
-        # Load the ticketing module
-        try:
-            conf_ticketing = get_config()['ticketing']
-            ticketing = getattr(__import__('swift_drive.plugins.ticketing',
-                                fromlist=[conf_ticketing]), conf_ticketing)
-            self.ticketing = ticketing.Ticketing()
-        except:
-            # We can live without a ticketing system
-            self.ticketing = None
-
-        # Load the notification module
-        try:
-            conf_notification = get_config()['notification']
-            notification = getattr(__import__(
-                                   'swift_drive.plugins.notification',
-                                   fromlist=[conf_notification]),
-                                   conf_notification)
-            self.notification = notification.Notification()
-        except:
-            # We can live without a notification system
-            self.notification = None
+        # The plugins are loaded on first use, so nothing is loaded when
+        # there are no drives to remove. A controller and a backend are
+        # necessary, but we can live without a ticketing and a notification
+        # system.
+        self.controller = CachedController(get_plugin('controller'))
+        self.backend = get_plugin('backend')
+        self.ticketing = get_plugin('ticketing', required=False)
+        self.notifications = get_plugins('notification')
+        self.outbox = Outbox(self.backend, self.notifications)
+        # Deliver the notifications at the end of every run. The daemon
+        # turns this off and delivers them with its own task.
+        self.drain_outbox = True
+        # Send a notification when a run can't go any further. The daemon
+        # turns this off and only notifies when the reason changes.
+        self.notify = True
+        # Why the last run stopped, None if it completed
+        self.failure = None
+        # The swift-recon endpoints fetched at every run, all at once. The
+        # daemon asks for more than the unmounted drives.
+        self.recon_endpoints = ['unmounted']
+        # What the endpoints returned in the last run. Format:
+        # {endpoint: data}
+        self.recon_status = {}
+
+        # The client keeps its connection open between the runs
+        self.recon = ReconClient()
 
     def remove_device(self, device_name):
         """
         Remove a device from the controller, create an event and, if
         configured, raise a ticket and send out a notification.
+        It's safe to run this for many devices at the same time.
 
         :param device_name: The device name.
+        :returns: A dictionary with the result. The status can be removed,
+                  skipped or failed. Format:
+                  {'device': device_name, 'status': status, 'message': msg}
         """
         controller_id, vdisk_id = device_name.strip('c').split('u')
-        # Check if the drive is present in the backend. If not, add it using
-        # the information coming from the controller.
+        # Check if the drive is present in the backend. If not, we'll add it
+        # using the information coming from the controller.
         device_info = self.backend.get_drive(device_name)
+        if device_info is not None:
+            # Check the backend if those drives are already being processed.
+            # Exit if any.
+            events = self.backend.get_event(device_info['serial'],
+                                            status='new')
+            events += self.backend.get_event(device_info['serial'],
+                                             status='inprogress')
+            if len(events) > 0:
+                return {'device': device_name, 'status': 'skipped',
+                        'message': 'Already being processed'}
+        drive_info = self.controller.get_drive_from_device(device_name)
         if device_info is None:
-            drive_info = self.controller.get_drive_from_device(device_name)
             drive_serial = drive_info['serial']
-            self.backend.add_drive(device_name, drive_serial, self.now,
-                                   drive_info['model'], drive_info['firmware'],
-                                   drive_info['capacity'], 'failed')
         else:
             drive_serial = device_info['serial']
-            # Check the backend if those drives are already being processed.
-            # Exit if any.
-            events = self.backend.get_event(drive_serial, status='new')
-            events += self.backend.get_event(drive_serial, status='inprogress')
-            if len(events) > 0:
-                return
-            self.backend.update_drive(device_name, drive_serial,
-                                      status='failed')
 
         # Check if the drive had been already replaced in the past 24 hours
         a_day_ago = self.now - 86400
-        events = self.backend.get_event(drive_serial, time=a_day_ago)
-        if len(events) > 0:
-            exit('The drive %s has been already replaced in the past 24h.\n'
-                 'I am skipping it since it may be a false positive.')
-
-        # At this point we are pretty sure the drive has to be replaced
-        # First thing, fetch the drive information from the controller and
-        # create an event to keep track of the operations, marking the drive
-        # as failed.
-        try:
-            drive_info
-        except:
-            drive_info = self.controller.get_drive_from_device(device_name)
-
-        self.backend.add_event(self.now, drive_serial, drive_info['status'],
-                               'new', 1)
-        # We can now try to remove the drive from the controller
+        replaced = len(self.backend.get_event(drive_serial, time=a_day_ago)) > 0
+
+        # Mark the drive as failed and, if we are pretty sure the drive has to
+        # be replaced, create an event to keep track of the operations. All in
+        # one transaction.
+        with self.backend.transaction():
+            if device_info is None:
+                self.backend.add_drive(device_name, drive_serial, self.now,
+                                       drive_info['model'],
+                                       drive_info['firmware'],
+                                       drive_info['capacity'], 'failed')
+            else:
+                self.backend.update_drive(device_name, drive_serial,
+                                          status='failed')
+            if not replaced:
+                self.backend.add_event(self.now, drive_serial,
+                                       drive_info['status'], 'new', 0)
+        if replaced:
+            return {'device': device_name, 'status': 'skipped',
+                    'message': 'The drive %s has been already replaced in the '
+                               'past 24h. I am skipping it since it may be a '
+                               'false positive.' % drive_serial}
+
+        # We can now try to remove the drive from the controller. The
+        # controller plugin makes sure only one change at a time is made on
+        # each controller.
         try:
             self.controller.remove_device(controller_id, vdisk_id)
         except Exception, msg:
-            exit(msg)
+            return {'device': device_name, 'status': 'failed',
+                    'message': str(msg)}
 
         ################# Uncomment once ticketing is working #################
         # # We should now raise a ticket, if we want it
@@ -123,76 +118,104 @@ class RemoveDrives():
         # # TODO: Add the ticket to the backend using the ticket_number
         #######################################################################
 
-        # We can now update the event status to 'inprogress'
+        # We can now update the event status to 'inprogress' and, in the
+        # same transaction, queue the notification that tells the sysops
+        # the drive is being processed. It's delivered at the end of the run.
+        msg = '%s has failed' % \
+              device_name
+        # If we sent a ticket, say it in the notification
         try:
-            self.backend.update_event(self.now, drive_info['serial'],
-                                      status='inprogress')
-        except Exception, msg:
-            exit(msg)
-
-        # Tell the sysops that the drive is being processed
-        if self.notification is not None:
-            try:
-                msg = '%s has failed' % \
-                      device_name
-                # If we sent a ticket, say it in the notification
-                try:
-                    if ticket_sent:
-                        msg += ' and I successfully raised a ticket'
-                except:
-                    pass
-                self.notification.send_notification('Failed drive', msg)
-                self.backend.update_event(self.now(), drive_info['serial'],
-                                          notification_sent=1)
-            except:
-                # We can survive for now. If needed, we can send out the
-                # notification later on.
-                pass
+            if ticket_sent:
+                msg += ' and I successfully raised a ticket'
+        except:
+            pass
+        try:
+            with self.backend.transaction():
+                self.backend.update_event(self.now, drive_serial,
+                                          status='inprogress')
+                if self.notifications:
+                    self.backend.add_notification(self.now, 'Failed drive',
+                                                  msg, drive_serial,
+                                                  self.now)
+        except Exception, e:
+            return {'device': device_name, 'status': 'failed',
+                    'message': 'Removed from the controller, but failed to '
+                               'update the event: %s' % e}
+
+        return {'device': device_name, 'status': 'removed',
+                'message': 'Removed from the controller'}
 
     def main(self):
         """
         Detects failed drives and replaces them.
         """
+        self.now = int(time())
+        self.failure = None
+        self.recon_status = {}
         # # Only root can run this command, so check the UID first
         if getuid() > 0:
             exit('Only root can run this command', notify=False)
+        try:
+            self.remove_unmounted()
+        finally:
+            # Deliver what this run, or a previous one, queued. Also when
+            # we are exiting because of an error.
+            if self.drain_outbox and self.notifications:
+                try:
+                    self.outbox.drain()
+                except Exception, e:
+                    print 'Failed to deliver the notifications: %s' % e
+
+    def stop(self, message):
+        """
+        Stop the run because it can't go any further, and remember why.
 
+        :param message: The reason, printed and sent as a notification if
+                        notify is set.
+        """
+        self.failure = message
+        exit(message, notify=self.notify)
+
+    def remove_unmounted(self):
+        """
+        Removes the unmounted drives reported by swift-recon.
+        """
         # Get the list of unmounted drives from swift-recon. If there are more than
         # 3, stop and send out a notification: something bad is happening and it
         # requires manual intervention. In the future this value can be fetched
         # from the configuration file.
-        for retries in range(4):
-            if retries == 3:
-                exit('Failed to connect to swift recon for 3 times.\n'
-                     'Please check')
-            try:
-                recon_obj = urlopen('http://127.0.0.1:6000/recon/unmounted')
-            except:
-                continue
-            if recon_obj.code == 200:
-                try:
-                    recon_list = json.loads(recon_obj.read())
-                    unmounted_drives = [a['device'] for a in recon_list]
-                except:
-                    exit('Failed to load the json returned from swift-recon')
-                break
-            else:
-                exit('Invalid HTTP code returned from swift-recon')
+        self.recon_status, errors = self.recon.get_many(self.recon_endpoints)
+        if 'unmounted' in errors:
+            self.stop('Failed to get the unmounted drives from swift recon: '
+                      '%s\nPlease check' % errors['unmounted'])
+        unmounted_drives = [a['device']
+                            for a in self.recon_status['unmounted']]
 
         if len(unmounted_drives) > 3:
-            exit('Too many unmounted drives (currently %d). I\'m stopping here.'
-                 '\nPlease investigate manually.')
-
-        # Set up the thread pool
-        threads = []
-        for drive in unmounted_drives:
-            threads.append(Thread(self.remove_drive(drive,)))
-
-        # Start all threads
-        [thread.start() for thread in threads]
-
-        # Wait for all of them to finish
-        [thread.join() for thread in threads]
+            self.stop('Too many unmounted drives (currently %d). I\'m '
+                      'stopping here.\nPlease investigate manually.' %
+                      len(unmounted_drives))
+
+        # Process the drives at the same time, but not more than
+        # removal_workers of them
+        max_workers = get_config().get('removal_workers', 4)
+        results = []
+        for drive, result in zip(unmounted_drives, run_parallel(
+                self.remove_device, unmounted_drives, max_workers)):
+            res, error, duration = result
+            if error is not None:
+                res = {'device': drive, 'status': 'failed',
+                       'message': str(error)}
+            print '%s: %s (%s)' % (res['device'], res['status'],
+                                   res['message'])
+            results.append(res)
+
+        failures = [a for a in results if a['status'] == 'failed']
+        if failures:
+            self.stop('Failed to remove %d drives:\n%s' % (
+                      len(failures), '\n'.join(['%s: %s' % (a['device'],
+                                                             a['message'])
+                                                 for a in failures])))
 
 
 def main():
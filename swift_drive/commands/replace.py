@@ -1 +1,162 @@
-# Only root can run this command, so check the UID first
\ No newline at end of file
+from time import time
+from swift_drive.common.cache import CachedController
+from swift_drive.common.config import get_config
+from swift_drive.common.utils import exit, confirm
+from swift_drive.plugins import get_plugin
+from os import getuid
+
+
+class Replace():
+    """
+    Adds the drives swapped by the operator back into the system. All the
+    drives waiting for a replacement are processed at once: the vdisks are
+    created, then the devices are partitioned, formatted and mounted as a
+    pipeline (see the add_devices method of the controller).
+    """
+    def __init__(self):
+        self.now = int(time())
+        # The plugins are loaded on first use
+        self.controller = CachedController(get_plugin('controller'))
+        self.backend = get_plugin('backend')
+
+    def find_swapped(self):
+        """
+        Match the drives waiting for a replacement with the new drives
+        inserted into the controllers.
+
+        :returns: A tuple with two lists: the drives that can be added, as
+                  dictionaries with the old drive, the event, the controller
+                  id, the vdisk id and the pdisk id, and the description of
+                  the drives that can't be added yet.
+        """
+        pending = {}
+        skipped = []
+        inventory = self.backend.get_inventory()
+        for event in self.backend.get_events('inprogress'):
+            drive = inventory.get_drive_by_serial(event['drive_serial'])
+            if drive is None:
+                # A sync may have recorded the new drive on the device
+                # already, so the old one is only in the history
+                drive = self.backend.get_drive_by_serial(
+                    event['drive_serial'])
+            if drive is None:
+                skipped.append('%s: unknown drive' % event['drive_serial'])
+                continue
+            controller_id, vdisk_id = drive['name'].strip('c').split('u')
+            port = inventory.get_port_by_serial(drive['serial'])
+            pending.setdefault(controller_id, []).append(
+                {'drive': drive, 'event': event, 'controller_id':
+                 controller_id, 'vdisk_id': vdisk_id,
+                 'pdisk_id': port and port['name']})
+
+        swapped = []
+        for controller_id in sorted(pending):
+            ports = self.controller.get_ports(controller_id)
+            old_serials = [a['drive']['serial']
+                           for a in pending[controller_id]]
+            # The new drives are in use by no vdisk
+            new_ports = sorted([a for a in ports if ports[a][0] != 'active'
+                                and ports[a][1] not in old_serials])
+            # The ports are known unless a sync recorded the new drives
+            # already. In that case the vdisks are paired with the new drives
+            # in port order, as they were created (see get_snapshot).
+            drives = sorted(pending[controller_id],
+                            key=lambda a: int(a['vdisk_id']))
+            unknown = [a for a in drives if a['pdisk_id'] is None]
+            skipped += ['%s: not swapped yet' % a['drive']['name']
+                        for a in drives if a['pdisk_id'] is not None and
+                        a['pdisk_id'] not in new_ports]
+            free_ports = [a for a in new_ports
+                          if a not in [b['pdisk_id'] for b in drives]]
+            if len(unknown) != len(free_ports):
+                skipped += ['%s: can\'t tell which new drive replaces it' %
+                            a['drive']['name'] for a in unknown]
+                unknown = []
+            for drive, pdisk_id in zip(unknown, free_ports):
+                drive['pdisk_id'] = pdisk_id
+            swapped += [a for a in drives if a['pdisk_id'] in new_ports]
+        return swapped, skipped
+
+    def record_drive(self, swapped, device_name):
+        """
+        Records a drive added back, with its port, and closes its event.
+
+        :param swapped: The swapped drive, as returned by find_swapped.
+        :param device_name: The device name of the vdisk created.
+        :returns: The serial of the drive.
+        """
+        d = self.controller.get_drive_from_device(device_name)
+        with self.backend.transaction():
+            self.backend.add_drive(device_name, d['serial'], self.now,
+                                   d['model'], d['firmware'], d['capacity'],
+                                   d['status'])
+            if self.backend.get_port(swapped['pdisk_id'],
+                                     swapped['controller_id']) is None:
+                self.backend.add_port(swapped['pdisk_id'],
+                                      swapped['controller_id'], d['serial'],
+                                      'active')
+            else:
+                self.backend.update_port(swapped['pdisk_id'],
+                                         swapped['controller_id'],
+                                         drive_serial=d['serial'],
+                                         status='active')
+            self.backend.update_event(swapped['event']['time'],
+                                      swapped['event']['drive_serial'],
+                                      status='closed')
+        return d['serial']
+
+    def main(self):
+        """
+        Adds the swapped drives back and closes their events.
+        """
+        self.now = int(time())
+        # Only root can run this command, so check the UID first
+        if getuid() > 0:
+            exit('Only root can run this command', notify=False)
+
+        self.controller.invalidate()
+        swapped, skipped = self.find_swapped()
+        for message in skipped:
+            print message
+        if not swapped:
+            exit('No swapped drives to add.', error_code=0, notify=False)
+        print 'The following drives will be added:'
+        for a in swapped:
+            print 'c%su%s on port %s (replacing %s)' % (
+                  a['controller_id'], a['vdisk_id'], a['pdisk_id'],
+                  a['drive']['serial'])
+        if not confirm('Are you sure?'):
+            exit('OK, I am stopping here.', notify=False)
+
+        max_workers = get_config().get('format_workers', 4)
+        results = self.controller.add_devices(
+            [(a['controller_id'], a['vdisk_id'], a['pdisk_id'])
+             for a in swapped], max_workers)
+
+        failures = []
+        for a, result in zip(swapped, results):
+            # The controller may have picked another vdisk id, so the device
+            # name is the one add_devices returns
+            device_name, error, duration = result
+            if error is None:
+                # Each drive is recorded on its own, so a failure doesn't
+                # lose the drives added already
+                try:
+                    serial = self.record_drive(a, device_name)
+                except Exception, e:
+                    error = 'added, but not recorded: %s' % e
+            if error is not None:
+                print '%s: failed (%s)' % (device_name, error)
+                failures.append('%s: %s' % (device_name, error))
+                continue
+            print '%s: added %s in %.2fs' % (device_name, serial, duration)
+        if failures:
+            exit('Failed to add %d drives:\n%s' % (len(failures),
+                                                   '\n'.join(failures)))
+
+
+def main():
+    """
+    Main entry point to the replace; just calls `Replace().main()`.
+    """
+    return Replace().main()
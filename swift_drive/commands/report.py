@@ -0,0 +1,127 @@
+import argparse
+import sys
+from time import time, strftime, localtime
+from swift_drive.common.fleet import Fleet
+from swift_drive.common.utils import exit
+from swift_drive.plugins import get_plugin
+
+# The counters of the failure rollup, see get_failure_rollup in the backend
+COUNTERS = ['drives', 'install_time', 'failures', 'failure_time',
+            'replacements', 'replace_time']
+# How the failures are grouped. Format: (title, columns)
+GROUPS = [
+    ('Failures by model', ['model']),
+    ('Failures by model and firmware', ['model', 'firmware']),
+    ('Failures by controller slot', ['slot']),
+]
+
+
+def summarise(rows, columns, now):
+    """
+    Add up the rows of the failure rollup by some of their columns and
+    work out the statistics.
+
+    :param rows: The rows of the failure rollup.
+    :param columns: The columns to group the rows by.
+    :param now: The current time.
+    :returns: A list of tuples (key, drives, failures, failure rate, MTBF in
+              days, mean time to replace in hours), sorted by key. The values
+              that can't be worked out are None.
+    """
+    groups = {}
+    for row in rows:
+        key = tuple([row[a] or 'unknown' for a in columns])
+        group = groups.setdefault(key, dict.fromkeys(COUNTERS, 0))
+        for a in COUNTERS:
+            group[a] += row[a]
+
+    summary = []
+    for key in sorted(groups):
+        g = groups[key]
+        rate = mtbf = ttr = None
+        if g['drives']:
+            rate = 100.0 * g['failures'] / g['drives']
+        if g['failures']:
+            # The time the drives have been running, up to now or to their
+            # failure
+            uptime = (g['drives'] - g['failures']) * now - \
+                g['install_time'] + g['failure_time']
+            if uptime > 0:
+                mtbf = float(uptime) / g['failures'] / 86400
+        if g['replacements']:
+            ttr = float(g['replace_time']) / g['replacements'] / 3600
+        summary.append((key, g['drives'], g['failures'], rate, mtbf, ttr))
+    return summary
+
+
+def format_value(value, fmt):
+    if value is None:
+        return '-'
+    return fmt % value
+
+
+class Report():
+    def __init__(self, args=None):
+        """
+        :param args: The command line arguments. Defaults to the ones after
+                     the command name.
+        """
+        parser = argparse.ArgumentParser(
+            prog='swift-drive report',
+            description='Report the drive failures of this node, or of the '
+                        'whole fleet.')
+        parser.add_argument('fleet_db', nargs='?',
+                            help='report on a fleet db (see the merge '
+                            'command) instead of the backend')
+        parser.add_argument('--debug', action='store_true',
+                            help=argparse.SUPPRESS)
+        if args is None:
+            args = sys.argv[2:]
+        self.args = parser.parse_args(args)
+        if self.args.fleet_db:
+            self.backend = Fleet(self.args.fleet_db)
+        else:
+            # Load the backend module
+            self.backend = get_plugin('backend')
+
+    def main(self):
+        """
+        Prints the failure rates, the mean time between failures and the
+        time to replace, by model, firmware and controller slot, along with
+        the devices that keep failing.
+        """
+        if not hasattr(self.backend, 'get_failure_rollup'):
+            exit('The backend does not support the reports.', notify=False)
+        now = int(time())
+        rows = self.backend.get_failure_rollup()
+        for title, columns in GROUPS:
+            print title
+            print '%-40s %7s %8s %7s %11s %11s' % (
+                  '/'.join(columns), 'drives', 'failures', 'rate',
+                  'MTBF (d)', 'replace (h)')
+            for key, drives, failures, rate, mtbf, ttr in \
+                    summarise(rows, columns, now):
+                print '%-40s %7d %8d %7s %11s %11s' % (
+                      '/'.join(key)[:40], drives, failures,
+                      format_value(rate, '%.2f%%'),
+                      format_value(mtbf, '%.1f'), format_value(ttr, '%.1f'))
+            print
+
+        print 'Repeat offenders'
+        print '%-30s %-10s %8s %s' % ('slot', 'vdisk', 'failures',
+                                      'last failure')
+        for a in self.backend.get_repeat_offenders():
+            slot = a['slot'] or 'unknown'
+            if 'host' in a:
+                # From the fleet db
+                slot = '%s/%s' % (a['host'], slot)
+            print '%-30s %-10s %8d %s' % (
+                  slot[:30], a['vdisk'], a['failures'],
+                  strftime('%Y-%m-%d %H:%M', localtime(a['last_failure'])))
+
+
+def main():
+    """
+    Main entry point to the report; just calls `Report().main()`.
+    """
+    return Report().main()
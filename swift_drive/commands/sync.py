@@ -0,0 +1,173 @@
+from swift_drive.commands.init import Init
+from swift_drive.common.utils import exit
+from time import time
+
+# The drive fields that can change without the drive being replaced
+DRIVE_FIELDS = ['model', 'firmware', 'capacity', 'status']
+
+
+class Sync(Init):
+    """
+    Brings the backend up to date with what the controllers report, without
+    wiping it. Only the differences are written, so it's cheap enough to run
+    from cron every minute.
+    """
+    def main(self):
+        self.now = int(time())
+        # We want the current state, not what we have cached on disk nor the
+        # snapshots of a previous run (the daemon reuses the same Sync)
+        self.controller.invalidate()
+        controllers = self.controller.get_controllers()
+        inventory = self.discover(controllers, verbose=False)
+        if controllers and not inventory:
+            exit('Failed to inspect all the controllers. The backend has not '
+                 'been changed.')
+
+        changes = []
+        with self.backend.transaction():
+            changes += self.sync_controllers(controllers)
+            # What the backend knows, read once
+            known = self.backend.get_inventory()
+            changes += self.sync_ports(inventory, known)
+            # If a controller couldn't be inspected we don't know which
+            # drives went missing, so we don't mark any
+            changes += self.sync_drives(
+                inventory, known, len(inventory) == len(controllers))
+
+        for change in changes:
+            print change
+
+    def sync_controllers(self, controllers):
+        """
+        Add the new controllers to the backend, update the ids that changed
+        and remove the controllers that disappeared.
+
+        :param controllers: A dictionary with the controller ids and slots
+                            reported by the controllers.
+        :returns: A list with the description of the changes.
+        """
+        changes = []
+        known = self.backend.get_controllers()
+        known_slots = dict([(known[a], a) for a in known])
+        for controller_id, slot in sorted(controllers.items()):
+            if controller_id in known:
+                continue
+            if slot in known_slots:
+                # Some controllers change their id after a reboot
+                self.backend.update_controller_id(slot, controller_id)
+                changes.append('Controller in slot %s: id changed from %s to '
+                               '%s' % (slot, known_slots[slot],
+                                       controller_id))
+                del known[known_slots[slot]]
+            else:
+                self.backend.add_controller(controller_id, slot)
+                changes.append('Controller %s (slot %s): added' %
+                               (controller_id, slot))
+        for controller_id in sorted(known):
+            if controller_id not in controllers:
+                self.backend.delete_controller(controller_id)
+                changes.append('Controller %s (slot %s): removed' %
+                               (controller_id, known[controller_id]))
+        return changes
+
+    def sync_ports(self, inventory, known):
+        """
+        Add the new ports to the backend and update the ones that changed.
+        The ports that aren't reported any more are marked as unknown.
+
+        :param inventory: The information for each controller, as returned by
+                          discover.
+        :param known: The Inventory of the backend.
+        :returns: A list with the description of the changes.
+        """
+        changes = []
+        missing = set(known.ports)
+        for controller_id in sorted(inventory):
+            ports = inventory[controller_id][0]
+            for name in sorted(ports):
+                status, drive_serial = ports[name]
+                port = known.get_port(controller_id, name)
+                missing.discard((controller_id, name))
+                if port is None:
+                    self.backend.add_port(name, controller_id, drive_serial,
+                                          status)
+                    changes.append('Port %s on controller %s: added (%s, %s)'
+                                   % (name, controller_id, status,
+                                      drive_serial))
+                elif (port['status'], port['drive_serial']) != \
+                        (status, drive_serial):
+                    self.backend.update_port(name, controller_id,
+                                             status=status,
+                                             drive_serial=drive_serial)
+                    changes.append('Port %s on controller %s: (%s, %s) -> '
+                                   '(%s, %s)' % (name, controller_id,
+                                                 port['status'],
+                                                 port['drive_serial'],
+                                                 status, drive_serial))
+        for controller_id, name in sorted(missing):
+            port = known.get_port(controller_id, name)
+            if controller_id in inventory and port['status'] != 'unknown':
+                self.backend.update_port(name, controller_id,
+                                         status='unknown')
+                changes.append('Port %s on controller %s: %s -> unknown' %
+                               (name, controller_id, port['status']))
+        return changes
+
+    def sync_drives(self, inventory, known, complete):
+        """
+        Add the new drives to the backend and update the ones that changed.
+        A new serial on a device is a new drive, so the old entry is kept for
+        the history. The drives marked as failed are left alone, they are
+        taken care of by the removal.
+
+        :param inventory: The information for each controller, as returned by
+                          discover.
+        :param known: The Inventory of the backend.
+        :param complete: True if all the controllers have been inspected, so
+                         the drives not reported any more can be marked as
+                         missing.
+        :returns: A list with the description of the changes.
+        """
+        changes = []
+        current = {}
+        for controller_id in inventory:
+            current.update(inventory[controller_id][1])
+        for name in sorted(current):
+            d = current[name]
+            drive = known.get_drive(name)
+            if drive is None or drive['serial'] != d['serial']:
+                self.backend.add_drive(name, d['serial'], self.now,
+                                       d['model'], d['firmware'],
+                                       d['capacity'], d['status'])
+                changes.append('Drive %s: added %s (%s)' %
+                               (name, d['serial'], d['status']))
+                continue
+            if drive['status'] == 'failed':
+                continue
+            updates = dict([(a, d[a]) for a in DRIVE_FIELDS
+                            if drive[a] != d[a]])
+            if updates:
+                descr = ', '.join(['%s %s -> %s' % (a, drive[a], updates[a])
+                                   for a in sorted(updates)])
+                updates['last_update'] = self.now
+                self.backend.update_drive(name, d['serial'], **updates)
+                changes.append('Drive %s: %s' % (name, descr))
+        if complete:
+            for name in sorted(known.drives):
+                drive = known.get_drive(name)
+                if name in current or \
+                        drive['status'] in ['failed', 'missing']:
+                    continue
+                self.backend.update_drive(name, drive['serial'],
+                                          status='missing',
+                                          last_update=self.now)
+                changes.append('Drive %s: %s -> missing' %
+                               (name, drive['status']))
+        return changes
+
+
+def main():
+    """
+    Main entry point to the sync; just calls `Sync().main()`.
+    """
+    return Sync().main()
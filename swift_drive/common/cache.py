@@ -0,0 +1,158 @@
+import os
+import threading
+from time import time
+from swift_drive.common.config import get_config
+from swift_drive.common.inventory import decode_record, encode_record
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+CACHE_FILE = '/var/cache/swift-drive/inventory.json'
+CACHE_TTL = 300
+
+
+class CachedController(object):
+    """
+    Wraps a controller plugin and keeps the results of its read-only queries
+    on disk, so the commands don't need to query the controller every time
+    they run. The results expire after cache_ttl seconds and they are all
+    dropped as soon as something changes the state of the controller.
+
+    Every other attribute is taken from the wrapped controller.
+    """
+    # Methods whose results can be cached
+    cached_methods = ['get_controllers', 'get_ports', 'get_all_drives',
+                      'get_drive_from_controller', 'get_drive_from_device']
+    # Methods that change the state of the controller
+    mutating_methods = ['remove_device', 'add_device', 'add_devices',
+                        'create_vdisk', 'switch_led']
+
+    def __init__(self, controller):
+        """
+        :param controller: The controller plugin instance to wrap.
+        """
+        self.controller = controller
+        config = get_config()
+        self.path = config.get('cache_file', CACHE_FILE)
+        self.ttl = config.get('cache_ttl', CACHE_TTL)
+        self.lock = threading.Lock()
+        # The cache is loaded from disk on first use. Format:
+        # {key: [time, value]}
+        self.entries = None
+        # The inode, mtime and size of the file the entries come from, None
+        # if there is no file
+        self.stamp = None
+
+    def __getattr__(self, name):
+        attr = getattr(self.controller, name)
+        if self.ttl <= 0:
+            return attr
+        if name in self.cached_methods:
+            def cached(*args):
+                return self.get(name, attr, *args)
+            return cached
+        if name in self.mutating_methods:
+            def mutating(*args, **kwargs):
+                try:
+                    return attr(*args, **kwargs)
+                finally:
+                    # The controller drops its own snapshots of what changed
+                    self.drop_entries()
+            return mutating
+        return attr
+
+    def get(self, name, method, *args):
+        """
+        Returns the cached result for a method, calling it if the result is
+        missing or expired.
+
+        :param name: The method name.
+        :param method: The method of the wrapped controller.
+        :param args: The arguments for the method.
+        :returns: The result of the method.
+        """
+        key = ':'.join([name] + [str(a) for a in args])
+        now = time()
+        with self.lock:
+            entries = self.load()
+            if key in entries and now - entries[key][0] < self.ttl:
+                return entries[key][1]
+        value = method(*args)
+        with self.lock:
+            entries = self.load()
+            entries[key] = [now, value]
+            self.save()
+        return value
+
+    def invalidate(self):
+        """
+        Drop all the cached results, both in memory and on disk, and the
+        snapshots the controller keeps in memory, so the next queries see the
+        current state of the controllers.
+        """
+        self.drop_entries()
+        forget = getattr(self.controller, 'forget', None)
+        if forget is not None:
+            forget()
+
+    def drop_entries(self):
+        """
+        Drop the cached results, both in memory and on disk.
+        """
+        with self.lock:
+            self.entries = {}
+            self.stamp = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def get_stamp(self, path):
+        """
+        :returns: The inode, mtime and size of a file, None if it's missing.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_ino, st.st_mtime, st.st_size
+
+    def load(self):
+        """
+        Load the cache from disk, unless it's loaded already and the file
+        hasn't changed since. Another process may have updated the cache or
+        invalidated it (eg. remove or replace run while the daemon is up). A
+        missing or unreadable file is just an empty cache.
+
+        :returns: The cache entries.
+        """
+        stamp = self.get_stamp(self.path)
+        if self.entries is None or stamp != self.stamp:
+            self.stamp = stamp
+            try:
+                with open(self.path) as f:
+                    self.entries = json.load(f, object_hook=decode_record)
+            except (IOError, KeyError, TypeError, ValueError):
+                self.entries = {}
+        return self.entries
+
+    def save(self):
+        """
+        Write the cache to disk. The file is replaced atomically so other
+        processes never read a partial cache. Failing to write the cache is
+        not an error, we will just query the controller again next time.
+        """
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.entries, f, default=encode_record)
+            # The rename keeps the inode, so we won't read our own writes
+            stamp = self.get_stamp(tmp_path)
+            os.rename(tmp_path, self.path)
+            self.stamp = stamp
+        except (IOError, OSError):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
@@ -1,31 +1,162 @@
 import ConfigParser
+import os
 
-# CONFIG_FILE = '/etc/swift-drive/swift-drive.conf'
-# This is for testing
-CONFIG_FILE = '/home/dvaleriani/swift-drive/etc/swift-drive.conf-sample'
+# The config file can be overridden with the SWIFT_DRIVE_CONFIG environment
+# variable
+CONFIG_FILE = os.environ.get('SWIFT_DRIVE_CONFIG',
+                             '/etc/swift-drive/swift-drive.conf')
 
 
 class ConfigFileError(Exception):
     pass
 
 
-conf = ConfigParser.ConfigParser()
-try:
-    conf.read(CONFIG_FILE)
-except ConfigParser.Error, e:
-    raise ConfigFileError("Error trying to load config {0}: {1}".format(
-                          CONFIG_FILE, e))
+def _list(value):
+    return tuple([a.strip() for a in value.split(',') if a.strip()])
+
+
+def _path(value):
+    return os.path.expanduser(value.strip())
+
+
+# The options that aren't strings, converted once when the file is read.
+# Format: {section: {option: conversion}}
+OPTIONS = {
+    'common': {
+        'notifications': _list,
+        'discovery_workers': int,
+        'removal_workers': int,
+        'format_workers': int,
+        'command_timeout': float,
+        'cache_file': _path,
+        'cache_ttl': int,
+        'outbox_max_attempts': int,
+        'outbox_backoff': int,
+        'retention_days': int,
+        'retention_batch_size': int,
+        'vacuum_pages': int,
+    },
+    'daemon': {
+        'recon_interval': int,
+        'sync_interval': int,
+        'outbox_interval': int,
+        'retention_interval': int,
+        'retention_time_limit': float,
+    },
+    'recon': {
+        'recon_port': int,
+        'recon_timeout': float,
+        'recon_retries': int,
+        'recon_backoff': float,
+    },
+    'metrics': {
+        'metrics_textfile': _path,
+        'statsd_port': int,
+    },
+    'perc800': {
+        'controller_binaries': _list,
+    },
+    'sqlite': {
+        'sqlite_db': _path,
+        'sqlite_busy_timeout': float,
+    },
+    'swift': {
+        'swift_timeout': float,
+        'swift_retries': int,
+        'swift_backoff': float,
+        'swift_cache_ttl': float,
+    },
+    'email': {
+        'notification_email_recipients': _list,
+        'notification_email_port': int,
+        'notification_email_retries': int,
+        'notification_email_backoff': float,
+        'notification_email_window': float,
+    },
+}
+
+
+class Section(dict):
+    """
+    The options of a section. It's shared by all the callers, so it can't be
+    changed.
+    """
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('The configuration can not be changed')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = \
+        update = _readonly
+
+
+class Config(object):
+    """
+    A snapshot of the config file: it's parsed, converted and validated
+    once, then it never changes. Reloading the config file creates a new
+    snapshot.
+    """
+    def __init__(self, path):
+        """
+        :param path: The config file to read.
+        """
+        self.path = path
+        parser = ConfigParser.ConfigParser()
+        try:
+            parser.read(path)
+        except ConfigParser.Error, e:
+            raise ConfigFileError("Error trying to load config {0}: "
+                                  "{1}".format(path, e))
+        self.sections = {}
+        for section in parser.sections():
+            try:
+                values = dict(parser.items(section))
+            except ConfigParser.Error, e:
+                raise ConfigFileError("Error reading conf section {0}: "
+                                      "{1}".format(section, e))
+            for option, conversion in OPTIONS.get(section, {}).items():
+                if option not in values:
+                    continue
+                try:
+                    values[option] = conversion(values[option])
+                except ValueError:
+                    raise ConfigFileError("Invalid value for {0} in conf "
+                                          "section {1}: {2}".format(
+                                          option, section, values[option]))
+            self.sections[section] = Section(values)
+
+    def get(self, section):
+        try:
+            return self.sections[section]
+        except KeyError:
+            raise ConfigFileError("Error reading conf section {0}: No "
+                                  "section: '{0}'".format(section))
+
+
+# The config file is read on first use, see get_config
+conf = None
+
+
+def reload_config(path=None):
+    """
+    Read the config file (again). The new snapshot replaces the old one, in
+    a single step, only if the whole file can be parsed, so the callers
+    never see a partially loaded config.
+
+    :param path: The config file to read. Defaults to CONFIG_FILE.
+    """
+    global conf
+    conf = Config(path or CONFIG_FILE)
 
 
 def get_config(section="common"):
     """
     Get the values for the specified section in the config file.
 
-    :param config_file: The configuration file to read.
-    :returns: A dictionary with the configuration values.
+    :param section: The section to get.
+    :returns: A read-only dictionary with the configuration values. The
+              options in OPTIONS are already converted.
     """
-    try:
-        return dict(conf.items(section))
-    except ConfigParser.Error, e:
-        raise ConfigFileError("Error reading conf section {0}: {1}".format(
-                              section, e))
+    snapshot = conf
+    if snapshot is None:
+        reload_config()
+        snapshot = conf
+    return snapshot.get(section)
@@ -1,48 +1,20 @@
 import os
-import re
 import subprocess
-import urllib2
+import threading
+from swift_drive.common.recon import ReconClient
 from swift_drive.common.utils import execute
-try:
-    from simplejson import json
-except ImportError:
-    import json
+
+# Serialises the changes to /etc/fstab when many drives are mounted at once
+fstab_lock = threading.Lock()
 
 
 def get_unmounted_devices():
     """
     Get unmounted drives information from swift-recon
 
-    :returns: A dictionary containing the unmounted drives
+    :returns: A list of dictionaries containing the unmounted drives
     """
-    ip_address = '127.0.0.1'
-    port = '6000'
-    url = 'http://%s:%s/recon/unmounted' % (ip_address, port)
-
-    retries = 0
-    timeout = 10
-    while (retries < 3):
-        try:
-            urlobj = urllib2.urlopen(url, timeout=timeout)
-            break
-
-        except urllib2.URLError, e:
-            if str(e.reason) == 'timed out':
-                retries = retries + 1
-                timeout += 5
-
-        except urllib2.HTTPError, e:
-            print "Error code: %s" % e.code
-            raise
-
-    if retries == 3:
-        exit(1)
-
-    if re.match(r'^2[0-9][0-9]$', str(urlobj.code).strip()):
-        body = urlobj.read()
-        content = json.loads(body)
-
-    return content
+    return ReconClient().get('unmounted')
 
 
 def is_mounted(device_name, basepath='/srv/node'):
@@ -69,8 +41,9 @@ def mount(device_name, basepath='/srv/node'):
     :returns: A boolean value that reflects the result of the operation.
     """
     mount_point = os.path.join(basepath, device_name)
-    subprocess.call(['/bin/sed', '-i', 's/^#LABEL=%s/LABEL=%s/' %
-                    (device_name, device_name), '/etc/fstab'])
+    with fstab_lock:
+        subprocess.call(['/bin/sed', '-i', 's/^#LABEL=%s/LABEL=%s/' %
+                        (device_name, device_name), '/etc/fstab'])
     try:
         subprocess.call(['mount', mount_point])
     except:
@@ -123,15 +96,15 @@ def format_device(device_name, size, label=None):
         parted_label = '/sbin/parted -s ' + device_path + ' mklabel gpt'
         parted_result = execute(parted_label)
         if parted_result[0].startswith('Error:'):
-            msg = ("Error: Unable to create GPT partition label for device %s"
-                   "Parted error: %s ") % (device_path, parted_result[0])
-            exit(msg)
+            msg = ("Error: Unable to create GPT partition label for device "
+                   "%s\nParted error: %s ") % (device_path, parted_result[0])
+            raise Exception(msg)
 
         parted_partition = '/sbin/parted -s %s mkpart primary xfs 0 %s' % \
                            (device_path, size)
         parted_result = execute(parted_partition)
         if parted_result[0].startswith('Error:'):
-            msg = ("Error: Unable to create partition table.\n"
+            msg = ("Error: Unable to create partition table for device %s\n"
                    "Parted error: %s") % (device_path, parted_result[0])
             raise Exception(msg)
     else:
@@ -145,6 +118,6 @@ def format_device(device_name, size, label=None):
         (label, partition_path)
     mkfs_result = execute(mkfs_cmd)
     if mkfs_result[0].startswith('Cannot'):
-        msg = ("Cannot create a filesystem on device %s"
+        msg = ("Cannot create a filesystem on device %s\n"
                "Mkfs error: %s") % (device_path, mkfs_result[0])
-        exit(msg)
+        raise Exception(msg)
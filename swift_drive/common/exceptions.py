@@ -19,3 +19,33 @@ class ResponseError(Error):
 
     def __repr__(self):
         return '%d - %s' % (self.status, self.reason)
+
+
+class CommandTimeout(Error):
+    """
+    A command didn't complete in time and it has been killed
+    """
+    def __init__(self, cmd, timeout):
+        self.cmd = cmd
+        self.timeout = timeout
+        Error.__init__(self)
+
+    def __str__(self):
+        return 'Command timed out after %ss: %s' % (self.timeout, self.cmd)
+
+    def __repr__(self):
+        return 'Command timed out after %ss: %s' % (self.timeout, self.cmd)
+
+
+class ReconError(Error):
+    """
+    swift-recon could not be reached or returned an invalid response
+    """
+    pass
+
+
+class SwiftError(Error):
+    """
+    Swift could not be reached or returned an invalid response
+    """
+    pass
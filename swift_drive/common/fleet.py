@@ -0,0 +1,345 @@
+"""
+The fleet db: the sqlite backends of many nodes merged into a single db, to
+answer the questions about the whole cluster (eg. which firmware fails the
+most, or if a drive has already failed on another node). Every row records
+the host it comes from.
+
+The node dbs are attached to the fleet db one at a time and copied with
+INSERT ... SELECT, in chunks, every chunk in its own transaction. The events
+and tickets are merged incrementally: only the rows added after the
+high-water mark of the node (and the ones that can still change) are read
+again. The other tables are small and are copied whole every time.
+
+Usage:
+    fleet = Fleet('/srv/swift-drive/fleet.db')
+    fleet.merge('node01', '/srv/swift-drive/nodes/node01.db')
+"""
+import os
+import sqlite3
+from time import time
+
+CHUNK_SIZE = 5000
+# The events and tickets change until they are closed. The ones not closed
+# yet are merged again every time, unless they are older than the newest one
+# by more than this many seconds.
+REOPEN_WINDOW = 30 * 86400
+
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS nodes (
+        host TEXT PRIMARY KEY,
+        path TEXT,
+        last_merge INTEGER,
+        events_mark INTEGER,
+        tickets_mark INTEGER
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS drives (
+        host TEXT,
+        name TEXT,
+        serial TEXT,
+        last_update INTEGER,
+        model TEXT,
+        firmware TEXT,
+        capacity TEXT,
+        status TEXT,
+        PRIMARY KEY (host, name, serial)
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS drives_serial ON drives (serial)',
+    'CREATE INDEX IF NOT EXISTS drives_model_firmware '
+    'ON drives (model, firmware)',
+    '''
+    CREATE TABLE IF NOT EXISTS ports (
+        host TEXT,
+        name TEXT,
+        controller_id TEXT,
+        drive_serial TEXT,
+        status TEXT,
+        PRIMARY KEY (host, name, controller_id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS controllers (
+        host TEXT,
+        id TEXT,
+        slot TEXT,
+        PRIMARY KEY (host, id)
+    )
+    ''',
+    # The same event merged twice (eg. from two copies of a node db) is
+    # stored once
+    '''
+    CREATE TABLE IF NOT EXISTS events (
+        host TEXT,
+        time INTEGER,
+        drive_serial TEXT,
+        error TEXT,
+        status TEXT,
+        notification_sent INTEGER,
+        UNIQUE (drive_serial, time)
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS events_host_time ON events (host, time)',
+    '''
+    CREATE TABLE IF NOT EXISTS tickets (
+        host TEXT,
+        time INTEGER,
+        ticket_number TEXT,
+        drive_serial TEXT,
+        status TEXT,
+        PRIMARY KEY (host, ticket_number)
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS tickets_serial ON tickets (drive_serial)',
+    '''
+    CREATE TABLE IF NOT EXISTS failure_rollup (
+        host TEXT,
+        model TEXT,
+        firmware TEXT,
+        slot TEXT,
+        drives INTEGER,
+        install_time INTEGER,
+        failures INTEGER,
+        failure_time INTEGER,
+        replacements INTEGER,
+        replace_time INTEGER,
+        PRIMARY KEY (host, model, firmware, slot)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS slot_rollup (
+        host TEXT,
+        slot TEXT,
+        vdisk TEXT,
+        failures INTEGER,
+        last_failure INTEGER,
+        PRIMARY KEY (host, slot, vdisk)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS drive_history (
+        host TEXT,
+        drive_serial TEXT,
+        events INTEGER,
+        first_event INTEGER,
+        last_event INTEGER,
+        last_error TEXT,
+        tickets INTEGER,
+        PRIMARY KEY (host, drive_serial)
+    )
+    ''',
+]
+
+# The tables merged incrementally, by rowid. Format: {table: columns}
+INCREMENTAL = {
+    'events': ['time', 'drive_serial', 'error', 'status',
+               'notification_sent'],
+    'tickets': ['time', 'ticket_number', 'drive_serial', 'status'],
+}
+# The tables copied whole. The drives are among them because they are
+# updated in place (eg. when they fail) without a time to tell. The rollups
+# and the history are missing from the older node dbs. Format:
+# [(table, columns)]
+SNAPSHOTS = [
+    ('controllers', ['id', 'slot']),
+    ('ports', ['name', 'controller_id', 'drive_serial', 'status']),
+    ('drives', ['name', 'serial', 'last_update', 'model', 'firmware',
+                'capacity', 'status']),
+    ('failure_rollup', ['model', 'firmware', 'slot', 'drives',
+                        'install_time', 'failures', 'failure_time',
+                        'replacements', 'replace_time']),
+    ('slot_rollup', ['slot', 'vdisk', 'failures', 'last_failure']),
+    ('drive_history', ['drive_serial', 'events', 'first_event',
+                       'last_event', 'last_error', 'tickets']),
+]
+
+
+def dict_factory(cursor, row):
+    d = {}
+    for idx, col in enumerate(cursor.description):
+        d[col[0]] = row[idx]
+    return d
+
+
+class Fleet(object):
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        """
+        :param path: The fleet db, created if missing.
+        :param chunk_size: How many rows to copy in every transaction.
+        """
+        self.path = path
+        self.chunk_size = chunk_size
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = dict_factory
+        self.db.execute('PRAGMA journal_mode = WAL')
+        for query in SCHEMA:
+            self.db.execute(query)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def merge(self, host, path):
+        """
+        Merge a node db into the fleet db. The node db is only read.
+
+        :param host: The node the db comes from.
+        :param path: The node db.
+        :returns: A dictionary with how many rows have been copied, by
+                  table.
+        """
+        # ATTACH would create a missing db
+        if not os.path.isfile(path):
+            raise Exception('%s does not exist' % path)
+        # ATTACH can't run inside a transaction
+        self.db.commit()
+        self.db.execute('ATTACH DATABASE ? AS node', (path, ))
+        try:
+            query = '''
+            SELECT name FROM node.sqlite_master
+            WHERE type = 'table'
+            '''
+            tables = set([a['name'] for a in self.db.execute(query)])
+            if 'events' not in tables:
+                raise Exception('%s is not a swift-drive db' % path)
+            node = self.db.execute('SELECT * FROM nodes WHERE host = ?',
+                                   (host, )).fetchone() or {}
+            copied = {}
+            marks = {}
+            for table in sorted(INCREMENTAL):
+                if table in tables:
+                    copied[table], marks[table] = self.merge_incremental(
+                        host, table, node.get('%s_mark' % table))
+            for table, columns in SNAPSHOTS:
+                if table in tables:
+                    copied[table] = self.merge_snapshot(host, table, columns)
+            query = '''
+            INSERT OR REPLACE INTO nodes (
+                host,
+                path,
+                last_merge,
+                events_mark,
+                tickets_mark
+            ) VALUES (?, ?, ?, ?, ?)
+            '''
+            self.db.execute(query, (host, path, int(time()),
+                                    marks.get('events'),
+                                    marks.get('tickets')))
+            self.db.commit()
+        except:
+            self.db.rollback()
+            raise
+        finally:
+            self.db.execute('DETACH DATABASE node')
+        return copied
+
+    def merge_incremental(self, host, table, mark):
+        """
+        Copy the rows of a node table from the high-water mark onwards.
+        Every chunk is committed on its own; the rows are copied again if
+        the merge doesn't complete, and the duplicates are replaced.
+
+        :param host: The node the db comes from.
+        :param table: The table to copy.
+        :param mark: The high-water mark of the last merge: the first rowid
+                     of the node table to copy. None to copy the whole
+                     table.
+        :returns: A tuple with how many rows have been copied and the new
+                  high-water mark.
+        """
+        columns = INCREMENTAL[table]
+        newest = self.db.execute('SELECT MAX(rowid) AS id, MAX(time) AS time '
+                                 'FROM node.%s' % table).fetchone()
+        if newest['id'] is None:
+            return 0, mark
+        if mark is None or mark > newest['id'] + 1:
+            # New, or the node db has been initialised again
+            mark = 0
+        insert = '''
+        INSERT OR REPLACE INTO main.%s (host, %s)
+        SELECT ?, %s FROM node.%s
+        WHERE rowid > ?
+        AND rowid <= ?
+        ''' % (table, ', '.join(columns), ', '.join(columns), table)
+        bound = '''
+        SELECT MAX(rowid) AS last, COUNT(*) AS count FROM (
+            SELECT rowid FROM node.%s
+            WHERE rowid > ?
+            ORDER BY rowid
+            LIMIT ?
+        )
+        ''' % table
+        copied = 0
+        last = mark - 1
+        while True:
+            chunk = self.db.execute(bound, (last,
+                                            self.chunk_size)).fetchone()
+            if not chunk['count']:
+                break
+            self.db.execute(insert, (host, last, chunk['last']))
+            self.db.commit()
+            copied += chunk['count']
+            last = chunk['last']
+
+        # The next merge starts from the oldest row that can still change,
+        # or after the newest one
+        query = '''
+        SELECT MIN(rowid) AS id FROM node.%s
+        WHERE status != 'closed'
+        AND time >= ?
+        ''' % table
+        oldest_open = self.db.execute(query, (newest['time'] - REOPEN_WINDOW,
+                                              )).fetchone()['id']
+        if oldest_open is None:
+            return copied, newest['id'] + 1
+        return copied, oldest_open
+
+    def merge_snapshot(self, host, table, columns):
+        """
+        Replace the rows of a node with the ones in a node table.
+
+        :param host: The node the db comes from.
+        :param table: The table to copy.
+        :param columns: The columns to copy.
+        :returns: How many rows have been copied.
+        """
+        self.db.execute('DELETE FROM main.%s WHERE host = ?' % table,
+                        (host, ))
+        query = '''
+        INSERT OR REPLACE INTO main.%s (host, %s)
+        SELECT ?, %s FROM node.%s
+        ''' % (table, ', '.join(columns), ', '.join(columns), table)
+        cur = self.db.execute(query, (host, ))
+        self.db.commit()
+        return cur.rowcount
+
+    def get_failure_rollup(self):
+        """
+        Extract the failure counters of all the nodes, as get_failure_rollup
+        of the sqlite backend does.
+        """
+        query = '''
+        SELECT model, firmware, slot, SUM(drives) AS drives,
+               SUM(install_time) AS install_time, SUM(failures) AS failures,
+               SUM(failure_time) AS failure_time,
+               SUM(replacements) AS replacements,
+               SUM(replace_time) AS replace_time
+        FROM failure_rollup
+        GROUP BY model, firmware, slot
+        '''
+        return self.db.execute(query).fetchall()
+
+    def get_repeat_offenders(self, min_failures=2):
+        """
+        Extract the devices that failed again and again on all the nodes,
+        most failures first, as get_repeat_offenders of the sqlite backend
+        does. The host is in the results too.
+        """
+        query = '''
+        SELECT * FROM slot_rollup
+        WHERE failures >= ?
+        ORDER BY failures DESC, last_failure DESC
+        '''
+        return self.db.execute(query, (min_failures, )).fetchall()
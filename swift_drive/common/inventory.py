@@ -0,0 +1,316 @@
+"""
+The records shared by the controller plugins, the backends and the commands:
+drives, ports, controllers and events. They have a fixed set of fields kept
+in __slots__, so they are smaller and quicker to build than dictionaries, and
+they can still be read like dictionaries (drive['serial'], drive.get('port'))
+so the code written for the dictionaries keeps working.
+
+The Inventory keeps the drives, the ports and the controllers of a node
+indexed by what the commands look them up with, so a lookup doesn't need a
+scan or another query.
+
+Usage:
+    inventory = backend.get_inventory()
+    drive = inventory.get_drive_by_serial('9XG3ABCD')
+    port = inventory.get_port(controller_id, drive['port'])
+"""
+
+
+class Record(object):
+    __slots__ = ()
+    # The columns of the table the records are stored in. Any other field is
+    # only set by the controller plugins.
+    columns = ()
+
+    def __init__(self, *args, **kwargs):
+        """
+        Build a record from the values of its fields, in order, or by name.
+        The missing fields are None.
+        """
+        if len(args) > len(self.__slots__):
+            raise TypeError('%s takes at most %d fields' %
+                            (type(self).__name__, len(self.__slots__)))
+        for field, value in zip(self.__slots__, args):
+            setattr(self, field, value)
+        for field in self.__slots__[len(args):]:
+            setattr(self, field, kwargs.pop(field, None))
+        if kwargs:
+            raise TypeError('Unknown %s fields: %s' %
+                            (type(self).__name__, ', '.join(sorted(kwargs))))
+
+    def __getitem__(self, field):
+        try:
+            return getattr(self, field)
+        except (AttributeError, TypeError):
+            raise KeyError(field)
+
+    def __setitem__(self, field, value):
+        if field not in self.__slots__:
+            raise KeyError(field)
+        setattr(self, field, value)
+
+    def __contains__(self, field):
+        return field in self.__slots__
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.values() == other.values()
+
+    def __ne__(self, other):
+        return not self == other
+
+    # The records can change, like the dictionaries
+    __hash__ = None
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__,
+                           ', '.join(['%s=%r' % a for a in self.items()]))
+
+    def get(self, field, default=None):
+        return getattr(self, field, default)
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def values(self):
+        return [getattr(self, a) for a in self.__slots__]
+
+    def items(self):
+        return zip(self.__slots__, self.values())
+
+    def update(self, values):
+        for field, value in values.items():
+            self[field] = value
+
+    def copy(self):
+        return type(self)(*self.values())
+
+
+class Drive(Record):
+    __slots__ = ('name', 'serial', 'last_update', 'model', 'firmware',
+                 'capacity', 'status', 'port', 'controller_slot')
+    columns = ('name', 'serial', 'last_update', 'model', 'firmware',
+               'capacity', 'status')
+
+
+class Port(Record):
+    __slots__ = ('name', 'controller_id', 'drive_serial', 'status')
+    columns = __slots__
+
+
+class Controller(Record):
+    __slots__ = ('id', 'slot')
+    columns = __slots__
+
+
+class Event(Record):
+    __slots__ = ('time', 'drive_serial', 'error', 'status',
+                 'notification_sent')
+    columns = __slots__
+
+
+RECORDS = [Drive, Port, Controller, Event]
+# The record types by table name
+TABLES = {'drives': Drive, 'ports': Port, 'controllers': Controller,
+          'events': Event}
+# The record types by name, and by the columns of their table in any order
+_by_name = dict([(a.__name__, a) for a in RECORDS])
+_by_columns = dict([(frozenset(a.columns), a) for a in RECORDS])
+# How to build the rows, by cursor description. Format:
+# {description: (record type or dict, column names, in field order)}
+_row_types = {}
+
+
+def record_factory(cursor, row):
+    """
+    Row factory for the sqlite connections. The whole rows of the drives,
+    ports, controllers and events tables become records, the other rows
+    dictionaries.
+    """
+    description = cursor.description
+    try:
+        cls, names, ordered = _row_types[description]
+    except KeyError:
+        names = tuple([a[0] for a in description])
+        cls = _by_columns.get(frozenset(names), dict)
+        ordered = cls is not dict and \
+            names == cls.__slots__[:len(names)]
+        _row_types[description] = cls, names, ordered
+    if ordered:
+        return cls(*row)
+    if cls is dict:
+        return dict(zip(names, row))
+    return cls(**dict(zip(names, row)))
+
+
+def encode_record(record):
+    """
+    JSON encoder for the records (json.dump(value, f, default=encode_record)).
+    Decode them with decode_record.
+    """
+    if isinstance(record, Record):
+        return {'__record__': type(record).__name__,
+                'values': record.values()}
+    raise TypeError('%r is not JSON serializable' % (record, ))
+
+
+def decode_record(value):
+    """
+    JSON decoder for the records encoded by encode_record
+    (json.load(f, object_hook=decode_record)).
+    """
+    name = value.get('__record__')
+    if name is None:
+        return value
+    return _by_name[name](*value['values'])
+
+
+class Inventory(object):
+    def __init__(self, drives=(), ports=(), controllers=()):
+        """
+        :param drives: The drives, the most updated entry of each device.
+        :param ports: The ports.
+        :param controllers: The controllers.
+        """
+        # The drives by device name and by serial
+        self.drives = {}
+        self.serials = {}
+        # The ports by (controller_id, name) and by drive serial
+        self.ports = {}
+        self.port_serials = {}
+        # The names of the drives and the keys of the ports, by status
+        self.drive_statuses = {}
+        self.port_statuses = {}
+        # The controllers by id
+        self.controllers = {}
+        for drive in drives:
+            self.add(drive)
+        for port in ports:
+            self.add(port)
+        for controller in controllers:
+            self.add(controller)
+
+    def add(self, record):
+        """
+        Add a record, or replace the one with the same device name, port or
+        controller id.
+
+        :param record: A Drive, a Port or a Controller.
+        """
+        if isinstance(record, Drive):
+            self.remove(self.drives.get(record.name))
+            self.drives[record.name] = record
+            other = self.serials.get(record.serial)
+            # A drive moved to another device keeps the newest entry
+            if other is None or \
+                    (other.last_update or 0) <= (record.last_update or 0):
+                self.serials[record.serial] = record
+            self.drive_statuses.setdefault(record.status,
+                                           set()).add(record.name)
+        elif isinstance(record, Port):
+            key = (record.controller_id, record.name)
+            self.remove(self.ports.get(key))
+            self.ports[key] = record
+            if record.drive_serial:
+                self.port_serials[record.drive_serial] = record
+            self.port_statuses.setdefault(record.status, set()).add(key)
+        elif isinstance(record, Controller):
+            self.controllers[record.id] = record
+        else:
+            raise TypeError('Unsupported record: %r' % (record, ))
+
+    def remove(self, record):
+        """
+        Remove a record from the inventory and its indexes. None is ignored.
+
+        :param record: A Drive, a Port or a Controller.
+        """
+        if record is None:
+            return
+        if isinstance(record, Drive):
+            if self.drives.get(record.name) is not record:
+                return
+            del self.drives[record.name]
+            if self.serials.get(record.serial) is record:
+                del self.serials[record.serial]
+            self.drive_statuses[record.status].discard(record.name)
+        elif isinstance(record, Port):
+            key = (record.controller_id, record.name)
+            if self.ports.get(key) is not record:
+                return
+            del self.ports[key]
+            if self.port_serials.get(record.drive_serial) is record:
+                del self.port_serials[record.drive_serial]
+            self.port_statuses[record.status].discard(key)
+        elif self.controllers.get(record.id) is record:
+            del self.controllers[record.id]
+
+    def update(self, record, **values):
+        """
+        Change some fields of a record, keeping the indexes up to date.
+
+        :param record: A record of the inventory.
+        :param values: The new values of the fields.
+        """
+        self.remove(record)
+        record.update(values)
+        self.add(record)
+
+    def get_drive(self, name):
+        """
+        :param name: The device name.
+        :returns: The drive, or None.
+        """
+        return self.drives.get(name)
+
+    def get_drive_by_serial(self, serial):
+        """
+        :param serial: The drive serial number.
+        :returns: The drive, or None.
+        """
+        return self.serials.get(serial)
+
+    def get_drives_by_status(self, status):
+        """
+        :param status: The drive status.
+        :returns: The drives with the status, sorted by device name.
+        """
+        return [self.drives[a]
+                for a in sorted(self.drive_statuses.get(status, ()))]
+
+    def get_port(self, controller_id, name):
+        """
+        :param controller_id: The id of the controller the port is on.
+        :param name: The port name.
+        :returns: The port, or None.
+        """
+        return self.ports.get((controller_id, name))
+
+    def get_port_by_serial(self, drive_serial):
+        """
+        :param drive_serial: The serial of the drive attached to the port.
+        :returns: The port, or None.
+        """
+        return self.port_serials.get(drive_serial)
+
+    def get_ports_by_status(self, status):
+        """
+        :param status: The port status.
+        :returns: The ports with the status, sorted by controller id and
+                  name.
+        """
+        return [self.ports[a]
+                for a in sorted(self.port_statuses.get(status, ()))]
+
+    def get_controller_slot(self, controller_id):
+        """
+        :param controller_id: The controller id.
+        :returns: The PCI slot of the controller, or None.
+        """
+        controller = self.controllers.get(controller_id)
+        return controller and controller.slot
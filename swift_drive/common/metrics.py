@@ -0,0 +1,209 @@
+"""
+Counters and latency histograms for the slow parts of swift-drive: the
+external commands, the backend queries, the swift-recon and Swift requests
+and the notifications.
+
+The metrics are kept in memory and published, according to the [metrics]
+section of the config file:
+- as a Prometheus textfile, for the node_exporter textfile collector. The
+  file is written when the process exits (and after every daemon task), so
+  it describes the last run of a command or the whole life of the daemon.
+- as statsd timers, sent over UDP as soon as they are recorded.
+
+Usage:
+    with metrics.timer('command', binary='omreport', subcommand='storage'):
+        ...
+    metrics.observe('recon_request', 0.02, endpoint='unmounted', status=200)
+"""
+import atexit
+import os
+import socket
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from time import time
+from swift_drive.common.config import get_config
+
+# The upper bounds, in seconds, of the histogram buckets
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+           120]
+PREFIX = 'swift_drive'
+
+HELP = {
+    'command': 'External commands run, by binary, subcommand and exit '
+               'status',
+    'backend': 'Backend method calls, by method and status',
+    'recon_request': 'swift-recon requests, by endpoint and HTTP status',
+    'notification': 'Notifications sent, by plugin and status',
+    'swift_request': 'Swift requests of the swift backend, by method and '
+                     'HTTP status',
+}
+
+
+class Metrics(object):
+    """
+    The metrics recorded by this process. Safe to use from many threads.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # {(name, labels): [count, sum, [count per bucket]]}
+        self.histograms = {}
+        self.configured = False
+        self.textfile = None
+        self.statsd = None
+        self.statsd_prefix = PREFIX
+        self.socket = None
+
+    def configure(self):
+        """
+        Read the [metrics] section of the config file. It's done on first
+        use, and again after the config is reloaded.
+        """
+        try:
+            config = get_config('metrics')
+        except Exception:
+            # The section is optional, without it nothing is published
+            config = {}
+        self.textfile = config.get('metrics_textfile') or None
+        self.statsd = None
+        if config.get('statsd_host'):
+            self.statsd = (config['statsd_host'],
+                           config.get('statsd_port', 8125))
+            if self.socket is None:
+                self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.statsd_prefix = config.get('statsd_prefix', PREFIX)
+        self.configured = True
+
+    def observe(self, name, duration, **labels):
+        """
+        Record an operation.
+
+        :param name: The metric name, eg. command.
+        :param duration: How many seconds the operation took.
+        :param labels: The labels identifying the operation, eg. binary.
+        """
+        if not self.configured:
+            self.configure()
+        key = (name, tuple(sorted((a, str(b)) for a, b in labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0, 0.0,
+                                                    [0] * len(BUCKETS)]
+            histogram[0] += 1
+            histogram[1] += duration
+            for index, bound in enumerate(BUCKETS):
+                if duration <= bound:
+                    histogram[2][index] += 1
+        if self.statsd is not None:
+            self.send_statsd(key, duration)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Record how long the block takes. The status label is set to error if
+        the block raises an exception, ok otherwise, unless it's given.
+        """
+        start = time()
+        try:
+            yield
+        except:
+            labels.setdefault('status', 'error')
+            self.observe(name, time() - start, **labels)
+            raise
+        labels.setdefault('status', 'ok')
+        self.observe(name, time() - start, **labels)
+
+    def send_statsd(self, key, duration):
+        """
+        Send a statsd timer. Failing to send it is not an error.
+        """
+        name, labels = key
+        # The status goes last, eg. swift_drive.command.omreport.storage.0
+        values = [b for a, b in labels if a != 'status'] + \
+                 [b for a, b in labels if a == 'status']
+        metric = '.'.join([self.statsd_prefix, name] +
+                          [a.replace('.', '_').replace(' ', '_')
+                           for a in values])
+        try:
+            self.socket.sendto('%s:%d|ms' % (metric, duration * 1000),
+                               self.statsd)
+        except socket.error:
+            pass
+
+    def render(self):
+        """
+        Returns the metrics in the Prometheus text format.
+        """
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+        lines = []
+        last = None
+        for (name, labels), (count, total, buckets) in histograms:
+            metric = '%s_%s_duration_seconds' % (PREFIX, name)
+            if name != last:
+                lines.append('# HELP %s %s' % (metric, HELP.get(name, name)))
+                lines.append('# TYPE %s histogram' % metric)
+                last = name
+            label_list = ['%s="%s"' % (a, b.replace('\\', '\\\\')
+                                       .replace('"', '\\"'))
+                          for a, b in labels]
+            for bound, value in zip(BUCKETS, buckets):
+                lines.append('%s_bucket{%s} %d' % (
+                             metric, ','.join(label_list +
+                                              ['le="%s"' % bound]), value))
+            lines.append('%s_bucket{%s} %d' % (
+                         metric, ','.join(label_list + ['le="+Inf"']), count))
+            lines.append('%s_sum{%s} %f' % (metric, ','.join(label_list),
+                                            total))
+            lines.append('%s_count{%s} %d' % (metric, ','.join(label_list),
+                                              count))
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        """
+        Write the Prometheus textfile, if configured. The file is replaced
+        atomically so node_exporter never reads a partial file. Failing to
+        write it is not an error.
+        """
+        if not self.configured:
+            self.configure()
+        if self.textfile is None or not self.histograms:
+            return
+        tmp_path = '%s.%d.tmp' % (self.textfile, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(self.render())
+            os.rename(tmp_path, self.textfile)
+        except (IOError, OSError):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+metrics = Metrics()
+atexit.register(metrics.flush)
+
+
+def timed_methods(name, prefixes):
+    """
+    Class decorator that records every call to the methods whose name starts
+    with one of the prefixes. The method name is the method label.
+
+    :param name: The metric name, eg. backend.
+    :param prefixes: The prefixes of the methods to record, eg. ['get_'].
+    """
+    def wrap(method_name, method):
+        @wraps(method)
+        def timed(*args, **kwargs):
+            with metrics.timer(name, method=method_name):
+                return method(*args, **kwargs)
+        return timed
+
+    def decorate(cls):
+        for method_name, method in cls.__dict__.items():
+            if callable(method) and method_name.startswith(tuple(prefixes)):
+                setattr(cls, method_name, wrap(method_name, method))
+        return cls
+    return decorate
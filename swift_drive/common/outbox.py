@@ -0,0 +1,124 @@
+"""
+Delivery of the notifications queued in the backend outbox. The commands
+queue their notifications in the same transaction as the changes they are
+about, and the outbox is drained afterwards (at the end of the run, or by
+the daemon), so a slow or unreachable MTA never delays the handling of the
+drives, and a failed delivery is retried instead of being lost.
+"""
+import uuid
+from time import time
+from swift_drive.common.config import get_config
+from swift_drive.common.utils import send_notifications
+from swift_drive.plugins import get_plugin, get_plugins
+
+# Seconds a notification is claimed for by a delivery in progress
+LEASE = 300
+# Delivery attempts before giving up on a notification
+MAX_ATTEMPTS = 10
+# The first delay, in seconds, between the attempts, doubled every time
+BACKOFF = 60
+MAX_BACKOFF = 3600
+
+
+class Outbox(object):
+    def __init__(self, backend, notifications=None):
+        """
+        :param backend: The backend plugin with the outbox.
+        :param notifications: The notification plugins to deliver with, as
+                              get_plugins returns them. Defaults to the ones
+                              in the config file.
+        """
+        self.backend = backend
+        self.notifications = notifications
+        config = get_config()
+        self.max_attempts = config.get('outbox_max_attempts', MAX_ATTEMPTS)
+        self.backoff = config.get('outbox_backoff', BACKOFF)
+
+    def drain(self, limit=100):
+        """
+        Deliver the notifications due. The ones that fail are retried later
+        with an exponential backoff, up to max_attempts times, and only with
+        the plugins that failed to deliver them.
+
+        :param limit: How many notifications to deliver at most.
+        :returns: A tuple with the number of notifications sent and failed.
+        """
+        if self.notifications is None:
+            self.notifications = get_plugins('notification')
+        if not self.notifications:
+            # Nothing to deliver with, they will wait
+            return 0, 0
+        now = int(time())
+        pending = self.backend.get_notifications(now, uuid.uuid4().hex,
+                                                 LEASE, limit)
+        if not pending:
+            return 0, 0
+
+        # The plugins that delivered each notification, by id. A failed
+        # notification is only retried with the plugins that didn't.
+        delivered = dict([(a['id'], set(filter(None, (a['delivered'] or
+                                                      '').split(','))))
+                          for a in pending])
+        errors = {}
+        for notification in self.notifications:
+            sent = []
+            for a in pending:
+                if notification.name in delivered[a['id']]:
+                    continue
+                try:
+                    notification.send_notification(a['subject'], a['body'])
+                    sent.append(a)
+                except Exception, e:
+                    errors[a['id']] = e
+            # Send what the plugin may have kept for a digest
+            if hasattr(notification, 'flush'):
+                try:
+                    notification.flush()
+                except Exception, e:
+                    for a in sent:
+                        errors.setdefault(a['id'], e)
+                    continue
+            for a in sent:
+                delivered[a['id']].add(notification.name)
+
+        now = int(time())
+        with self.backend.transaction():
+            for a in pending:
+                if a['id'] not in errors:
+                    self.backend.update_notification(a['id'], status='sent',
+                                                     sent_time=now,
+                                                     claim=None)
+                    if a['event_time'] is not None:
+                        self.backend.update_event(a['event_time'],
+                                                  a['drive_serial'],
+                                                  notification_sent=1)
+                    continue
+                attempts = a['attempts'] + 1
+                delay = min(MAX_BACKOFF, self.backoff * 2 ** (attempts - 1))
+                self.backend.update_notification(
+                    a['id'], attempts=attempts, next_attempt=now + delay,
+                    last_error=str(errors[a['id']]), claim=None,
+                    delivered=','.join(sorted(delivered[a['id']])) or None,
+                    status='failed' if attempts >= self.max_attempts
+                    else 'pending')
+        return len(pending) - len(errors), len(errors)
+
+
+def queue_notification(subject, body, backend=None):
+    """
+    Queue a notification in the outbox of the backend. If that's not
+    possible, the notification is sent right away.
+
+    :param subject: The notification subject.
+    :param body: The notification body.
+    :param backend: The backend plugin. Defaults to the one in the config
+                    file.
+    :returns: A list with the errors, as send_notifications does.
+    """
+    try:
+        if backend is None:
+            backend = get_plugin('backend')
+        backend.add_notification(int(time()), subject, body)
+        return []
+    except Exception:
+        return send_notifications(subject, body)
@@ -0,0 +1,167 @@
+import httplib
+import random
+import socket
+import threading
+from time import sleep, time
+from swift_drive.common.config import get_config
+from swift_drive.common.exceptions import ReconError, ResponseError
+from swift_drive.common.metrics import metrics
+from swift_drive.common.utils import run_parallel
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+# The endpoints fetched by get_many, along with the type of data they return
+ENDPOINTS = {'unmounted': list, 'diskusage': list, 'driveaudit': dict,
+             'replication': dict}
+
+
+class ReconClient(object):
+    """
+    Client for the swift-recon middleware of the local object server. The
+    connections are kept open between the requests, in a small pool shared by
+    the threads, so the short lived threads of get_many reuse them. Failed
+    requests are retried with a jittered exponential backoff.
+    """
+    def __init__(self):
+        try:
+            config = get_config('recon')
+        except Exception:
+            # The section is optional
+            config = {}
+        self.host = config.get('recon_host', '127.0.0.1')
+        self.port = config.get('recon_port', 6000)
+        self.timeout = config.get('recon_timeout', 10)
+        self.retries = config.get('recon_retries', 3)
+        # The first delay between the retries, doubled every time
+        self.backoff = config.get('recon_backoff', 0.5)
+        self.max_backoff = 10
+        # The idle connections, at most one for each endpoint get_many
+        # fetches at the same time
+        self.idle = []
+        self.max_idle = len(ENDPOINTS)
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take an idle connection, or open a new one if there are none.
+        """
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return httplib.HTTPConnection(self.host, self.port,
+                                      timeout=self.timeout)
+
+    def release(self, connection):
+        """
+        Give back a connection whose response has been read completely, so
+        the next request can use it.
+        """
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        """
+        Close the idle connections.
+        """
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
+
+    def get(self, endpoint):
+        """
+        Fetch a recon endpoint.
+
+        :param endpoint: The endpoint name, eg. unmounted.
+        :returns: The data returned by recon.
+        """
+        path = '/recon/%s' % endpoint
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                delay = min(self.max_backoff,
+                            self.backoff * 2 ** (attempt - 1))
+                sleep(random.uniform(0, delay))
+            start = time()
+            connection = self.acquire()
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error), e:
+                metrics.observe('recon_request', time() - start,
+                                endpoint=endpoint, status='error')
+                # The connection may have been closed by the server, we'll
+                # open a new one next time
+                connection.close()
+                error = e
+                continue
+            self.release(connection)
+            metrics.observe('recon_request', time() - start,
+                            endpoint=endpoint, status=response.status)
+            if response.status >= 500:
+                error = ResponseError(response.status, response.reason)
+                continue
+            if response.status != 200:
+                raise ResponseError(response.status, response.reason)
+            try:
+                data = json.loads(body)
+            except ValueError:
+                raise ReconError('Invalid json returned from %s' % path)
+            self.validate(endpoint, data)
+            return data
+        raise ReconError('Failed to fetch %s from swift-recon after %d '
+                         'attempts: %s' % (path, self.retries + 1, error))
+
+    def validate(self, endpoint, data):
+        """
+        Check the data returned by recon has the expected format.
+
+        :param endpoint: The endpoint name.
+        :param data: The data returned by recon.
+        """
+        data_type = ENDPOINTS.get(endpoint)
+        if data_type is not None and not isinstance(data, data_type):
+            raise ReconError('Unexpected data returned from /recon/%s: %r' %
+                             (endpoint, data))
+        if endpoint == 'unmounted':
+            for device in data:
+                if not isinstance(device, dict) or 'device' not in device:
+                    raise ReconError('Unexpected device returned from '
+                                     '/recon/unmounted: %r' % (device,))
+
+    def get_unmounted(self):
+        """
+        Get the names of the unmounted devices.
+
+        :returns: A list with the device names.
+        """
+        return [a['device'] for a in self.get('unmounted')]
+
+    def get_many(self, endpoints=None):
+        """
+        Fetch many recon endpoints at the same time.
+
+        :param endpoints: The endpoint names. Defaults to unmounted,
+                          diskusage, driveaudit and replication.
+        :returns: A tuple with two dictionaries: the data returned for each
+                  endpoint and the errors for the endpoints that failed.
+                  Format: ({endpoint: data}, {endpoint: error})
+        """
+        if endpoints is None:
+            endpoints = sorted(ENDPOINTS)
+        results = {}
+        errors = {}
+        for endpoint, result in zip(endpoints, run_parallel(
+                self.get, endpoints, len(endpoints))):
+            data, error, duration = result
+            if error is None:
+                results[endpoint] = data
+            else:
+                errors[endpoint] = error
+        return results, errors
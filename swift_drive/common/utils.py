@@ -1,42 +1,183 @@
 import os
 import re
+import select
 import shlex
 import sys
 import socket
 import subprocess
-from swift_drive.plugins.notification import *
+import Queue
+from threading import Thread
+from time import sleep, time
 from swift_drive.common.config import get_config
+from swift_drive.common.exceptions import CommandTimeout
+from swift_drive.common.metrics import metrics
+from swift_drive.plugins import get_plugins
+
+# Seconds a command is allowed to run when no timeout is configured
+DEFAULT_COMMAND_TIMEOUT = 120
 
 
 def get_hostname():
     return socket.gethostname()
 
 
-def execute(cmd):
+class Command(object):
     """
-    execute a command and formats the output that is given back by
-    the subprocess.
+    Run a command and stream its output line by line (stderr included) while
+    it's still running. The command is killed if it doesn't complete before
+    the timeout: first with SIGTERM, then with SIGKILL if it's still alive
+    after kill_timeout seconds.
 
-    :param cmd: The command that should be passed over to the subprocess call.
-    :returns: An array with the line output.
+    Usage:
+        command = Command('omreport storage controller', timeout=60)
+        for line in command:
+            print line
+        print command.returncode, command.duration
     """
-    if isinstance(cmd, unicode):
-        cmd = cmd.encode('utf8')
+    def __init__(self, cmd, timeout=None, kill_timeout=5):
+        """
+        :param cmd: The command to run.
+        :param timeout: Seconds the command is allowed to run. None means no
+                        limit.
+        :param kill_timeout: Seconds to wait for the command to exit after
+                             SIGTERM before sending SIGKILL.
+        """
+        if isinstance(cmd, unicode):
+            cmd = cmd.encode('utf8')
+        self.cmd = cmd
+        self.timeout = timeout
+        self.kill_timeout = kill_timeout
+        self.returncode = None
+        self.duration = None
 
-    args = shlex.split(cmd)
-    try:
+    def __iter__(self):
+        start = time()
+        deadline = None
+        if self.timeout is not None:
+            deadline = start + self.timeout
+        args = shlex.split(self.cmd)
+        status = None
         p = subprocess.Popen(args,
                              stdin=subprocess.PIPE,
                              stdout=subprocess.PIPE,
                              stderr=subprocess.STDOUT,
                              close_fds=True)
-    except:
-        raise
+        p.stdin.close()
+        try:
+            fd = p.stdout.fileno()
+            buf = ''
+            while True:
+                wait = None
+                if deadline is not None:
+                    wait = deadline - time()
+                    if wait <= 0:
+                        status = 'timeout'
+                        raise CommandTimeout(self.cmd, self.timeout)
+                if not select.select([fd], [], [], wait)[0]:
+                    continue
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    break
+                lines = (buf + chunk).split('\n')
+                buf = lines.pop()
+                for line in lines:
+                    yield line
+            if buf:
+                yield buf
+            # The output is closed, but the command may still be running
+            while p.poll() is None:
+                if deadline is not None and time() >= deadline:
+                    status = 'timeout'
+                    raise CommandTimeout(self.cmd, self.timeout)
+                sleep(0.01)
+        finally:
+            # Also reached when the caller stops reading the output
+            if p.poll() is None:
+                if status is None:
+                    status = 'killed'
+                self.kill(p)
+            p.stdout.close()
+            self.returncode = p.returncode
+            self.duration = time() - start
+            binary, subcommand = command_name(args)
+            if status is None:
+                status = self.returncode
+            metrics.observe('command', self.duration, binary=binary,
+                            subcommand=subcommand, status=status)
+
+    def kill(self, p):
+        """
+        Terminate the process, escalating to SIGKILL if it doesn't exit, and
+        reap it so no zombies are left behind.
+
+        :param p: The Popen object of the process.
+        """
+        try:
+            p.terminate()
+            deadline = time() + self.kill_timeout
+            while p.poll() is None and time() < deadline:
+                sleep(0.05)
+            if p.poll() is None:
+                p.kill()
+                p.wait()
+        except OSError:
+            # The process exited in the meantime
+            p.poll()
+
+    def run(self):
+        """
+        Run the command and wait for it to complete.
+
+        :returns: A list with the output lines.
+        """
+        return list(self)
+
+
+def command_name(args):
+    """
+    The binary and the subcommand run by a command, used to tell the commands
+    apart in the metrics. The subcommand is made of the first two arguments
+    that aren't options, values or paths, eg. 'storage pdisk' for
+    'omreport storage pdisk controller=1 -fmt xml', followed by the action if
+    any, eg. 'storage controller deletevdisk' for omconfig.
+
+    :param args: The command arguments.
+    :returns: A tuple (binary, subcommand).
+    """
+    binary = os.path.basename(args[0]) if args else ''
+    words = [a for a in args[1:]
+             if not a.startswith('-') and '=' not in a and '/' not in a]
+    words = words[:2] + [a.split('=', 1)[1] for a in args[1:]
+                         if a.startswith('action=')]
+    return binary, ' '.join(words)
+
+
+def get_command_timeout():
+    """
+    Returns how many seconds an external command is allowed to run, from the
+    command_timeout option in the config file.
+    """
+    try:
+        return get_config().get('command_timeout', DEFAULT_COMMAND_TIMEOUT)
+    except Exception:
+        return DEFAULT_COMMAND_TIMEOUT
+
 
-    output = p.stdout.read()
+def execute(cmd, timeout=None):
+    """
+    execute a command and formats the output that is given back by
+    the subprocess.
+
+    :param cmd: The command that should be passed over to the subprocess call.
+    :param timeout: Seconds the command is allowed to run. Defaults to the
+                    command_timeout option in the config file.
+    :returns: An array with the line output.
+    """
+    if timeout is None:
+        timeout = get_command_timeout()
 
     lines = []
-    for x in output.strip().split('\n'):
+    for x in Command(cmd, timeout).run():
         if not re.match(r'^$', x):
             lines.append(x)
 
@@ -47,6 +188,68 @@ def execute(cmd):
     return lines
 
 
+def run_parallel(function, items, max_workers=4):
+    """
+    Run a function against every item using a bounded pool of threads.
+    An exception raised for one item doesn't stop the others, it's returned
+    with the results instead.
+
+    :param function: The function to call. It takes the item as argument.
+    :param items: The items to process.
+    :param max_workers: The maximum number of threads running at once.
+    :returns: A list of tuples (result, error, duration) in the same order as
+              the items. error is None if the call succeeded.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    queue = Queue.Queue()
+    for index in range(len(items)):
+        queue.put(index)
+
+    def worker():
+        while True:
+            try:
+                index = queue.get_nowait()
+            except Queue.Empty:
+                return
+            start = time()
+            try:
+                results[index] = (function(items[index]), None, time() - start)
+            except Exception, e:
+                results[index] = (None, e, time() - start)
+
+    threads = [Thread(target=worker)
+               for n in range(max(1, min(max_workers, len(items))))]
+    [thread.start() for thread in threads]
+    [thread.join() for thread in threads]
+    return results
+
+
+def send_notifications(subject, message, notifications=None):
+    """
+    Send a notification with every notification module configured.
+
+    :param subject: The notification subject.
+    :param message: The notification body.
+    :param notifications: The notification plugins to use. Defaults to the
+                          ones in the config file.
+    :returns: A list with the errors, empty if all the notifications have
+              been sent.
+    """
+    errors = []
+    try:
+        if notifications is None:
+            notifications = get_plugins('notification')
+    except Exception, e:
+        return [e]
+    for notification in notifications:
+        try:
+            notification.send_notification(subject, message)
+        except Exception, e:
+            errors.append(e)
+    return errors
+
+
 def exit(message, subject='', error_code=1, notify=True):
     '''
     Exit with a specific error code (default 1).
@@ -57,16 +260,10 @@ def exit(message, subject='', error_code=1, notify=True):
     :param notify: Should we send out a notification?
     '''
     if notify:
-        try:
-            notification_types = get_config()['notifications'].split(',')
-            for notification in notification_types:
-                try:
-                    eval(notification).send_notification(subject, message)
-                except:
-                    raise Exception('Error: notification type not found')
-        except:
-            # Nothing serious, just no need to notify
-            pass
+        # The notification is queued in the outbox, so we don't wait for
+        # the delivery. Nothing serious if it fails, just no need to notify.
+        from swift_drive.common.outbox import queue_notification
+        queue_notification(subject, message)
     print message
     sys.exit(error_code)
 
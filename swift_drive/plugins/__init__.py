@@ -0,0 +1,108 @@
+"""
+The plugin registry. The plugins are resolved by name, but they are imported
+and instantiated only when they are used for the first time, so a command
+that has nothing to do doesn't pay for the plugins it would have needed (eg.
+connecting to the SMTP server or opening the db).
+
+Usage:
+    backend = get_plugin('backend')            # the one in the config file
+    backend.get_drive('c0u1')                  # imported and created here
+    for notification in get_plugins('notification'):
+        notification.send_notification(subject, body)
+"""
+import threading
+from swift_drive.common.config import get_config
+
+# The plugin kinds, along with the class every plugin module provides and the
+# option of the [common] section that names the plugins to use
+KINDS = {
+    'controller': ('Controller', 'controller'),
+    'backend': ('Backend', 'backend'),
+    'ticketing': ('Ticketing', 'ticketing'),
+    'notification': ('Notification', 'notifications'),
+}
+
+
+def load_plugin(kind, name):
+    """
+    Import a plugin module.
+
+    :param kind: The plugin kind, eg. backend.
+    :param name: The plugin name, eg. sqlite.
+    :returns: The plugin class.
+    """
+    if kind not in KINDS:
+        raise Exception('Unknown plugin kind %s' % kind)
+    try:
+        module = getattr(__import__('swift_drive.plugins.%s' % kind,
+                                    fromlist=[name]), name)
+        return getattr(module, KINDS[kind][0])
+    except (ImportError, AttributeError), e:
+        raise Exception('Failed to load %s %s module: %s' % (name, kind, e))
+
+
+class LazyPlugin(object):
+    """
+    Stands in for a plugin instance. The plugin is imported and created when
+    one of its attributes is used for the first time; if that fails, the
+    exception is raised there and again at every later use.
+    """
+    def __init__(self, kind, name):
+        """
+        :param kind: The plugin kind, eg. backend.
+        :param name: The plugin name, eg. sqlite.
+        """
+        self.kind = kind
+        self.name = name
+        self.lock = threading.Lock()
+        self.plugin = None
+
+    def instance(self):
+        """
+        The plugin instance, created on first use.
+        """
+        if self.plugin is None:
+            with self.lock:
+                if self.plugin is None:
+                    self.plugin = load_plugin(self.kind, self.name)()
+        return self.plugin
+
+    @property
+    def loaded(self):
+        return self.plugin is not None
+
+    def __getattr__(self, name):
+        return getattr(self.instance(), name)
+
+    def __repr__(self):
+        return '<LazyPlugin %s %s>' % (self.kind, self.name)
+
+
+def get_plugin(kind, name=None, required=True):
+    """
+    Get a plugin by name.
+
+    :param kind: The plugin kind, eg. backend.
+    :param name: The plugin name. Defaults to the one in the config file.
+    :param required: If the config file doesn't name any plugin, raise an
+                     exception when True, return None otherwise.
+    :returns: The plugin, loaded on first use.
+    """
+    if name is None:
+        name = get_config().get(KINDS[kind][1], '').strip()
+        if not name:
+            if required:
+                raise Exception('No %s module configured' % kind)
+            return None
+    return LazyPlugin(kind, name)
+
+
+def get_plugins(kind):
+    """
+    Get all the plugins named, as a list, in the config file (eg. the
+    notifications).
+
+    :param kind: The plugin kind, eg. notification.
+    :returns: A list with the plugins, loaded on first use.
+    """
+    return [LazyPlugin(kind, a) for a in get_config().get(KINDS[kind][1], ())]
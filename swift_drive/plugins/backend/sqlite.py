@@ -1,35 +1,19 @@
 import sqlite3
+import threading
+from contextlib import contextmanager
+from time import time as current_time
 from swift_drive.common.config import get_config
+from swift_drive.common.inventory import Inventory, record_factory
+from swift_drive.common.metrics import timed_methods
 
 
-def dict_factory(cursor, row):
-    d = {}
-    for idx, col in enumerate(cursor.description):
-        d[col[0]] = row[idx]
-    return d
-
-
-class Backend():
-    def __init__(self):
-        # Define the accepted statuses for the ports and drives
-        self.valid_port_status_list = ['active', 'error', 'disabled',
-                                       'unknown', 'foreign']
-        self.valid_drive_status_list = ['active', 'failed', 'missing',
-                                        'disabled', 'unknown']
-        self.conf = get_config('sqlite')
-        dbfile = self.conf['sqlite_db']
-        self.db = sqlite3.connect(dbfile)
-        self.db.row_factory = dict_factory
-        self.cur = self.db.cursor()
-
-    def init_schema(self):
-        """
-        Initialise the SQLite db schema.
-        WARNING: it will wipe out all the existing data!
-        """
-        query = 'DROP TABLE IF EXISTS drives'
-        self.cur.execute(query)
-        query = '''
+# Every migration is a list of queries that brings the schema to the next
+# version: the first one creates the original schema, the others upgrade it in
+# place. New migrations must be appended at the end of the list.
+MIGRATIONS = [
+    # Version 1: the original schema
+    [
+        '''
         CREATE TABLE drives (
             name INT,
             serial TEXT,
@@ -40,14 +24,8 @@ class Backend():
             status TEXT,
             PRIMARY KEY (name, serial)
         )
-
+        ''',
         '''
-        self.cur.execute(query)
-        self.db.commit()
-
-        query = 'DROP TABLE IF EXISTS ports'
-        self.cur.execute(query)
-        query = '''
         CREATE TABLE ports (
             name TEXT,
             controller_id TEXT,
@@ -55,25 +33,14 @@ class Backend():
             status INT,
             PRIMARY KEY (name, controller_id)
         )
-
+        ''',
         '''
-        self.cur.execute(query)
-        self.db.commit()
-
-        query = 'DROP TABLE IF EXISTS controllers'
-        self.cur.execute(query)
-        query = '''
         CREATE TABLE controllers (
             id TEXT PRIMARY KEY,
             slot INT
         )
+        ''',
         '''
-        self.cur.execute(query)
-        self.db.commit()
-
-        query = 'DROP TABLE IF EXISTS events'
-        self.cur.execute(query)
-        query = '''
         CREATE TABLE events (
             time INT,
             drive_serial TEXT,
@@ -81,23 +48,480 @@ class Backend():
             status INT,
             notification_sent INT
         )
+        ''',
         '''
-        self.cur.execute(query)
-        self.db.commit()
-
-        query = 'DROP TABLE IF EXISTS tickets'
-        self.cur.execute(query)
-        query = '''
         CREATE TABLE tickets (
             time INT,
             ticket_number TEXT PRIMARY KEY,
             drive_serial TEXT,
             status INT
         )
+        ''',
+    ],
+    # Version 2: proper column types and indexes for the lookups
+    [
+        'ALTER TABLE drives RENAME TO drives_v1',
+        '''
+        CREATE TABLE drives (
+            name TEXT,
+            serial TEXT,
+            last_update INTEGER,
+            model TEXT,
+            firmware TEXT,
+            capacity TEXT,
+            status TEXT,
+            PRIMARY KEY (name, serial)
+        )
+        ''',
+        'INSERT INTO drives SELECT * FROM drives_v1',
+        'DROP TABLE drives_v1',
+        'ALTER TABLE ports RENAME TO ports_v1',
+        '''
+        CREATE TABLE ports (
+            name TEXT,
+            controller_id TEXT,
+            drive_serial TEXT,
+            status TEXT,
+            PRIMARY KEY (name, controller_id)
+        )
+        ''',
+        'INSERT INTO ports SELECT * FROM ports_v1',
+        'DROP TABLE ports_v1',
+        'ALTER TABLE controllers RENAME TO controllers_v1',
+        '''
+        CREATE TABLE controllers (
+            id TEXT PRIMARY KEY,
+            slot TEXT
+        )
+        ''',
+        'INSERT INTO controllers SELECT * FROM controllers_v1',
+        'DROP TABLE controllers_v1',
+        'ALTER TABLE events RENAME TO events_v1',
+        '''
+        CREATE TABLE events (
+            time INTEGER,
+            drive_serial TEXT,
+            error TEXT,
+            status TEXT,
+            notification_sent INTEGER
+        )
+        ''',
+        'INSERT INTO events SELECT * FROM events_v1',
+        'DROP TABLE events_v1',
+        'ALTER TABLE tickets RENAME TO tickets_v1',
+        '''
+        CREATE TABLE tickets (
+            time INTEGER,
+            ticket_number TEXT PRIMARY KEY,
+            drive_serial TEXT,
+            status TEXT
+        )
+        ''',
+        'INSERT INTO tickets SELECT * FROM tickets_v1',
+        'DROP TABLE tickets_v1',
+        # get_drive
+        'CREATE INDEX drives_name_update ON drives (name, last_update)',
+        # get_controller_id
+        'CREATE INDEX ports_serial_status ON ports (drive_serial, status)',
+        # update_controller_id
+        'CREATE INDEX controllers_slot ON controllers (slot)',
+        # get_event by status and update_event
+        'CREATE INDEX events_serial_status_time '
+        'ON events (drive_serial, status, time)',
+        # get_event by time
+        'CREATE INDEX events_serial_time ON events (drive_serial, time)',
+        'CREATE INDEX tickets_serial ON tickets (drive_serial)',
+    ],
+    # Version 3: the outbox for the notifications waiting to be delivered
+    [
+        '''
+        CREATE TABLE outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            time INTEGER,
+            subject TEXT,
+            body TEXT,
+            drive_serial TEXT,
+            event_time INTEGER,
+            status TEXT,
+            attempts INTEGER DEFAULT 0,
+            next_attempt INTEGER,
+            claim TEXT,
+            last_error TEXT,
+            sent_time INTEGER
+        )
+        ''',
+        # get_notifications
+        'CREATE INDEX outbox_status_next ON outbox (status, next_attempt)',
+    ],
+    # Version 4: the failure rollups, kept up to date by add_drives,
+    # add_events and update_event so the reports never scan the history.
+    # The existing history is rolled up here; the install time of the old
+    # drives is the last time they have been updated, and the time to
+    # replace is measured up to the next drive added on the same device.
+    [
+        '''
+        CREATE TABLE failure_rollup (
+            model TEXT,
+            firmware TEXT,
+            slot TEXT,
+            drives INTEGER DEFAULT 0,
+            install_time INTEGER DEFAULT 0,
+            failures INTEGER DEFAULT 0,
+            failure_time INTEGER DEFAULT 0,
+            replacements INTEGER DEFAULT 0,
+            replace_time INTEGER DEFAULT 0,
+            PRIMARY KEY (model, firmware, slot)
+        )
+        ''',
+        '''
+        CREATE TABLE slot_rollup (
+            slot TEXT,
+            vdisk TEXT,
+            failures INTEGER DEFAULT 0,
+            last_failure INTEGER,
+            PRIMARY KEY (slot, vdisk)
+        )
+        ''',
+        '''
+        CREATE TEMP TABLE drive_groups AS
+        SELECT
+            IFNULL(d.model, '') AS model,
+            IFNULL(d.firmware, '') AS firmware,
+            IFNULL(c.slot, '') AS slot,
+            d.last_update AS install_time
+        FROM drives AS d
+        LEFT JOIN controllers AS c
+        ON c.id = substr(d.name, 2, instr(d.name, 'u') - 2)
+        ''',
+        '''
+        CREATE TEMP TABLE event_groups AS
+        SELECT
+            IFNULL(d.model, '') AS model,
+            IFNULL(d.firmware, '') AS firmware,
+            IFNULL(c.slot, '') AS slot,
+            substr(d.name, instr(d.name, 'u') + 1) AS vdisk,
+            e.time AS time,
+            e.status AS status,
+            (
+                SELECT MIN(r.last_update) FROM drives AS r
+                WHERE r.name = d.name
+                AND r.last_update > e.time
+            ) AS replaced
+        FROM events AS e
+        LEFT JOIN drives AS d
+        ON d.serial = e.drive_serial
+        AND d.last_update = (
+            SELECT MAX(last_update) FROM drives
+            WHERE serial = e.drive_serial
+        )
+        LEFT JOIN controllers AS c
+        ON c.id = substr(d.name, 2, instr(d.name, 'u') - 2)
+        ''',
+        '''
+        INSERT INTO failure_rollup
+        SELECT model, firmware, slot, SUM(drives), SUM(install_time),
+               SUM(failures), SUM(failure_time), SUM(replacements),
+               SUM(replace_time)
+        FROM (
+            SELECT model, firmware, slot, 1 AS drives, install_time,
+                   0 AS failures, 0 AS failure_time, 0 AS replacements,
+                   0 AS replace_time
+            FROM drive_groups
+            UNION ALL
+            SELECT model, firmware, slot, 0, 0, 1, time,
+                   status = 'closed' AND replaced IS NOT NULL,
+                   CASE WHEN status = 'closed' AND replaced IS NOT NULL
+                        THEN replaced - time ELSE 0 END
+            FROM event_groups
+        )
+        GROUP BY model, firmware, slot
+        ''',
+        '''
+        INSERT INTO slot_rollup
+        SELECT slot, vdisk, COUNT(*), MAX(time) FROM event_groups
+        WHERE vdisk IS NOT NULL
+        GROUP BY slot, vdisk
+        ''',
+        'DROP TABLE drive_groups',
+        'DROP TABLE event_groups',
+    ],
+    # Version 5: the summaries of the expired events and tickets, see
+    # expire_events
+    [
+        '''
+        CREATE TABLE drive_history (
+            drive_serial TEXT PRIMARY KEY,
+            events INTEGER DEFAULT 0,
+            first_event INTEGER,
+            last_event INTEGER,
+            last_error TEXT,
+            tickets INTEGER DEFAULT 0
+        )
+        ''',
+        # expire_events
+        'CREATE INDEX events_status_time ON events (status, time)',
+        # expire_tickets
+        'CREATE INDEX tickets_status_time ON tickets (status, time)',
+        # expire_notifications
+        'CREATE INDEX outbox_status_time ON outbox (status, time)',
+    ],
+    # Version 6: the notification plugins that delivered a notification
+    # already, comma separated, so a retry doesn't send it through them
+    # again
+    [
+        'ALTER TABLE outbox ADD COLUMN delivered TEXT',
+    ],
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# The columns the update methods can change, and the ones that identify the
+# rows to change. Format: {table: (columns, key columns)}
+UPDATES = {
+    'drives': (['last_update', 'model', 'firmware', 'capacity', 'status'],
+               ['name', 'serial']),
+    'ports': (['drive_serial', 'status'], ['name', 'controller_id']),
+    'events': (['error', 'status', 'notification_sent'],
+               ['time', 'drive_serial']),
+    'tickets': (['time', 'drive_serial', 'status'], ['ticket_number']),
+    'outbox': (['time', 'subject', 'body', 'drive_serial', 'event_time',
+                'status', 'attempts', 'next_attempt', 'claim', 'last_error',
+                'sent_time', 'delivered'], ['id']),
+}
+# The UPDATE statements built so far, by table and columns changed
+_update_queries = {}
+
+
+@timed_methods('backend', ['add_', 'delete_', 'expire_', 'get_', 'init_',
+                           'migrate_', 'update_', 'vacuum'])
+class Backend():
+    def __init__(self):
+        # Define the accepted statuses for the ports and drives
+        self.valid_port_status_list = ['active', 'error', 'disabled',
+                                       'unknown', 'foreign']
+        self.valid_drive_status_list = ['active', 'failed', 'missing',
+                                        'disabled', 'unknown']
+        self.conf = get_config('sqlite')
+        self.dbfile = self.conf['sqlite_db']
+        # How long to wait for a lock held by another process before giving up
+        self.busy_timeout = self.conf.get('sqlite_busy_timeout', 30)
+        # Every thread gets its own connection
+        self.local = threading.local()
+        # The schema version is checked when the first connection is opened.
+        # init_schema and migrate_schema skip the check, they bring the
+        # schema up to date.
+        self.schema_checked = False
+
+    @property
+    def db(self):
+        """
+        The connection for the current thread. It's opened on first use, in
+        WAL mode so readers and a writer don't block each other. The first
+        one checks that the db has the schema of this version.
+        """
+        try:
+            return self.local.db
+        except AttributeError:
+            db = sqlite3.connect(self.dbfile, timeout=self.busy_timeout)
+            db.row_factory = record_factory
+            db.execute('PRAGMA journal_mode = WAL')
+            self.local.db = db
+            # How many transaction() blocks this thread is in
+            self.local.transaction_depth = 0
+            if not self.schema_checked:
+                self.check_schema()
+            return db
+
+    def check_schema(self):
+        """
+        Make sure the db schema is the one this version works with, so an
+        outdated db fails with a clear message rather than on a missing table
+        or column.
+        """
+        current = self.get_schema_version()
+        if current != SCHEMA_VERSION:
+            self.close()
+            if current == 0:
+                raise Exception('The db %s is empty, run swift-drive init '
+                                'first' % self.dbfile)
+            if current < SCHEMA_VERSION:
+                raise Exception('The db schema (version %d) is outdated, run '
+                                'swift-drive migrate to upgrade it to '
+                                'version %d' % (current, SCHEMA_VERSION))
+            raise Exception('The db schema (version %d) is newer than the '
+                            'ones supported (up to %d)' % (current,
+                                                          SCHEMA_VERSION))
+        self.schema_checked = True
+
+    def close(self):
+        """
+        Close the connection for the current thread, if any.
+        """
+        db = getattr(self.local, 'db', None)
+        if db is not None:
+            db.close()
+            del self.local.db
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group the writes in a single transaction, so they are committed (and
+        synced to disk) only once at the end of the block. Everything is
+        rolled back if the block raises an exception. Blocks can be nested,
+        only the outermost one commits.
+
+        Usage:
+            with backend.transaction():
+                backend.add_drive(...)
+                backend.add_event(...)
+        """
+        db = self.db
+        self.local.transaction_depth += 1
+        try:
+            yield self
+        except:
+            self.local.transaction_depth -= 1
+            if self.local.transaction_depth == 0:
+                db.rollback()
+            raise
+        self.local.transaction_depth -= 1
+        if self.local.transaction_depth == 0:
+            db.commit()
+
+    def commit(self):
+        """
+        Commit the pending writes, unless we are inside a transaction block.
+        """
+        db = self.db
+        if self.local.transaction_depth == 0:
+            db.commit()
+
+    def _update(self, table, key, values):
+        """
+        Change some columns of the rows of a table with a single statement.
+        The statement is built once for every combination of columns.
+
+        :param table: The table name, from UPDATES.
+        :param key: The values of the key columns, in the UPDATES order.
+        :param values: The new values, by column.
+        """
+        if not values:
+            return
+        columns = tuple(sorted(values))
+        query = _update_queries.get((table, columns))
+        if query is None:
+            allowed, key_columns = UPDATES[table]
+            for column in columns:
+                if column not in allowed:
+                    raise Exception('Invalid %s field: %s' % (table, column))
+            query = 'UPDATE %s SET %s WHERE %s' % (
+                table, ', '.join(['%s = ?' % a for a in columns]),
+                ' AND '.join(['%s = ?' % a for a in key_columns]))
+            _update_queries[(table, columns)] = query
+        self.db.execute(query, tuple([values[a] for a in columns]) + key)
+        self.commit()
 
+    def init_schema(self):
+        """
+        Initialise the SQLite db schema.
+        WARNING: it will wipe out all the existing data!
+        """
+        self.schema_checked = True
+        cur = self.db.cursor()
+        query = '''
+        SELECT name FROM sqlite_master
+        WHERE type = 'table'
+        AND name NOT LIKE 'sqlite_%'
         '''
-        self.cur.execute(query)
+        cur.execute(query)
+        for table in cur.fetchall():
+            cur.execute('DROP TABLE %s' % table['name'])
+        cur.execute('PRAGMA user_version = 0')
         self.db.commit()
+        self.migrate_schema()
+        # The db is empty, so rewriting it is quick
+        self.full_vacuum()
+
+    def get_schema_version(self):
+        """
+        Returns the version of the schema. Databases created before the
+        schema was versioned are at version 1.
+
+        :returns: The schema version, 0 if the db is empty.
+        """
+        cur = self.db.cursor()
+        cur.execute('PRAGMA user_version')
+        version = cur.fetchone()['user_version']
+        if version == 0:
+            query = '''
+            SELECT name FROM sqlite_master
+            WHERE type = 'table'
+            AND name = 'drives'
+            '''
+            cur.execute(query)
+            if cur.fetchone():
+                version = 1
+        return version
+
+    def migrate_schema(self):
+        """
+        Upgrade the schema in place to the latest version, keeping the data.
+        Every migration runs in its own transaction, so a failure leaves the
+        db at the last version successfully applied.
+
+        :returns: A tuple with the schema version before and after the
+                  upgrade.
+        """
+        self.schema_checked = True
+        current = self.get_schema_version()
+        if current > SCHEMA_VERSION:
+            raise Exception('The db schema (version %d) is newer than the '
+                            'ones supported (up to %d)' % (current,
+                                                          SCHEMA_VERSION))
+        # The sqlite module commits before any statement which isn't DML, so
+        # we take care of the transactions for the schema changes ourselves
+        cur = self.db.cursor()
+        isolation_level = self.db.isolation_level
+        self.db.isolation_level = None
+        try:
+            for version in range(current, SCHEMA_VERSION):
+                cur.execute('BEGIN')
+                try:
+                    for query in MIGRATIONS[version]:
+                        cur.execute(query)
+                    cur.execute('PRAGMA user_version = %d' %
+                                     (version + 1))
+                except:
+                    cur.execute('ROLLBACK')
+                    raise
+                cur.execute('COMMIT')
+        finally:
+            self.db.isolation_level = isolation_level
+        return current, SCHEMA_VERSION
+
+    def needs_full_vacuum(self):
+        """
+        Returns True if the incremental vacuum isn't on yet. Until then,
+        vacuum can't give any space back; full_vacuum turns it on.
+        """
+        cur = self.db.execute('PRAGMA auto_vacuum')
+        return cur.fetchone()['auto_vacuum'] != 2
+
+    def full_vacuum(self):
+        """
+        Rewrite the whole db, turning on the incremental vacuum, so the
+        space freed by the expired rows can be given back a little at a time
+        by vacuum afterwards.
+        WARNING: the db is locked until it's done, which takes a while on a
+        big db. The other processes wait up to sqlite_busy_timeout for it.
+        """
+        # VACUUM can't run inside a transaction
+        isolation_level = self.db.isolation_level
+        self.db.isolation_level = None
+        try:
+            self.db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            self.db.execute('VACUUM')
+        finally:
+            self.db.isolation_level = isolation_level
 
     # Drive related methods
 
@@ -115,8 +539,21 @@ class Backend():
         :param status: The status of the drive. Accepted values: 'online',
                        'failed', 'missing', 'disabled' and 'unknown'.
         """
-        if status not in self.valid_drive_status_list:
-            raise Exception('Invalid drive status')
+        self.add_drives([(name, serial, last_update, model, firmware,
+                          capacity, status)])
+
+    def add_drives(self, drives):
+        """
+        Adds many drives to the drives table in a single transaction.
+
+        :param drives: An iterable of tuples with the same values accepted by
+                       add_drive. Format: (name, serial, last_update, model,
+                       firmware, capacity, status)
+        """
+        drives = list(drives)
+        for drive in drives:
+            if drive[6] not in self.valid_drive_status_list:
+                raise Exception('Invalid drive status')
         query = '''
         INSERT INTO drives (
             name,
@@ -129,9 +566,16 @@ class Backend():
         ) VALUES(?, ?, ?, ?, ?, ?, ?)
 
         '''
-        self.cur.execute(query, (name, serial, last_update, model,
-                                 firmware, capacity, status))
-        self.db.commit()
+        self.db.executemany(query, drives)
+        # The slots of all the controllers are looked up at once, rather than
+        # once per drive
+        slots = dict([(a['id'], a['slot']) for a in
+                      self.db.execute('SELECT id, slot FROM controllers')])
+        for drive in drives:
+            slot = self.get_device_slot(drive[0], slots)[0]
+            self._update_failure_rollup(drive[3], drive[4], slot, drives=1,
+                                        install_time=drive[2])
+        self.commit()
 
     def delete_drive(self, name, serial):
         """
@@ -145,24 +589,23 @@ class Backend():
 
         """
         query = 'DELETE FROM drives WHERE name = ? and serial = ?'
-        self.cur.execute(query, (name, serial))
-        self.db.commit()
+        self.db.execute(query, (name, serial))
+        self.commit()
 
     def update_drive(self, name, serial, **kwargs):
         """
         Updates drives information.
 
-        :param name: The time when the drive is being added.
-        :param serial: The drive serial number. Accepted values: 'online',
+        :param name: The device name.
+        :param serial: The drive serial number.
+        :param kwargs: The new values: last_update, model, firmware, capacity
+                       and status. Accepted status values: 'active',
                        'failed', 'missing', 'disabled' and 'unknown'.
         """
-        for field, value in kwargs.items():
-            if field == 'status' and field not in self.valid_drive_status_list:
-                raise Exception('Invalid drive status')
-            query = 'UPDATE drives SET %s = ? where name = ? and serial = ?' %\
-                    field
-            self.cur.execute(query, (field, name, serial))
-            self.db.commit()
+        if 'status' in kwargs and \
+                kwargs['status'] not in self.valid_drive_status_list:
+            raise Exception('Invalid drive status')
+        self._update('drives', (name, serial), kwargs)
 
     def get_drive(self, name):
         """
@@ -170,15 +613,48 @@ class Backend():
         This looks for the most updated entry.
 
         :param name: The device name.
-        :returns: A dictionary with the information.
+        :returns: The Drive, or None.
         """
         query = 'SELECT * FROM drives WHERE name = ? ORDER BY last_update DESC'
-        self.cur.execute(query, (name, ))
-        drive = self.cur.fetchone()
+        cur = self.db.execute(query, (name, ))
+        drive = cur.fetchone()
         if not drive:
             return None
         return drive
 
+    def get_drives(self):
+        """
+        Extract the information for all the drives, looking for the most
+        updated entry of each device.
+
+        :returns: A dictionary with the device names as keys and the Drives
+                  as values.
+        """
+        query = '''
+        SELECT * FROM drives AS d
+        WHERE last_update = (
+            SELECT MAX(last_update) FROM drives
+            WHERE name = d.name
+        )
+        '''
+        cur = self.db.execute(query)
+        return dict([(drive['name'], drive) for drive in cur.fetchall()])
+
+    def get_drive_by_serial(self, serial):
+        """
+        Extract drive information using the serial number.
+        This looks for the most updated entry.
+
+        :param serial: The drive serial number.
+        :returns: The Drive, or None.
+        """
+        query = '''
+        SELECT * FROM drives WHERE serial = ?
+        ORDER BY last_update DESC
+        '''
+        cur = self.db.execute(query, (serial, ))
+        return cur.fetchone()
+
     # port related methods
 
     def add_port(self, name, controller_id, drive_serial, status):
@@ -193,8 +669,20 @@ class Backend():
         :param status: The status of the port. Accepted values: active, error
                        or unknown.
         """
-        if status not in self.valid_port_status_list:
-            raise Exception('Invalid port status')
+        self.add_ports([(name, controller_id, drive_serial, status)])
+
+    def add_ports(self, ports):
+        """
+        Adds many ports to the ports table in a single transaction.
+
+        :param ports: An iterable of tuples with the same values accepted by
+                      add_port. Format: (name, controller_id, drive_serial,
+                      status)
+        """
+        ports = list(ports)
+        for port in ports:
+            if port[3] not in self.valid_port_status_list:
+                raise Exception('Invalid port status')
         query = '''
         INSERT INTO ports (
             name,
@@ -203,8 +691,8 @@ class Backend():
             status
         ) VALUES (?, ?, ?, ?)
         '''
-        self.cur.execute(query, (name, controller_id, drive_serial, status))
-        self.db.commit()
+        self.db.executemany(query, ports)
+        self.commit()
 
     def delete_port(self, name, controller_id):
         """
@@ -215,8 +703,8 @@ class Backend():
                               attached.
         """
         query = 'DELETE FROM ports WHERE name = ? and controller_id = ?'
-        self.cur.execute(query, (name, controller_id))
-        self.db.commit()
+        self.db.execute(query, (name, controller_id))
+        self.commit()
 
     def update_port(self, name, controller_id, **kwargs):
         """
@@ -225,17 +713,12 @@ class Backend():
         :param name: The port name.
         :param controller_id: The id of the controller where the port is
                               attached.
+        :param kwargs: The new values: drive_serial and status.
         """
-        for field, value in kwargs.items():
-            if field == 'status' and field not in self.valid_port_status_list:
-                raise Exception('Invalid port status')
-            query = '''
-            UPDATE ports SET %s = ?
-            WHERE name = ?
-            AND controller_id = ?
-            ''' % field
-            self.cur.execute(query, (value, name, controller_id))
-            self.db.commit()
+        if 'status' in kwargs and \
+                kwargs['status'] not in self.valid_port_status_list:
+            raise Exception('Invalid port status')
+        self._update('ports', (name, controller_id), kwargs)
 
     def get_port(self, name, controller_id):
         """
@@ -244,13 +727,33 @@ class Backend():
         :param name: The port name.
         :param controller_id: The id of the controller where the port is
                               attached.
-        :returns: A dictionary with the information.
+        :returns: The Port, or None.
         """
         query = 'SELECT * FROM ports WHERE name = ? and controller_id = ?'
-        self.cur.execute(query, (name, controller_id))
-        res = self.cur.fetchone()
+        cur = self.db.execute(query, (name, controller_id))
+        res = cur.fetchone()
         return res
 
+    def get_ports(self):
+        """
+        Extract the information for all the ports.
+
+        :returns: A list of Ports.
+        """
+        cur = self.db.execute('SELECT * FROM ports')
+        return cur.fetchall()
+
+    def get_port_by_serial(self, drive_serial):
+        """
+        Extract the information for the port where a drive is attached.
+
+        :param drive_serial: The drive serial number.
+        :returns: The Port, or None.
+        """
+        query = 'SELECT * FROM ports WHERE drive_serial = ?'
+        cur = self.db.execute(query, (drive_serial, ))
+        return cur.fetchone()
+
     # Controller related methods
 
     def add_controller(self, controller_id, slot):
@@ -260,14 +763,25 @@ class Backend():
         :param controller_id: The id of the controller.
         :param slot: The PCI slot where the controller is connected.
         """
+        self.add_controllers([(controller_id, slot)])
+
+    def add_controllers(self, controllers):
+        """
+        Adds many controllers to the controllers table in a single
+        transaction.
+
+        :param controllers: An iterable of tuples with the same values
+                            accepted by add_controller. Format:
+                            (controller_id, slot)
+        """
         query = '''
         INSERT INTO controllers (
             id,
             slot
         ) VALUES (?, ?)
         '''
-        self.cur.execute(query, (controller_id, slot))
-        self.db.commit()
+        self.db.executemany(query, controllers)
+        self.commit()
 
     def delete_controller(self, controller_id):
         """
@@ -276,8 +790,8 @@ class Backend():
         :param controller_id: The id of the controller.
         """
         query = 'DELETE FROM controllers WHERE id = ?'
-        self.cur.execute(query, (controller_id,))
-        self.db.commit()
+        self.db.execute(query, (controller_id,))
+        self.commit()
 
     def update_controller_id(self, slot, controller_id):
         """
@@ -288,8 +802,17 @@ class Backend():
         :param controller_id: The new id of the controller.
         """
         query = 'UPDATE controllers SET id = ? WHERE slot = ?'
-        self.cur.execute(query, (controller_id, slot))
-        self.db.commit()
+        self.db.execute(query, (controller_id, slot))
+        self.commit()
+
+    def get_controllers(self):
+        """
+        Extract the information for all the controllers.
+
+        :returns: A dictionary with the id and PCI slot.
+        """
+        cur = self.db.execute('SELECT * FROM controllers')
+        return dict([(c['id'], c['slot']) for c in cur.fetchall()])
 
     def get_controller_slot(self, controller_id):
         """
@@ -299,12 +822,31 @@ class Backend():
         :returns: the slot number for the controller
         """
         query = 'SELECT slot FROM controllers WHERE id = ?'
-        self.cur.execute(query, (controller_id,))
+        cur = self.db.execute(query, (controller_id,))
         try:
-            return self.cur.fetchone()['port']
+            return cur.fetchone()['slot']
         except:
             return None
 
+    def get_device_slot(self, name, slots=None):
+        """
+        Returns where a device is, in a way that doesn't change when the
+        controller ids do.
+
+        :param name: The device name.
+        :param slots: The PCI slots of the controllers, by id. If not given,
+                      the slot is looked up in the db.
+        :returns: A tuple with the PCI slot of the controller and the vdisk
+                  id. Empty strings for what is unknown.
+        """
+        try:
+            controller_id, vdisk_id = name.strip('c').split('u')
+        except (AttributeError, ValueError):
+            return '', ''
+        if slots is not None:
+            return slots.get(controller_id) or '', vdisk_id
+        return self.get_controller_slot(controller_id) or '', vdisk_id
+
     def get_controller_id(self, drive_serial):
         """
         Get the controller id for a given drive serial.
@@ -317,12 +859,24 @@ class Backend():
         WHERE drive_serial = ?
         AND status = 'active'
         '''
-        self.cur.execute(query, (drive_serial, ))
+        cur = self.db.execute(query, (drive_serial, ))
         try:
-            return self.cur.fetchone()['controller_id']
+            return cur.fetchone()['controller_id']
         except:
             return None
 
+    def get_inventory(self):
+        """
+        Extract the drives, the ports and the controllers at once, for the
+        commands that look up many of them.
+
+        :returns: An Inventory with the most updated entry of each device,
+                  all the ports and all the controllers.
+        """
+        cur = self.db.execute('SELECT * FROM controllers')
+        return Inventory(self.get_drives().values(), self.get_ports(),
+                         cur.fetchall())
+
     # Event related methods
 
     def add_event(self, time, drive_serial, error, status, notification_sent):
@@ -338,8 +892,21 @@ class Backend():
                                   sent.
 
         """
-        if notification_sent not in [0, 1]:
-            raise Exception('Invalid notification_sent status')
+        self.add_events([(time, drive_serial, error, status,
+                          notification_sent)])
+
+    def add_events(self, events):
+        """
+        Adds many events to the events table in a single transaction.
+
+        :param events: An iterable of tuples with the same values accepted by
+                       add_event. Format: (time, drive_serial, error, status,
+                       notification_sent)
+        """
+        events = list(events)
+        for event in events:
+            if event[4] not in [0, 1]:
+                raise Exception('Invalid notification_sent status')
         query = '''
         INSERT INTO events (
             time,
@@ -349,9 +916,15 @@ class Backend():
             notification_sent
         ) VALUES (?, ?, ?, ?, ?)
         '''
-        self.cur.execute(query, (time, drive_serial, error,
-                                 status, notification_sent))
-        self.db.commit()
+        self.db.executemany(query, events)
+        # Every event is a failure
+        for event in events:
+            model, firmware, slot, vdisk = self._get_failure_group(event[1])
+            self._update_failure_rollup(model, firmware, slot, failures=1,
+                                        failure_time=event[0])
+            if vdisk:
+                self._update_slot_rollup(slot, vdisk, event[0])
+        self.commit()
 
     def delete_event(self):
         """
@@ -365,17 +938,30 @@ class Backend():
 
         :param time: The time when the event happened.
         :param drive_serial: The drive's serial number.
+        :param kwargs: The new values: error, status and notification_sent.
         """
-        for field, value in kwargs.items():
-            if field == 'notification_sent' and value not in [0, 1]:
-                raise Exception('Invalid notification_sent status')
-            query = '''
-            UPDATE events SET %s = ?
-            WHERE time = ?
-            AND drive_serial = ?
-            ''' % field
-            self.cur.execute(query, (value, time, drive_serial))
-            self.db.commit()
+        if 'notification_sent' in kwargs and \
+                kwargs['notification_sent'] not in [0, 1]:
+            raise Exception('Invalid notification_sent status')
+        with self.transaction():
+            if kwargs.get('status') == 'closed':
+                # The drive has been replaced
+                query = '''
+                SELECT time FROM events
+                WHERE time = ?
+                AND drive_serial = ?
+                AND status != 'closed'
+                '''
+                cur = self.db.execute(query, (time, drive_serial))
+                events = cur.fetchall()
+                if events:
+                    now = int(current_time())
+                    model, firmware, slot = \
+                        self._get_failure_group(drive_serial)[:3]
+                    self._update_failure_rollup(
+                        model, firmware, slot, replacements=len(events),
+                        replace_time=sum([now - a['time'] for a in events]))
+            self._update('events', (time, drive_serial), kwargs)
 
     def get_event(self, drive_serial, **kwargs):
         """
@@ -384,7 +970,7 @@ class Backend():
         for the search.
 
         :param drive_serial: The drive's serial number.
-        :returns: A list of dictionaries containing the information.
+        :returns: A list of Events.
         """
         query = 'SELECT * FROM events WHERE drive_serial = ?'
         values = [drive_serial]
@@ -394,10 +980,188 @@ class Backend():
             else:
                 query += ' AND %s = ?' % field
             values.append(value)
-        self.cur.execute(query, tuple(values))
-        res = self.cur.fetchall()
+        cur = self.db.execute(query, tuple(values))
+        res = cur.fetchall()
         return res
 
+    def get_events(self, status):
+        """
+        Extract the events with a given status, oldest first.
+
+        :param status: The event status.
+        :returns: A list of Events.
+        """
+        query = 'SELECT * FROM events WHERE status = ? ORDER BY time'
+        cur = self.db.execute(query, (status, ))
+        return cur.fetchall()
+
+    # Failure analytics related methods
+
+    def _get_failure_group(self, drive_serial):
+        """
+        Find the rollup rows a failure of a drive belongs to.
+
+        :param drive_serial: The drive serial number.
+        :returns: A tuple (model, firmware, slot, vdisk). Empty strings for
+                  what is unknown.
+        """
+        drive = self.get_drive_by_serial(drive_serial)
+        if drive is None:
+            return '', '', '', ''
+        slot, vdisk = self.get_device_slot(drive['name'])
+        return drive['model'] or '', drive['firmware'] or '', slot, vdisk
+
+    def _update_failure_rollup(self, model, firmware, slot, **increments):
+        """
+        Add some values to the counters of a row of the failure rollup.
+
+        :param model: The drive model.
+        :param firmware: The drive firmware version.
+        :param slot: The PCI slot of the controller.
+        :param increments: The values to add, by counter.
+        """
+        key = (model or '', firmware or '', slot or '')
+        query = '''
+        INSERT OR IGNORE INTO failure_rollup (model, firmware, slot)
+        VALUES (?, ?, ?)
+        '''
+        self.db.execute(query, key)
+        counters = sorted(increments)
+        query = '''
+        UPDATE failure_rollup SET %s
+        WHERE model = ?
+        AND firmware = ?
+        AND slot = ?
+        ''' % ', '.join(['%s = %s + ?' % (a, a) for a in counters])
+        self.db.execute(query, tuple([increments[a] for a in counters]) + key)
+
+    def _update_slot_rollup(self, slot, vdisk, time):
+        """
+        Count a failure on a device of a controller.
+
+        :param slot: The PCI slot of the controller.
+        :param vdisk: The vdisk id.
+        :param time: The time of the failure.
+        """
+        query = '''
+        INSERT OR IGNORE INTO slot_rollup (slot, vdisk, last_failure)
+        VALUES (?, ?, ?)
+        '''
+        self.db.execute(query, (slot, vdisk, time))
+        query = '''
+        UPDATE slot_rollup
+        SET failures = failures + 1, last_failure = MAX(last_failure, ?)
+        WHERE slot = ?
+        AND vdisk = ?
+        '''
+        self.db.execute(query, (time, slot, vdisk))
+
+    def get_failure_rollup(self):
+        """
+        Extract the failure counters, by drive model, firmware version and
+        controller slot. They are kept up to date as the drives and events
+        are added, so this never scans the history.
+
+        :returns: A list of dictionaries with the model, firmware, slot,
+                  drives (how many have been installed), install_time (the
+                  sum of their install times), failures, failure_time (the
+                  sum of the failure times), replacements and replace_time
+                  (the sum of the times to replace).
+        """
+        cur = self.db.execute('SELECT * FROM failure_rollup')
+        return cur.fetchall()
+
+    def get_repeat_offenders(self, min_failures=2):
+        """
+        Extract the devices that failed again and again, most failures
+        first.
+
+        :param min_failures: How many failures make a repeat offender.
+        :returns: A list of dictionaries with the slot of the controller, the
+                  vdisk id, the failures and the time of the last failure.
+        """
+        query = '''
+        SELECT * FROM slot_rollup
+        WHERE failures >= ?
+        ORDER BY failures DESC, last_failure DESC
+        '''
+        cur = self.db.execute(query, (min_failures, ))
+        return cur.fetchall()
+
+    # Outbox related methods
+
+    def add_notification(self, time, subject, body, drive_serial=None,
+                         event_time=None):
+        """
+        Queue a notification in the outbox. Called in the same transaction
+        as the changes it's about, it's never lost nor sent for changes that
+        have been rolled back.
+
+        :param time: The time when the notification is raised.
+        :param subject: The notification subject.
+        :param body: The notification body.
+        :param drive_serial: The drive serial number, if the notification is
+                             about an event.
+        :param event_time: The time of the event, if any. The event is marked
+                           as notified once the notification is sent.
+        """
+        query = '''
+        INSERT INTO outbox (
+            time,
+            subject,
+            body,
+            drive_serial,
+            event_time,
+            status,
+            next_attempt
+        ) VALUES (?, ?, ?, ?, ?, 'pending', ?)
+        '''
+        self.db.execute(query, (time, subject, body, drive_serial, event_time,
+                                time))
+        self.commit()
+
+    def get_notifications(self, time, claim, lease, limit=100):
+        """
+        Claim the pending notifications due for delivery. They are claimed
+        with a single statement, so many processes can deliver at the same
+        time without sending a notification twice. The claimed notifications
+        are due again after the lease, in case the delivery never completes.
+
+        :param time: The current time.
+        :param claim: A token that identifies the caller.
+        :param lease: How many seconds the notifications are claimed for.
+        :param limit: How many notifications to claim at most.
+        :returns: A list of dictionaries containing the notifications,
+                  oldest first.
+        """
+        query = '''
+        UPDATE outbox SET claim = ?, next_attempt = ?
+        WHERE id IN (
+            SELECT id FROM outbox
+            WHERE status = 'pending'
+            AND next_attempt <= ?
+            ORDER BY id
+            LIMIT ?
+        )
+        '''
+        self.db.execute(query, (claim, time + lease, time, limit))
+        self.commit()
+        query = 'SELECT * FROM outbox WHERE claim = ? ORDER BY id'
+        cur = self.db.execute(query, (claim, ))
+        return cur.fetchall()
+
+    def update_notification(self, notification_id, **kwargs):
+        """
+        Updates information for a notification in the outbox.
+
+        :param notification_id: The notification id.
+        :param kwargs: The new values, by column of the outbox.
+        """
+        if 'status' in kwargs and \
+                kwargs['status'] not in ['pending', 'sent', 'failed']:
+            raise Exception('Invalid notification status')
+        self._update('outbox', (notification_id, ), kwargs)
+
     # Ticket related methods
 
     def add_ticket(self, time, ticket_number, drive_serial, status):
@@ -418,8 +1182,8 @@ class Backend():
             status
         ) VALUES (?, ?, ?, ?)
         '''
-        self.cur.execute(query, (time, ticket_number, drive_serial, status))
-        self.db.commit()
+        self.db.execute(query, (time, ticket_number, drive_serial, status))
+        self.commit()
 
     def delete_ticket(self):
         """
@@ -431,16 +1195,10 @@ class Backend():
         """
         Updates information for an existing ticket.
 
-        :param time: The time when the event happened.
         :param ticket_number: The ticket number.
+        :param kwargs: The new values: time, drive_serial and status.
         """
-        for field, value in kwargs.items():
-            query = '''
-            UPDATE tickets SET %s = ?
-            WHERE ticket_number = ?
-            ''' % field
-            self.cur.execute(query, (value, ticket_number))
-            self.db.commit()
+        self._update('tickets', (ticket_number, ), kwargs)
 
     def get_ticket(self, ticket_number):
         """
@@ -450,6 +1208,131 @@ class Backend():
         :returns: A dictionary with the information.
         """
         query = 'SELECT * FROM tickets WHERE ticket_number = ?'
-        self.cur.execute(query, (ticket_number,))
-        res = self.cur.fetchone()
+        cur = self.db.execute(query, (ticket_number,))
+        res = cur.fetchone()
         return res
+
+    # Retention related methods
+
+    def expire_events(self, before, limit=500):
+        """
+        Delete some of the closed events older than a given time. Every drive
+        keeps a summary of its expired events in the drive_history table, and
+        the failure rollups are not affected. The rows are deleted in small
+        transactions, so a removal in progress never waits for long: call
+        this again until it returns 0.
+
+        :param before: The time the events must be older than.
+        :param limit: How many events to delete at most.
+        :returns: How many events have been deleted.
+        """
+        query = '''
+        SELECT rowid, time, drive_serial, error FROM events
+        WHERE status = 'closed'
+        AND time < ?
+        ORDER BY time
+        LIMIT ?
+        '''
+        with self.transaction():
+            events = self.db.execute(query, (before, limit)).fetchall()
+            for event in events:
+                self._add_drive_history(event['drive_serial'])
+                query = '''
+                UPDATE drive_history SET
+                    events = events + 1,
+                    first_event = MIN(IFNULL(first_event, ?), ?),
+                    last_error = CASE WHEN last_event IS NULL
+                                      OR last_event <= ?
+                                      THEN ? ELSE last_error END,
+                    last_event = MAX(IFNULL(last_event, ?), ?)
+                WHERE drive_serial = ?
+                '''
+                self.db.execute(query, (event['time'], event['time'],
+                                        event['time'], event['error'],
+                                        event['time'], event['time'],
+                                        event['drive_serial']))
+            self.db.executemany('DELETE FROM events WHERE rowid = ?',
+                                [(a['rowid'], ) for a in events])
+        return len(events)
+
+    def expire_tickets(self, before, limit=500):
+        """
+        Delete some of the closed tickets older than a given time, counting
+        them in the drive_history table. Like expire_events, call this again
+        until it returns 0.
+
+        :param before: The time the tickets must be older than.
+        :param limit: How many tickets to delete at most.
+        :returns: How many tickets have been deleted.
+        """
+        query = '''
+        SELECT rowid, drive_serial FROM tickets
+        WHERE status = 'closed'
+        AND time < ?
+        LIMIT ?
+        '''
+        with self.transaction():
+            tickets = self.db.execute(query, (before, limit)).fetchall()
+            for ticket in tickets:
+                self._add_drive_history(ticket['drive_serial'])
+                query = '''
+                UPDATE drive_history SET tickets = tickets + 1
+                WHERE drive_serial = ?
+                '''
+                self.db.execute(query, (ticket['drive_serial'], ))
+            self.db.executemany('DELETE FROM tickets WHERE rowid = ?',
+                                [(a['rowid'], ) for a in tickets])
+        return len(tickets)
+
+    def expire_notifications(self, before, limit=500):
+        """
+        Delete some of the notifications delivered (or given up on) before a
+        given time. Like expire_events, call this again until it returns 0.
+
+        :param before: The time the notifications must be older than.
+        :param limit: How many notifications to delete at most.
+        :returns: How many notifications have been deleted.
+        """
+        query = '''
+        DELETE FROM outbox WHERE id IN (
+            SELECT id FROM outbox
+            WHERE status IN ('sent', 'failed')
+            AND time < ?
+            LIMIT ?
+        )
+        '''
+        with self.transaction():
+            cur = self.db.execute(query, (before, limit))
+        return cur.rowcount
+
+    def _add_drive_history(self, drive_serial):
+        query = 'INSERT OR IGNORE INTO drive_history (drive_serial) VALUES (?)'
+        self.db.execute(query, (drive_serial, ))
+
+    def get_drive_history(self, drive_serial):
+        """
+        Extract the summary of the expired events and tickets of a drive.
+
+        :param drive_serial: The drive serial number.
+        :returns: A dictionary with the number of events, the time of the
+                  first and last one, the last error and the number of
+                  tickets. None if nothing expired for the drive.
+        """
+        query = 'SELECT * FROM drive_history WHERE drive_serial = ?'
+        cur = self.db.execute(query, (drive_serial, ))
+        return cur.fetchone()
+
+    def vacuum(self, pages=100):
+        """
+        Give back to the filesystem some of the space freed by the deleted
+        rows. Like expire_events, it's done a little at a time so the db is
+        never locked for long. Nothing is given back until the incremental
+        vacuum is on, see full_vacuum.
+
+        :param pages: How many free pages to give back at most.
+        :returns: How many free pages are left.
+        """
+        self.db.execute('PRAGMA incremental_vacuum(%d)' % pages).fetchall()
+        self.commit()
+        cur = self.db.execute('PRAGMA freelist_count')
+        return cur.fetchone()['freelist_count']
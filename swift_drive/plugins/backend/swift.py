@@ -1 +1,988 @@
-# Placeholder
\ No newline at end of file
+# This backend keeps the state of the node in a Swift container, so there is
+# no db server to run and the state of the whole cluster is in one place.
+#
+# The state of a node is in two objects, named after the node:
+# - <prefix>/inventory.jsonl.gz: the controllers, the ports and the drives;
+# - <prefix>/events.jsonl.gz: the events, the tickets and the outbox.
+# Both are gzipped JSON lines: a header with the format version and the
+# columns of every table, then a row per line, as a list of values.
+#
+# The state is kept in memory. It's read again with a conditional GET
+# (If-None-Match) at most every swift_cache_ttl seconds, so an unchanged
+# object costs a 304 and not a transfer. The changes are written at the end
+# of every transaction, only for the objects that changed, with a conditional
+# PUT: If-None-Match: * for a new object, If-Match otherwise. On a 412 the
+# objects are read again and the changes of the transaction applied on top of
+# them. Stock Swift ignores If-Match on PUT though, so two processes writing
+# the same object at the same time are last-writer-wins and one of the
+# changes is lost; the old versions are kept in swift_versions_container.
+# Only the processes of the node write its objects, which keeps this rare.
+#
+# Unlike the sqlite backend, this one has no reports (get_failure_rollup,
+# get_repeat_offenders), no retention policy (expire_*, vacuum) and no
+# summaries of the expired events (get_drive_history): the report and
+# maintenance commands refuse to run with it, and the daemon doesn't apply
+# the retention policy.
+import gzip
+import hashlib
+import httplib
+import random
+import socket
+import threading
+import urllib
+import urlparse
+from contextlib import contextmanager
+from cStringIO import StringIO
+from time import sleep, time as current_time
+from swift_drive.common.config import get_config
+from swift_drive.common.exceptions import ResponseError, SwiftError
+from swift_drive.common.inventory import Inventory, TABLES
+from swift_drive.common.metrics import metrics, timed_methods
+from swift_drive.common.utils import get_hostname
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+# The version of the format of the objects. Objects written with an older
+# version are rewritten by migrate_schema.
+FORMAT_VERSION = 1
+# The columns of every table, in the order they are written
+COLUMNS = {
+    'controllers': ['id', 'slot'],
+    'ports': ['name', 'controller_id', 'drive_serial', 'status'],
+    'drives': ['name', 'serial', 'last_update', 'model', 'firmware',
+               'capacity', 'status'],
+    'events': ['time', 'drive_serial', 'error', 'status',
+               'notification_sent'],
+    'tickets': ['time', 'ticket_number', 'drive_serial', 'status'],
+    'outbox': ['id', 'time', 'subject', 'body', 'drive_serial', 'event_time',
+               'status', 'attempts', 'next_attempt', 'claim', 'last_error',
+               'sent_time', 'delivered'],
+}
+# The tables in every object
+OBJECTS = {
+    'inventory': ['controllers', 'ports', 'drives'],
+    'events': ['events', 'tickets', 'outbox'],
+}
+
+
+def encode(tables, names):
+    """
+    Serialise some tables into the content of an object. The same tables
+    always give the same content, so they have the same ETag.
+
+    :param tables: The tables, as lists of dictionaries, by name.
+    :param names: The names of the tables to serialise.
+    :returns: The gzipped JSON lines.
+    """
+    buf = StringIO()
+    gz = gzip.GzipFile(fileobj=buf, mode='wb', mtime=0)
+    header = {'format': FORMAT_VERSION,
+              'columns': dict([(a, COLUMNS[a]) for a in names])}
+    gz.write(json.dumps(header, sort_keys=True) + '\n')
+    for name in names:
+        for row in tables[name]:
+            gz.write(json.dumps([name] + [row[a] for a in COLUMNS[name]]) +
+                     '\n')
+    gz.close()
+    return buf.getvalue()
+
+
+def decode(body, names):
+    """
+    Parse the content of an object. The columns missing from an object
+    written by an older version are None.
+
+    :param body: The gzipped JSON lines.
+    :param names: The names of the tables the object is expected to have.
+    :returns: A tuple with the format version and the tables, as lists of
+              dictionaries, by name.
+    """
+    try:
+        lines = gzip.GzipFile(fileobj=StringIO(body)).read().splitlines()
+        header = json.loads(lines[0])
+        columns = header['columns']
+        tables = dict([(a, []) for a in names])
+        for line in lines[1:]:
+            values = json.loads(line)
+            row = dict.fromkeys(COLUMNS[values[0]])
+            row.update(zip(columns[values[0]], values[1:]))
+            tables[values[0]].append(row)
+    except (IOError, ValueError, KeyError, IndexError), e:
+        raise SwiftError('Invalid object: %s' % e)
+    return header['format'], tables
+
+
+class SwiftClient(object):
+    """
+    A minimal client for the Swift API. It authenticates with the v1 auth
+    (swift_auth_url, swift_user and swift_key), unless a storage url and a
+    token are configured, and authenticates again when the token expires.
+    The connection is kept open between the requests. The failed requests
+    are retried with a jittered exponential backoff.
+    """
+    def __init__(self, config):
+        self.auth_url = config.get('swift_auth_url')
+        self.user = config.get('swift_user')
+        self.key = config.get('swift_key')
+        self.storage_url = config.get('swift_storage_url')
+        self.token = config.get('swift_auth_token')
+        self.timeout = config.get('swift_timeout', 10)
+        self.retries = config.get('swift_retries', 3)
+        self.backoff = config.get('swift_backoff', 0.5)
+        self.max_backoff = 10
+        self.connection = None
+
+    def connect(self, url):
+        parsed = urlparse.urlparse(url)
+        if parsed.scheme == 'https':
+            return httplib.HTTPSConnection(parsed.netloc,
+                                           timeout=self.timeout)
+        return httplib.HTTPConnection(parsed.netloc, timeout=self.timeout)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def authenticate(self):
+        """
+        Get a storage url and a token from the auth service.
+        """
+        if not self.auth_url:
+            raise SwiftError('No swift_auth_url configured to get a token')
+        connection = self.connect(self.auth_url)
+        try:
+            connection.request('GET', urlparse.urlparse(self.auth_url).path,
+                               headers={'X-Auth-User': self.user,
+                                        'X-Auth-Key': self.key})
+            response = connection.getresponse()
+            response.read()
+        except (httplib.HTTPException, socket.error), e:
+            raise SwiftError('Failed to authenticate: %s' % e)
+        finally:
+            connection.close()
+        if response.status // 100 != 2:
+            raise ResponseError(response.status, response.reason)
+        self.storage_url = response.getheader('x-storage-url')
+        self.token = response.getheader('x-auth-token')
+        self.close()
+
+    def request(self, method, path, body=None, headers=None):
+        """
+        Send a request to the storage url.
+
+        :param method: The HTTP method.
+        :param path: The path, relative to the storage url, eg. /container.
+        :param body: The request body.
+        :param headers: The request headers.
+        :returns: A tuple with the response status, headers (lowercase) and
+                  body.
+        """
+        headers = dict(headers or {})
+        error = None
+        authenticated = False
+        attempt = 0
+        while attempt <= self.retries:
+            if attempt > 0:
+                delay = min(self.max_backoff,
+                            self.backoff * 2 ** (attempt - 1))
+                sleep(random.uniform(0, delay))
+            attempt += 1
+            if not self.storage_url or not self.token:
+                self.authenticate()
+                authenticated = True
+            if self.connection is None:
+                self.connection = self.connect(self.storage_url)
+            headers['X-Auth-Token'] = self.token
+            start = current_time()
+            try:
+                self.connection.request(
+                    method, urlparse.urlparse(self.storage_url).path + path,
+                    body, headers)
+                response = self.connection.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, socket.error), e:
+                metrics.observe('swift_request', current_time() - start,
+                                method=method, status='error')
+                # The connection may have been closed by the server, we'll
+                # open a new one next time
+                self.close()
+                error = e
+                continue
+            metrics.observe('swift_request', current_time() - start,
+                            method=method, status=response.status)
+            if response.status == 401 and not authenticated and \
+                    self.auth_url:
+                # The token expired, get a new one. It's not a failure.
+                self.token = None
+                attempt -= 1
+                authenticated = True
+                continue
+            if response.status >= 500:
+                error = ResponseError(response.status, response.reason)
+                continue
+            return (response.status, dict(response.getheaders()), data)
+        raise SwiftError('%s %s failed after %d attempts: %s' %
+                         (method, path, self.retries + 1, error))
+
+
+@timed_methods('backend', ['add_', 'delete_', 'get_', 'init_', 'migrate_',
+                           'update_'])
+class Backend():
+    def __init__(self):
+        # Define the accepted statuses for the ports and drives
+        self.valid_port_status_list = ['active', 'error', 'disabled',
+                                       'unknown', 'foreign']
+        self.valid_drive_status_list = ['active', 'failed', 'missing',
+                                        'disabled', 'unknown']
+        self.conf = get_config('swift')
+        self.client = SwiftClient(self.conf)
+        self.container = self.conf.get('swift_container', 'swift-drive')
+        self.prefix = self.conf.get('swift_prefix') or get_hostname()
+        # Where Swift keeps the old versions of the objects, if anywhere
+        self.versions_container = self.conf.get('swift_versions_container')
+        # How long the state is used before checking if it changed
+        self.cache_ttl = self.conf.get('swift_cache_ttl', 5)
+        # The objects as last read or written: {name: (etag, body)}
+        self.objects = {}
+        self.tables = dict([(a, []) for a in COLUMNS])
+        self.loaded = None
+        # The changes of the transaction in progress, as functions that
+        # apply them to the tables
+        self.pending = []
+        # Only a thread at a time can use the state, a transaction keeps it
+        # until the end
+        self.lock = threading.RLock()
+        self.transaction_depth = 0
+
+    def object_path(self, name):
+        return '/%s/%s' % (urllib.quote(self.container),
+                           urllib.quote('%s/%s.jsonl.gz' % (self.prefix,
+                                                             name)))
+
+    def close(self):
+        """
+        Close the connection to Swift, if any.
+        """
+        with self.lock:
+            self.client.close()
+
+    def load(self, force=False):
+        """
+        Read the objects again, unless they have been read less than
+        cache_ttl seconds ago. The objects that didn't change cost a 304.
+
+        :param force: Check the objects even if they have been read recently.
+        """
+        if not force and self.loaded is not None and \
+                current_time() - self.loaded < self.cache_ttl:
+            return
+        for name in sorted(OBJECTS):
+            etag, body = self.objects.get(name, (None, None))
+            headers = {}
+            if etag is not None:
+                headers['If-None-Match'] = etag
+            status, headers, data = self.client.request(
+                'GET', self.object_path(name), headers=headers)
+            if status == 200:
+                self.objects[name] = (headers.get('etag', '').strip('"'),
+                                      data)
+            elif status == 404:
+                self.objects.pop(name, None)
+            elif status != 304:
+                raise ResponseError(status, 'Failed to read %s' % name)
+        self.tables = self.decode_objects()
+        self.loaded = current_time()
+
+    def decode_objects(self):
+        """
+        The tables, as in the objects last read or written.
+        """
+        tables = dict([(a, []) for a in COLUMNS])
+        for name in OBJECTS:
+            if name in self.objects:
+                tables.update(decode(self.objects[name][1],
+                                     OBJECTS[name])[1])
+        return tables
+
+    def save(self):
+        """
+        Write the objects that changed. If somebody else changed them in the
+        meantime, they are read again and the changes of the transaction are
+        applied again on top of them.
+        """
+        # The objects as they were before the transaction
+        base = dict(self.objects)
+        for attempt in range(self.client.retries + 1):
+            conflict = False
+            for name in sorted(OBJECTS):
+                body = encode(self.tables, OBJECTS[name])
+                etag = self.objects.get(name, (None, None))[0]
+                if etag == hashlib.md5(body).hexdigest():
+                    # Nothing changed
+                    continue
+                headers = {'Content-Type': 'application/x-ndjson'}
+                if etag is None:
+                    headers['If-None-Match'] = '*'
+                else:
+                    headers['If-Match'] = etag
+                status, response_headers, data = self.client.request(
+                    'PUT', self.object_path(name), body, headers)
+                if status == 404:
+                    # The first object of the container
+                    self.create_container()
+                    status, response_headers, data = self.client.request(
+                        'PUT', self.object_path(name), body, headers)
+                if status == 412:
+                    conflict = True
+                    continue
+                if status // 100 != 2:
+                    raise ResponseError(status, 'Failed to write %s' % name)
+                self.objects[name] = (
+                    response_headers.get('etag', '').strip('"'), body)
+            if not conflict:
+                self.pending = []
+                self.loaded = current_time()
+                return
+            # Apply the changes again to the new version of the objects that
+            # couldn't be written, and to the old version of the others so
+            # they come out as they have been written
+            written = dict([(a, self.objects[a]) for a in self.objects
+                            if self.objects[a] != base.get(a)])
+            self.load(force=True)
+            for name in written:
+                if name in base:
+                    self.objects[name] = base[name]
+                else:
+                    self.objects.pop(name, None)
+            self.tables = self.decode_objects()
+            for change in self.pending:
+                change(self.tables)
+            self.objects.update(written)
+        self.pending = []
+        self.load(force=True)
+        raise SwiftError('The state has been changed by somebody else %d '
+                         'times in a row' % (self.client.retries + 1))
+
+    def create_container(self):
+        headers = {}
+        if self.versions_container:
+            headers['X-Versions-Location'] = self.versions_container
+        status, headers, data = self.client.request(
+            'PUT', '/%s' % urllib.quote(self.container), headers=headers)
+        if status // 100 != 2:
+            raise ResponseError(status, 'Failed to create the container %s' %
+                                self.container)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group the writes in a single transaction, so the objects are written
+        only once at the end of the block. Everything is rolled back if the
+        block raises an exception. Blocks can be nested, only the outermost
+        one writes.
+
+        Usage:
+            with backend.transaction():
+                backend.add_drive(...)
+                backend.add_event(...)
+        """
+        with self.lock:
+            if self.transaction_depth == 0:
+                self.load()
+            self.transaction_depth += 1
+            try:
+                yield self
+            except:
+                self.transaction_depth -= 1
+                if self.transaction_depth == 0:
+                    self.pending = []
+                    self.tables = self.decode_objects()
+                raise
+            self.transaction_depth -= 1
+            if self.transaction_depth == 0:
+                try:
+                    self.save()
+                except:
+                    self.pending = []
+                    self.tables = self.decode_objects()
+                    raise
+
+    def change(self, function):
+        """
+        Make a change, in a transaction.
+
+        :param function: A function that applies the change to the tables
+                         it's given.
+        :returns: What the function returns.
+        """
+        with self.transaction():
+            result = function(self.tables)
+            self.pending.append(function)
+            return result
+
+    def select(self, table, **kwargs):
+        """
+        Extract the rows of a table with some values.
+
+        :param table: The table name.
+        :param kwargs: The values the rows must have.
+        :returns: A list with copies of the rows, as records for the tables
+                  that have them (see swift_drive.common.inventory).
+        """
+        record = TABLES.get(table, dict)
+        with self.lock:
+            if self.transaction_depth == 0:
+                self.load()
+            return [record(**a) for a in self.tables[table]
+                    if all([a[b] == kwargs[b] for b in kwargs])]
+
+    def init_schema(self):
+        """
+        Initialise the state.
+        WARNING: it will wipe out all the existing data!
+        """
+        def init(tables):
+            for name in tables:
+                tables[name][:] = []
+        # The missing objects are written too, empty
+        self.change(init)
+
+    def get_schema_version(self):
+        """
+        Returns the format version of the objects.
+
+        :returns: The format version, 0 if there are no objects.
+        """
+        with self.lock:
+            self.load(force=True)
+            versions = [decode(self.objects[a][1], OBJECTS[a])[0]
+                        for a in self.objects]
+            return min(versions or [0])
+
+    def migrate_schema(self):
+        """
+        Rewrite the objects in the latest format, keeping the data.
+
+        :returns: A tuple with the format version before and after the
+                  upgrade.
+        """
+        current = self.get_schema_version()
+        if current > FORMAT_VERSION:
+            raise Exception('The objects format (version %d) is newer than '
+                            'the ones supported (up to %d)' %
+                            (current, FORMAT_VERSION))
+        if current < FORMAT_VERSION:
+            # The objects are written again (or for the first time) in the
+            # new format, as nothing matches their ETag any more
+            with self.transaction():
+                pass
+        return current, FORMAT_VERSION
+
+    # Drive related methods
+
+    def add_drive(self, name, serial, last_update, model,
+                  firmware, capacity, status):
+        """
+        Adds a drive to the drives table.
+
+        :param name: The device name.
+        :param serial: The drive serial number.
+        :param last_update: The time when the drive is being added.
+        :param model: The drive model.
+        :param firmware: The drive firmware version.
+        :param capacity: The drive capacity.
+        :param status: The status of the drive. Accepted values: 'online',
+                       'failed', 'missing', 'disabled' and 'unknown'.
+        """
+        self.add_drives([(name, serial, last_update, model, firmware,
+                          capacity, status)])
+
+    def add_drives(self, drives):
+        """
+        Adds many drives to the drives table in a single transaction.
+
+        :param drives: An iterable of tuples with the same values accepted by
+                       add_drive. Format: (name, serial, last_update, model,
+                       firmware, capacity, status)
+        """
+        drives = list(drives)
+        for drive in drives:
+            if drive[6] not in self.valid_drive_status_list:
+                raise Exception('Invalid drive status')
+
+        def add(tables):
+            for drive in drives:
+                if [a for a in tables['drives']
+                        if (a['name'], a['serial']) == drive[:2]]:
+                    raise Exception('The drive %s %s already exists' %
+                                    drive[:2])
+                tables['drives'].append(dict(zip(COLUMNS['drives'], drive)))
+        self.change(add)
+
+    def delete_drive(self, name, serial):
+        """
+        Deletes a drive entry from the drives table.
+        This shouldn't be used normally as we're looking to keep track of
+        the device history, so we can even detect when a failed drive has been
+        recycled.
+
+        :param name: The device name.
+        :param serial: The drive serial number.
+        """
+        def delete(tables):
+            tables['drives'][:] = [a for a in tables['drives']
+                                   if (a['name'], a['serial']) !=
+                                   (name, serial)]
+        self.change(delete)
+
+    def update_drive(self, name, serial, **kwargs):
+        """
+        Updates drives information.
+
+        :param name: The device name.
+        :param serial: The drive serial number.
+        """
+        if 'status' in kwargs and \
+                kwargs['status'] not in self.valid_drive_status_list:
+            raise Exception('Invalid drive status')
+        self.update('drives', {'name': name, 'serial': serial}, kwargs)
+
+    def update(self, table, key, values):
+        """
+        Update the rows of a table with a given key.
+
+        :param table: The table name.
+        :param key: The values that identify the rows, by column.
+        :param values: The new values, by column.
+        """
+        for column in values:
+            if column not in COLUMNS[table]:
+                raise Exception('Invalid %s field: %s' % (table, column))
+
+        def update(tables):
+            for row in tables[table]:
+                if all([row[a] == key[a] for a in key]):
+                    row.update(values)
+        self.change(update)
+
+    def get_drive(self, name):
+        """
+        Extract drive information.
+        This looks for the most updated entry.
+
+        :param name: The device name.
+        :returns: The Drive, or None.
+        """
+        drives = self.select('drives', name=name)
+        if not drives:
+            return None
+        return max(drives, key=lambda a: a['last_update'])
+
+    def get_drives(self):
+        """
+        Extract the information for all the drives, looking for the most
+        updated entry of each device.
+
+        :returns: A dictionary with the device names as keys and the Drives
+                  as values.
+        """
+        drives = {}
+        for drive in sorted(self.select('drives'),
+                            key=lambda a: a['last_update']):
+            drives[drive['name']] = drive
+        return drives
+
+    def get_drive_by_serial(self, serial):
+        """
+        Extract drive information using the serial number.
+        This looks for the most updated entry.
+
+        :param serial: The drive serial number.
+        :returns: The Drive, or None.
+        """
+        drives = self.select('drives', serial=serial)
+        if not drives:
+            return None
+        return max(drives, key=lambda a: a['last_update'])
+
+    # port related methods
+
+    def add_port(self, name, controller_id, drive_serial, status):
+        """
+        Adds a port to the ports table.
+
+        :param name: The port name.
+        :param controller_id: The id of the controller where the port is
+                              attached.
+        :param drive_serial: The serial of the drive currently connected to
+                             the port.
+        :param status: The status of the port. Accepted values: active, error
+                       or unknown.
+        """
+        self.add_ports([(name, controller_id, drive_serial, status)])
+
+    def add_ports(self, ports):
+        """
+        Adds many ports to the ports table in a single transaction.
+
+        :param ports: An iterable of tuples with the same values accepted by
+                      add_port. Format: (name, controller_id, drive_serial,
+                      status)
+        """
+        ports = list(ports)
+        for port in ports:
+            if port[3] not in self.valid_port_status_list:
+                raise Exception('Invalid port status')
+
+        def add(tables):
+            for port in ports:
+                if [a for a in tables['ports']
+                        if (a['name'], a['controller_id']) == port[:2]]:
+                    raise Exception('The port %s on controller %s already '
+                                    'exists' % port[:2])
+                tables['ports'].append(dict(zip(COLUMNS['ports'], port)))
+        self.change(add)
+
+    def delete_port(self, name, controller_id):
+        """
+        Removes a port from the ports table.
+
+        :param name: The port name.
+        :param controller_id: The id of the controller where the port is
+                              attached.
+        """
+        def delete(tables):
+            tables['ports'][:] = [a for a in tables['ports']
+                                  if (a['name'], a['controller_id']) !=
+                                  (name, controller_id)]
+        self.change(delete)
+
+    def update_port(self, name, controller_id, **kwargs):
+        """
+        Updates information for a port.
+
+        :param name: The port name.
+        :param controller_id: The id of the controller where the port is
+                              attached.
+        """
+        if 'status' in kwargs and \
+                kwargs['status'] not in self.valid_port_status_list:
+            raise Exception('Invalid port status')
+        self.update('ports', {'name': name, 'controller_id': controller_id},
+                    kwargs)
+
+    def get_port(self, name, controller_id):
+        """
+        Extract port information.
+
+        :param name: The port name.
+        :param controller_id: The id of the controller where the port is
+                              attached.
+        :returns: The Port, or None.
+        """
+        ports = self.select('ports', name=name, controller_id=controller_id)
+        return ports[0] if ports else None
+
+    def get_ports(self):
+        """
+        Extract the information for all the ports.
+
+        :returns: A list of Ports.
+        """
+        return self.select('ports')
+
+    def get_port_by_serial(self, drive_serial):
+        """
+        Extract the information for the port where a drive is attached.
+
+        :param drive_serial: The drive serial number.
+        :returns: The Port, or None.
+        """
+        ports = self.select('ports', drive_serial=drive_serial)
+        return ports[0] if ports else None
+
+    # Controller related methods
+
+    def add_controller(self, controller_id, slot):
+        """
+        Adds a controller to the controllers table.
+
+        :param controller_id: The id of the controller.
+        :param slot: The PCI slot where the controller is connected.
+        """
+        self.add_controllers([(controller_id, slot)])
+
+    def add_controllers(self, controllers):
+        """
+        Adds many controllers to the controllers table in a single
+        transaction.
+
+        :param controllers: An iterable of tuples with the same values
+                            accepted by add_controller. Format:
+                            (controller_id, slot)
+        """
+        controllers = list(controllers)
+
+        def add(tables):
+            for controller_id, slot in controllers:
+                if [a for a in tables['controllers']
+                        if a['id'] == controller_id]:
+                    raise Exception('The controller %s already exists' %
+                                    controller_id)
+                tables['controllers'].append({'id': controller_id,
+                                              'slot': slot})
+        self.change(add)
+
+    def delete_controller(self, controller_id):
+        """
+        Removes a controller from the controllers table.
+
+        :param controller_id: The id of the controller.
+        """
+        def delete(tables):
+            tables['controllers'][:] = [a for a in tables['controllers']
+                                        if a['id'] != controller_id]
+        self.change(delete)
+
+    def update_controller_id(self, slot, controller_id):
+        """
+        Update the controller id. This is particularly useful with
+        LSI controllers as the id tends to change after every reboot.
+
+        :param slot: The PCI slot where the controller is connected.
+        :param controller_id: The new id of the controller.
+        """
+        self.update('controllers', {'slot': slot}, {'id': controller_id})
+
+    def get_controllers(self):
+        """
+        Extract the information for all the controllers.
+
+        :returns: A dictionary with the id and PCI slot.
+        """
+        return dict([(a['id'], a['slot'])
+                     for a in self.select('controllers')])
+
+    def get_controller_slot(self, controller_id):
+        """
+        Returns the PCI slot for the given controller id.
+
+        :param controller_id: the id of the controller
+        :returns: the slot number for the controller
+        """
+        controllers = self.select('controllers', id=controller_id)
+        return controllers[0]['slot'] if controllers else None
+
+    def get_controller_id(self, drive_serial):
+        """
+        Get the controller id for a given drive serial.
+
+        :param drive_serial: The serial number of the drive.
+        :returns: The controller id.
+        """
+        ports = self.select('ports', drive_serial=drive_serial,
+                            status='active')
+        return ports[0]['controller_id'] if ports else None
+
+    def get_inventory(self):
+        """
+        Extract the drives, the ports and the controllers at once, for the
+        commands that look up many of them.
+
+        :returns: An Inventory with the most updated entry of each device,
+                  all the ports and all the controllers.
+        """
+        with self.lock:
+            return Inventory(self.get_drives().values(), self.get_ports(),
+                             self.select('controllers'))
+
+    # Event related methods
+
+    def add_event(self, time, drive_serial, error, status, notification_sent):
+        """
+        Adds an event to the events table.
+
+        :param time: The time when the event happened.
+        :param drive_serial: The drive's serial number.
+        :param error: The error reported by the controller.
+        :param status: The event status. Could be new, inprogress, closed and
+                       error.
+        :param notification_sent: Should be 'yes' if a notification has been
+                                  sent.
+        """
+        self.add_events([(time, drive_serial, error, status,
+                          notification_sent)])
+
+    def add_events(self, events):
+        """
+        Adds many events to the events table in a single transaction.
+
+        :param events: An iterable of tuples with the same values accepted by
+                       add_event. Format: (time, drive_serial, error, status,
+                       notification_sent)
+        """
+        events = list(events)
+        for event in events:
+            if event[4] not in [0, 1]:
+                raise Exception('Invalid notification_sent status')
+
+        def add(tables):
+            tables['events'].extend([dict(zip(COLUMNS['events'], a))
+                                     for a in events])
+        self.change(add)
+
+    def delete_event(self):
+        """
+        Do you really need this?
+        """
+        pass
+
+    def update_event(self, time, drive_serial, **kwargs):
+        """
+        Updates information for an existing event.
+
+        :param time: The time when the event happened.
+        :param drive_serial: The drive's serial number.
+        """
+        if 'notification_sent' in kwargs and \
+                kwargs['notification_sent'] not in [0, 1]:
+            raise Exception('Invalid notification_sent status')
+        self.update('events', {'time': time, 'drive_serial': drive_serial},
+                    kwargs)
+
+    def get_event(self, drive_serial, **kwargs):
+        """
+        Extract event information.
+        NOTE: If the keyword time is present, it represents the starting time
+        for the search.
+
+        :param drive_serial: The drive's serial number.
+        :returns: A list of Events.
+        """
+        start = kwargs.pop('time', None)
+        return [a for a in self.select('events', drive_serial=drive_serial,
+                                       **kwargs)
+                if start is None or a['time'] > start]
+
+    def get_events(self, status):
+        """
+        Extract the events with a given status, oldest first.
+
+        :param status: The event status.
+        :returns: A list of Events.
+        """
+        return sorted(self.select('events', status=status),
+                      key=lambda a: a['time'])
+
+    # Outbox related methods
+
+    def add_notification(self, time, subject, body, drive_serial=None,
+                         event_time=None):
+        """
+        Queue a notification in the outbox. Called in the same transaction
+        as the changes it's about, it's never lost nor sent for changes that
+        have been rolled back.
+
+        :param time: The time when the notification is raised.
+        :param subject: The notification subject.
+        :param body: The notification body.
+        :param drive_serial: The drive serial number, if the notification is
+                             about an event.
+        :param event_time: The time of the event, if any. The event is marked
+                           as notified once the notification is sent.
+        """
+        def add(tables):
+            notification = dict.fromkeys(COLUMNS['outbox'])
+            notification.update({
+                'id': max([a['id'] for a in tables['outbox']] or [0]) + 1,
+                'time': time, 'subject': subject, 'body': body,
+                'drive_serial': drive_serial, 'event_time': event_time,
+                'status': 'pending', 'attempts': 0, 'next_attempt': time})
+            tables['outbox'].append(notification)
+        self.change(add)
+
+    def get_notifications(self, time, claim, lease, limit=100):
+        """
+        Claim the pending notifications due for delivery. The claimed
+        notifications are due again after the lease, in case the delivery
+        never completes.
+
+        :param time: The current time.
+        :param claim: A token that identifies the caller.
+        :param lease: How many seconds the notifications are claimed for.
+        :param limit: How many notifications to claim at most.
+        :returns: A list of dictionaries containing the notifications,
+                  oldest first.
+        """
+        def claim_due(tables):
+            due = sorted([a for a in tables['outbox']
+                          if a['status'] == 'pending' and
+                          a['next_attempt'] <= time],
+                         key=lambda a: a['id'])[:limit]
+            for a in due:
+                a['claim'] = claim
+                a['next_attempt'] = time + lease
+        self.change(claim_due)
+        return sorted(self.select('outbox', claim=claim),
+                      key=lambda a: a['id'])
+
+    def update_notification(self, notification_id, **kwargs):
+        """
+        Updates information for a notification in the outbox.
+
+        :param notification_id: The notification id.
+        """
+        if 'status' in kwargs and kwargs['status'] not in ['pending', 'sent',
+                                                           'failed']:
+            raise Exception('Invalid notification status')
+        self.update('outbox', {'id': notification_id}, kwargs)
+
+    # Ticket related methods
+
+    def add_ticket(self, time, ticket_number, drive_serial, status):
+        """
+        Adds a ticket to the tickets table.
+
+        :param time: The time when the event happened.
+        :param ticket_number: The ticket number.
+        :param drive_serial: The drive's serial number.
+        :param status: The event status. Could be new, inprogress, closed and
+                       error.
+        """
+        def add(tables):
+            if [a for a in tables['tickets']
+                    if a['ticket_number'] == ticket_number]:
+                raise Exception('The ticket %s already exists' %
+                                ticket_number)
+            tables['tickets'].append({'time': time,
+                                      'ticket_number': ticket_number,
+                                      'drive_serial': drive_serial,
+                                      'status': status})
+        self.change(add)
+
+    def delete_ticket(self):
+        """
+        Do you really need this?
+        """
+        pass
+
+    def update_ticket(self, ticket_number, **kwargs):
+        """
+        Updates information for an existing ticket.
+
+        :param ticket_number: The ticket number.
+        """
+        self.update('tickets', {'ticket_number': ticket_number}, kwargs)
+
+    def get_ticket(self, ticket_number):
+        """
+        Extract ticket information.
+
+        :param ticket_number: The ticket number.
+        :returns: A dictionary with the information.
+        """
+        tickets = self.select('tickets', ticket_number=ticket_number)
+        return tickets[0] if tickets else None
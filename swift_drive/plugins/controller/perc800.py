@@ -1,10 +1,109 @@
-import re
-from swift_drive.common.utils import execute, get_binaries
+import Queue
+import threading
+from time import time
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+from swift_drive.common.utils import Command, execute, get_binaries, \
+    get_command_timeout, run_parallel
 from swift_drive.common import disk
 from swift_drive.common.config import get_config
+from swift_drive.common.inventory import Drive
 
 COMMANDS = ['omconfig', 'omreport']
 
+# The states omreport uses for the objects (ObjState)
+STATES = {1: 'ready', 2: 'failed', 4: 'online', 8: 'offline',
+          32: 'degraded', 64: 'recovering', 128: 'removed',
+          1024: 'rebuilding', 2048: 'no media', 16384: 'predictive failure',
+          4194304: 'foreign'}
+
+
+def _text(value):
+    return value.strip()
+
+
+def _state(value):
+    try:
+        return STATES.get(int(value), 'unknown')
+    except ValueError:
+        return value.strip().lower()
+
+
+# The fields we need from the omreport xml output, for every kind of object.
+# Format: {tag: (key, conversion)}
+FIELDS = {
+    'controller': {
+        'ControllerNum': ('id', _text),
+        'PCISlot': ('slot', _text),
+        'Name': ('name', _text),
+    },
+    'pdisk': {
+        'Channel': ('channel', int),
+        'EnclosureID': ('enclosure', int),
+        'TargetID': ('target', int),
+        'ObjState': ('state', _state),
+        'DeviceSerialNumber': ('serial', lambda a: a.strip().upper()),
+        'ProductID': ('model', lambda a: a.strip().upper()),
+        'Revision': ('firmware', lambda a: a.strip().upper()),
+        'Length': ('capacity', int),
+    },
+    'vdisk': {
+        'LogicalDriveNum': ('id', _text),
+        'ObjState': ('state', _state),
+        'DeviceName': ('device', _text),
+    },
+}
+
+
+class RecordBuilder(object):
+    """
+    Target for the xml parser. Every DCStorageObject element in the omreport
+    output becomes a record with the typed fields we need, while the output
+    is being read. Nothing else is kept in memory.
+    """
+    def __init__(self, fields):
+        """
+        :param fields: The fields to collect, from FIELDS.
+        """
+        self.fields = fields
+        self.records = []
+        self.record = None
+        self.text = []
+
+    def start(self, tag, attrib):
+        if tag == 'DCStorageObject':
+            self.record = {}
+        self.text = []
+
+    def data(self, data):
+        self.text.append(data)
+
+    def end(self, tag):
+        if tag == 'DCStorageObject':
+            record = self.record
+            # The pdisk id is connector:enclosure:target, eg. 0:0:4, or
+            # connector:target on the backplanes without an enclosure
+            if 'target' in record and 'enclosure' in record:
+                record['id'] = '%s:%s:%s' % (record.get('channel', 0),
+                                             record['enclosure'],
+                                             record['target'])
+            elif 'target' in record:
+                record['id'] = '%s:%s' % (record.get('channel', 0),
+                                          record['target'])
+            self.records.append(record)
+            self.record = None
+        elif self.record is not None and tag in self.fields:
+            key, conversion = self.fields[tag]
+            try:
+                self.record[key] = conversion(''.join(self.text))
+            except ValueError:
+                pass
+
+    def close(self):
+        return self.records
+
 
 class Controller():
     def __init__(self):
@@ -17,89 +116,214 @@ class Controller():
         {'omconfig': '/path/to/omconfig', 'omreport': '/path/to/omreport'}
 
         """
-        config = get_config('perc800')
-        try:
-            binaries = config['controller_binaries']
-            self.binaries = dict([(a.split('/')[-1].strip(), a.strip())
-                                 for a in binaries.split(', ')])
-        except Exception, e:
+        # Controller snapshots, indexed by controller id
+        self.snapshots = {}
+        # Controller slots, indexed by controller id
+        self.slots = {}
+        # The controller firmware rejects concurrent config changes, so we
+        # keep a lock for each controller
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+        binaries = get_config('perc800').get('controller_binaries')
+        if binaries:
+            self.binaries = dict([(a.split('/')[-1], a) for a in binaries])
+        else:
             self.binaries = get_binaries(COMMANDS)
-            if COMMANDS != sorted(self.binaries.keys()):
-                msg = 'Error trying to locate the omtools binaries: %s' % e
-                raise Exception(msg)
+        missing = [a for a in COMMANDS if not self.binaries.get(a)]
+        if missing:
+            msg = 'Error trying to locate the omtools binaries: %s' % \
+                  ', '.join(missing)
+            raise Exception(msg)
+
+    def get_lock(self, controller_id):
+        """
+        Returns the lock to hold while changing the controller configuration
+        with omconfig.
+
+        :param controller_id: The controller index.
+        :returns: The lock for the controller.
+        """
+        controller_id = str(controller_id)
+        with self.locks_lock:
+            if controller_id not in self.locks:
+                self.locks[controller_id] = threading.RLock()
+            return self.locks[controller_id]
+
+    def forget(self, controller_id=None):
+        """
+        Drop the snapshots and the slots collected so far, so the next
+        queries see the current state of the controllers. Long running
+        callers (eg. the daemon) use it before every poll, to see the drives
+        swapped, added or failed in the meantime.
+
+        :param controller_id: The controller index. All the controllers if
+                              not given.
+        """
+        if controller_id is None:
+            self.snapshots.clear()
+            self.slots.clear()
+        else:
+            self.snapshots.pop(str(controller_id), None)
+            self.slots.pop(str(controller_id), None)
 
     def get_drive_from_device(self, device_name):
         """
         Collects information about a drive using the device name.
 
         :param device_name: The device name.
-        :returns: A dictionary that contains two dictionaries with the collected
-                  relevant information about the device.
+        :returns: The Drive on the device.
         """
         controller_id, vdisk_id = device_name.strip('c').split('u')
         return self.get_drive_from_controller(controller_id, vdisk_id)
 
     def get_drive_from_controller(self, controller_id, vdisk_id):
         """
-        Collects information about a drive using controller coordinates.
+        Collects information about a drive using controller coordinates. The
+        information comes from the controller snapshot.
 
         :param controller_id: The controller index.
         :param vdisk_id: The id of the vdisk to get the information for.
-        :returns: A dictionary that contains two dictionaries with the collected
-                  relevant information about the device.
+        :returns: The Drive on the vdisk.
         """
         controller_id = str(controller_id)
         vdisk_id = str(vdisk_id)
-        results = {}
-        pdisk = {}
-        vdisk = {}
-        for name in 'pdisk', 'vdisk':
-            d = eval(name)
-            cmd = '%s storage %s controller=%s vdisk=%s' % \
-                  (self.binaries['omreport'], name, controller_id, vdisk_id)
-            res = execute(cmd)
-            # Exit if we catch an error message
-            if re.match(r'^Error:*', res[0]):
-                raise Exception("Error: Unable to get drive info for vdisk %s\n"
-                                "Omreport error: %s") % (vdisk_id, res[0])
+        try:
+            return self.get_snapshot(controller_id)['drives'][vdisk_id]
+        except KeyError:
+            msg = ("Error: can't find the vdisk on the controller.\n"
+                   "Probably the drive has been removed already.\n"
+                   "Controller: %s, vdisk: %s") % (controller_id, vdisk_id)
+            raise Exception(msg)
+
+    def get_snapshot(self, controller_id, refresh=False):
+        """
+        Collects the whole inventory of a controller: omreport runs once for
+        the pdisks and once for the vdisks, then once for every vdisk to get
+        the pdisk it's made of, as no listing reports the membership of all
+        the vdisks at once. That's 2 + vdisks processes per controller (14
+        for 12 drives), run in parallel. The snapshot is reused until the
+        controller state is changed by swift-drive, a refresh is requested or
+        forget is called.
+
+        The vdisks can't be joined to the pdisks by position: after a swap
+        the new vdisk takes the lowest free id, wherever its pdisk is, and a
+        foreign pdisk can be in use with no vdisk of ours. Only the vdisk
+        membership reported by omreport is trusted.
+
+        :param controller_id: The controller index.
+        :param refresh: Ignore the snapshot taken previously, if any.
+        :returns: A dictionary with the controller slot, the pdisk records,
+                  the drives and the vdisks that couldn't be inspected.
+                  Format:
+                  {'slot': slot, 'pdisks': [pdisk, ...],
+                   'drives': {vdisk_id: Drive},
+                   'errors': {vdisk_id: error}}
+        """
+        controller_id = str(controller_id)
+        if not refresh and controller_id in self.snapshots:
+            return self.snapshots[controller_id]
+
+        # The embedded controller doesn't have a slot
+        if controller_id == '0':
+            slot = 'embedded'
+        else:
+            # The perc controller is attached to a slot and we need to know
+            # its id
+            if refresh or controller_id not in self.slots:
+                self.get_controllers()
+            try:
+                slot = self.slots[controller_id]
+            except KeyError:
+                msg = ("Error: can't fetch the slot number.\n"
+                       "Controller: %s") % controller_id
+                raise Exception(msg)
+
+        # Both queries run at the same time
+        results = run_parallel(lambda name: self._get_records(
+                               name, controller_id), ['pdisk', 'vdisk'])
+        for res, error, duration in results:
+            if error is not None:
+                raise error
+        pdisks, vdisks = results[0][0], results[1][0]
+        vdisk_ids = sorted([v['id'] for v in vdisks], key=int)
+        drives = {}
+        errors = {}
+        results = run_parallel(lambda vdisk_id: self._get_records(
+                               'pdisk', controller_id, vdisk_id), vdisk_ids)
+        for vdisk_id, result in zip(vdisk_ids, results):
+            res, error, duration = result
+            if error is None and len(res) != 1:
+                # Every vdisk is a single pdisk RAID-0 (see create_vdisk)
+                error = ("Error: Unable to get drive info for vdisk %s on "
+                         "controller %s: %d pdisks found") % \
+                        (vdisk_id, controller_id, len(res))
+            if error is not None:
+                errors[vdisk_id] = str(error)
             else:
-                # The embedded controller doesn't have a slot
-                if controller_id == '0':
-                    d['slot'] = 'embedded'
-                else:
-                    # The perc controller is attached to a slot and we need to know
-                    # its id otherwise is pointless to go any further
-                    try:
-                        d['slot'] = re.findall(r'Slot \d', res[1])[0][-1]
-                    except:
-                        msg = ("Error: can't fetch the slot number.\n"
-                               "Probably the drive has been removed already.\n"
-                               "Controller: %s, vdisk: %s") % \
-                              (controller_id, vdisk_id)
-                        raise Exception(msg)
-
-                # We can split everything after the second element by ':'
-                # so we will have a very nice dictionary (with 0 effort)
-                for element in res[2:]:
-                    key, value = element.split(':', 1)
-                    d[key.lower().strip()] = value.lower().strip()
-            name = d
-
-        results['port'] = pdisk['id']
-        results['serial'] = pdisk['serial no.'].upper()
-        results['model'] = pdisk['product id'].upper()
-        results['firmware'] = pdisk['revision'].upper()
-        results['controller_slot'] = pdisk['slot']
-        capacity = pdisk['capacity'].split()[0].split('.')[0]
-        results['capacity'] = capacity.replace(',', '.')[:4] + ' TB'
+                drives[vdisk_id] = self._get_drive_info(
+                    res[0], slot, 'c%su%s' % (controller_id, vdisk_id))
+
+        snapshot = {'slot': slot, 'pdisks': pdisks, 'drives': drives,
+                    'errors': errors}
+        self.snapshots[controller_id] = snapshot
+        return snapshot
+
+    def _get_records(self, name, controller_id=None, vdisk_id=None):
+        """
+        Runs omreport with the xml output for the controllers, or the pdisks
+        or the vdisks of a controller, and parses the records while the
+        output is being read.
+
+        :param name: The object to query: controller, pdisk or vdisk.
+        :param controller_id: The controller index.
+        :param vdisk_id: Restrict the query to a single vdisk.
+        :returns: The list of records.
+        """
+        cmd = '%s storage %s' % (self.binaries['omreport'], name)
+        if controller_id is not None:
+            cmd += ' controller=%s' % controller_id
+        if vdisk_id is not None:
+            cmd += ' vdisk=%s' % vdisk_id
+        cmd += ' -fmt xml'
+
+        parser = ElementTree.XMLParser(target=RecordBuilder(FIELDS[name]))
+        first_line = None
+        try:
+            for line in Command(cmd, get_command_timeout()):
+                if first_line is None and line.strip():
+                    first_line = line.strip()
+                parser.feed(line + '\n')
+            return parser.close()
+        except SyntaxError:
+            # omreport doesn't use xml for the errors
+            msg = "Error: Unable to get %s info" % name
+            if controller_id is not None:
+                msg += " for controller %s" % controller_id
+            msg += "\nOmreport error: %s" % first_line
+            raise Exception(msg)
+
+    def _get_drive_info(self, pdisk, slot, name=None):
+        """
+        Translates a pdisk record into the drive information used by the
+        commands and the backends.
+
+        :param pdisk: The pdisk record.
+        :param slot: The slot of the controller the pdisk belongs to.
+        :param name: The device name of the vdisk on the pdisk, if known.
+        :returns: A Drive.
+        """
+        # The capacity is in thousands of GiB, truncated to two decimals
+        capacity = '%.3f' % (pdisk['capacity'] / 2.0 ** 30 / 1000)
         # Use a consistent status by translating what the controller returns
         if pdisk['state'] == 'online':
-            results['status'] = 'active'
-        elif pdisk['state'] == 'critical':
-            results['status'] = 'failed'
+            status = 'active'
+        elif pdisk['state'] in ['failed', 'predictive failure']:
+            status = 'failed'
         else:
-            results['status'] = 'unknown'
-        return results
+            status = 'unknown'
+        return Drive(name=name, serial=pdisk['serial'], model=pdisk['model'],
+                     firmware=pdisk['firmware'], capacity=capacity[:4] + ' TB',
+                     status=status, port=pdisk['id'], controller_slot=slot)
 
     def remove_device(self, controller_id, vdisk_id):
         # TODO: Check on device xfs errors and bad mount. mtab
@@ -133,29 +357,27 @@ class Controller():
         removal_cmd = ('%s storage vdisk action=deletevdisk controller=%s '
                        'vdisk=%s' % (self.binaries['omconfig'],
                        controller_id, vdisk_id))
-        removal_result = execute(removal_cmd)
+        with self.get_lock(controller_id):
+            removal_result = execute(removal_cmd)
+            self.snapshots.pop(controller_id, None)
         if not 'Command successful!' in removal_result[0]:
             raise Exception("Error: Failed to remove vdisk %s from "
                             "controller %s for pdisk %s\n"
-                            "Omconfig error: %s ") % \
-                           (vdisk_id, controller_id, pdisk_id, removal_result[0])
+                            "Omconfig error: %s " %
+                            (vdisk_id, controller_id, pdisk_id,
+                             removal_result[0]))
 
     def add_device(self, controller_id, vdisk_id, pdisk_id, format=True):
         """
         Add a device back into the system.
 
         :param controller_id: The controller id.
-        :param vdisk_id: The id of the vdisk that should be created.
+        :param vdisk_id: The id of the vdisk that should be created. The
+                         controller may pick another one.
         :param pdisk_id: The id of the pdisk to add.
         :param format: Specifies wheter or not the drive should be formatted.
-        :returns: A boolean value that reflects the result of the operation.
+        :returns: The id of the vdisk created.
         """
-        controller_id = str(controller_id)
-        pdisk_id = str(pdisk_id)
-        device_id = 'c%su%s' % (controller_id, vdisk_id)
-        device_name = device_id + 'p'
-        # drive_info = get_drive_info(controller_id, vdisk_id)
-
         # Check if there is a replace operation in progress. INPROGRESS
         # Backend still needs to be develped.
         # Should also allow --force to override. TODO
@@ -174,16 +396,134 @@ class Controller():
         #     remove_device(controller_id, vdisk_id)
 
         # Now that we cleaned up the vdisk we can move on and create the new one
+        vdisk_id = self.create_vdisk(controller_id, pdisk_id)
+        self.prepare_device(controller_id, vdisk_id, pdisk_id, format)
+        return vdisk_id
+
+    def add_devices(self, devices, max_workers=4, format=True):
+        """
+        Add many devices back into the system as a pipeline. The vdisks are
+        created one at a time on each controller (but on all the controllers
+        at the same time) and, as soon as a vdisk is ready, its device is
+        partitioned, formatted and mounted while the next vdisks are being
+        created. Up to max_workers devices are formatted at once.
+
+        :param devices: A list of tuples (controller_id, vdisk_id, pdisk_id).
+                        The controller may pick other vdisk ids.
+        :param max_workers: How many devices to format at the same time.
+        :param format: Specifies wheter or not the drives should be formatted.
+        :returns: A list of tuples (device_name, error, duration) in the same
+                  order as the devices. error is None if the device has been
+                  added. The device name is the one of the vdisk created,
+                  if any.
+        """
+        devices = list(devices)
+        results = [None] * len(devices)
+        # The vdisks ids picked by the controller
+        vdisk_ids = [a[1] for a in devices]
+        ready = Queue.Queue()
+        start = time()
+
+        def create(indexes):
+            # Controller-bound: one createvdisk at a time per controller
+            for index in indexes:
+                controller_id, vdisk_id, pdisk_id = devices[index]
+                try:
+                    vdisk_ids[index] = self.create_vdisk(controller_id,
+                                                         pdisk_id)
+                except Exception, e:
+                    results[index] = e
+                    continue
+                ready.put(index)
+
+        def prepare():
+            # Disk-bound: parted, mkfs and mount run in parallel
+            while True:
+                index = ready.get()
+                if index is None:
+                    return
+                controller_id, vdisk_id, pdisk_id = devices[index]
+                try:
+                    self.prepare_device(controller_id, vdisk_ids[index],
+                                        pdisk_id, format)
+                    results[index] = time() - start
+                except Exception, e:
+                    results[index] = e
+
+        by_controller = {}
+        for index, device in enumerate(devices):
+            by_controller.setdefault(str(device[0]), []).append(index)
+        creators = [threading.Thread(target=create, args=(by_controller[a], ))
+                    for a in sorted(by_controller)]
+        preparers = [threading.Thread(target=prepare)
+                     for n in range(max(1, min(max_workers, len(devices))))]
+        [thread.start() for thread in creators + preparers]
+        [thread.join() for thread in creators]
+        [ready.put(None) for thread in preparers]
+        [thread.join() for thread in preparers]
+
+        output = []
+        for device, vdisk_id, result in zip(devices, vdisk_ids, results):
+            device_name = 'c%su%s' % (device[0], vdisk_id)
+            if result is None:
+                # The thread working on it died
+                result = Exception('The device has not been prepared')
+            if isinstance(result, Exception):
+                output.append((device_name, result, None))
+            else:
+                output.append((device_name, None, result))
+        return output
+
+    def create_vdisk(self, controller_id, pdisk_id):
+        """
+        Create a single pdisk RAID-0 vdisk. Only one change at a time is made
+        on each controller.
+
+        The controller picks the id of the new vdisk (usually the lowest one
+        free), so it's read back: it's the vdisk that wasn't there before.
+
+        :param controller_id: The controller id.
+        :param pdisk_id: The id of the pdisk to use.
+        :returns: The id of the vdisk created.
+        """
+        controller_id = str(controller_id)
+        pdisk_id = str(pdisk_id)
         add_cmd = '%s storage controller action=createvdisk controller=%s ' \
                   'pdisk=%s raid=r0 size=max stripesize=64kb ' \
                   'diskcachepolicy=disabled readpolicy=ara writepolicy=wb' % \
                   (self.binaries['omconfig'], controller_id, pdisk_id)
-        add_result = execute(add_cmd)
-        if not 'Command successful!' in add_result[0]:
-            raise Exception("Cannot create vdisk on port %s for controller %s.\n"
-                            "Error: %s ") % \
-                           (pdisk_id, controller_id, str(add_result))
+        with self.get_lock(controller_id):
+            before = set([a['id'] for a in
+                          self._get_records('vdisk', controller_id)])
+            add_result = execute(add_cmd)
+            self.snapshots.pop(controller_id, None)
+            if not 'Command successful!' in add_result[0]:
+                raise Exception("Cannot create vdisk on port %s for "
+                                "controller %s.\nError: %s " %
+                                (pdisk_id, controller_id, str(add_result)))
+            created = sorted(set([a['id'] for a in self._get_records(
+                'vdisk', controller_id)]) - before, key=int)
+            for vdisk_id in created:
+                # Somebody else may have created a vdisk in the meantime
+                if len(created) == 1 or pdisk_id in [
+                        a['id'] for a in self._get_records(
+                            'pdisk', controller_id, vdisk_id)]:
+                    return vdisk_id
+        raise Exception("Created a vdisk on port %s for controller %s, but "
+                        "can't find its id" % (pdisk_id, controller_id))
+
+    def prepare_device(self, controller_id, vdisk_id, pdisk_id, format=True):
+        """
+        Partition, format and mount the device of a new vdisk, then turn its
+        indicator light off.
 
+        :param controller_id: The controller id.
+        :param vdisk_id: The id of the vdisk.
+        :param pdisk_id: The id of the pdisk.
+        :param format: Specifies wheter or not the drive should be formatted.
+        """
+        device_id = 'c%su%s' % (controller_id, vdisk_id)
+        device_name = device_id + 'p'
         """
         Device added, so partition and format it
         """
@@ -221,7 +561,8 @@ class Controller():
 
         indicator_cmd = '%s storage pdisk action=%s controller=%s pdisk=%s' \
             % (self.binaries['omconfig'], action, controller_id, pdisk_id)
-        indicator_result = execute(indicator_cmd)
+        with self.get_lock(controller_id):
+            indicator_result = execute(indicator_cmd)
         if not 'Command successful!' in indicator_result[0]:
             msg = ("Error: Failed to turn the indicator light off "
                    "for pdisk %s on controller %s.\n"
@@ -235,15 +576,12 @@ class Controller():
 
         :returns: A dictionary with the id and PCI slot.
         '''
-        cmd = '%s storage controller' % self.binaries['omreport']
-        result = execute(cmd)
-        filtered_result = [a for a in result
-                           if a.startswith('ID') or a.startswith('Slot ID')]
         controllers = {}
-        for n in range(0, len(filtered_result), 2):
-            controller_id = filtered_result[n].split(':')[1].strip()
-            slot_id = filtered_result[n + 1].split(':')[1].strip()
-            controllers[controller_id] = slot_id
+        for controller in self._get_records('controller'):
+            # The embedded controller doesn't have a slot
+            controllers[controller['id']] = controller.get('slot') or \
+                'embedded'
+        self.slots = controllers
         return controllers
 
     def get_ports(self, controller_id):
@@ -258,48 +596,26 @@ class Controller():
         :returns: A dictionary with the information about the ports. Format:
                   {port_id: (status, drive_serial)}
         '''
-        cmd = '%s storage pdisk controller=%s' % (self.binaries['omreport'],
-                                                  controller_id)
-        result = execute(cmd)
-        filtered_result = [a for a in result if a.startswith('ID')
-                           or a.startswith('State')
-                           or a.startswith('Serial No.')]
         ports = {}
-        for n in range(0, len(filtered_result), 3):
-            port_id = ':'.join(filtered_result[n].split(':')[1:]).strip()
-            port_status = filtered_result[n + 1].split(':')[1].strip()
+        for pdisk in self.get_snapshot(controller_id)['pdisks']:
             # Use a consistent status by translating what the controller returns
-            if port_status == 'Online':
+            port_status = pdisk['state']
+            if port_status == 'online':
                 port_status = 'active'
-            elif port_status in ['Failed', 'Foreign']:
-                port_status = port_status.lower()
-            else:
+            elif port_status not in ['failed', 'foreign']:
                 port_status = 'unknown'
-            port_serial = filtered_result[n + 2].split(':')[1].strip()
-            ports[port_id] = (port_status, port_serial)
+            ports[pdisk['id']] = (port_status, pdisk.get('serial'))
         return ports
 
     def get_all_drives(self, controller_id):
         '''
         Extract information all the drives for a given controller. This is
-        used when initialising the backend. It usually takes a while to run.
+        used when initialising the backend.
         NOTE: Any missing vdisks will be skipped.
 
         :param controller_id: The controller to inspect.
-        :returns: A dictionary with the information about the drives.
+        :returns: A dictionary with the device names as keys and the Drives
+                  as values.
         '''
-        # First fetch the list of the vdisks
-        cmd = '%s storage vdisk controller=%s' % (self.binaries['omreport'],
-                                                  controller_id)
-        vdisks = [a.split(':')[1].strip() for a in execute(cmd)
-                  if a.startswith('ID')]
-        # Now let's use the list to extract information for each drive
-        all_drives = {}
-        for vdisk_id in vdisks:
-            device_id = 'c%su%s' % (controller_id, vdisk_id)
-            try:
-                all_drives[device_id] = self.get_drive_from_controller(
-                                            controller_id, vdisk_id)
-            except:
-                print device_id + ' had problems'
-        return all_drives
+        drives = self.get_snapshot(controller_id)['drives'].values()
+        return dict([(drive.name, drive) for drive in drives])
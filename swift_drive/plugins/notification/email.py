@@ -1,49 +1,177 @@
 # This module is used to send out emails to notify about swift-drive events.
-# It is assumed that there is a MTA running on localhost on port 25 and
-# that there aren't any restrictions or limitations.
-
+# It is assumed that there is a MTA running on localhost on port 25 (unless
+# configured otherwise) and that there aren't any restrictions or
+# limitations.
+#
+# The notifications raised within notification_email_window seconds are sent
+# together in a single digest, with a single SMTP transaction for all the
+# recipients. Whatever is still waiting is sent when the process exits.
+from __future__ import absolute_import
+import atexit
+import random
 import smtplib
+import threading
+from email.utils import formatdate, make_msgid
+from time import sleep
 from swift_drive.common.config import get_config
+from swift_drive.common.metrics import metrics
 #from swift_drive.common.template import get_template
 
+DEFAULT_SENDER = 'alert@swift-drive.com'
 
-class Notification():
+
+class Digest(object):
+    """
+    The notifications waiting to be sent. It's shared by all the plugin
+    instances of the process, so they end up in the same digest.
+    """
     def __init__(self):
-        self.smtp_server = smtplib.SMTP('localhost')
+        self.lock = threading.Lock()
+        # A list of tuples (subject, body)
+        self.pending = []
+        self.timer = None
 
-    def send_notification(self, subject, body):
-        # Get the list of recipients from the config file.
-        # The option is notification_email_recipients
-        from swift_drive.common.utils import get_hostname
-        hostname = get_hostname()
-        config = get_config('email')
-        # Get the recipients from the configuration. We can't go any further
-        # without any.
+    def add(self, subject, body, window):
+        """
+        Add a notification to the digest, which is sent window seconds after
+        its first notification.
+
+        :param subject: The notification subject.
+        :param body: The notification body.
+        :param window: How many seconds to wait for more notifications.
+        """
+        with self.lock:
+            self.pending.append((subject, body))
+            if self.timer is None:
+                self.timer = threading.Timer(window, self.flush_quietly)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        """
+        Send the notifications waiting, if any.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, []
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        if pending:
+            deliver(pending)
+
+    def flush_quietly(self):
+        """
+        Like flush, but the failures are only reported. Used when nobody is
+        there to handle them (from the timer and at exit).
+        """
         try:
-            recipients = config['notification_email_recipients'].split(',')
-        except:
-            raise Exception('Error: could not find any recipients in the '
-                            'configuration file. Please configure at least one.')
+            self.flush()
+        except Exception, e:
+            print 'Failed to send the email notifications: %s' % e
+
+
+def compose(notifications, sender, recipients):
+    """
+    Build the email for some notifications.
+
+    :param notifications: A list of tuples (subject, body).
+    :param sender: The sender address.
+    :param recipients: The recipient addresses.
+    :returns: The email, headers included.
+    """
+    from swift_drive.common.utils import get_hostname
+    if len(notifications) == 1:
+        subject, body = notifications[0]
+    else:
+        subject = '%d notifications' % len(notifications)
+        body = '\n\n'.join(['* %s\n%s' % a for a in notifications])
+    headers = [
+        ('From', sender),
+        ('To', ', '.join(recipients)),
+        ('Subject', '[swift-drive] - %s - %s' % (get_hostname(), subject)),
+        ('Date', formatdate(localtime=True)),
+        ('Message-ID', make_msgid()),
+    ]
+    return '\r\n'.join(['%s: %s' % a for a in headers]) + '\r\n\r\n' + body
+
 
-        # Check if there is a specific sender configured.
+def deliver(notifications):
+    """
+    Send some notifications in a single email to all the recipients. Every
+    attempt uses a new SMTP session, and the failed ones are retried with an
+    exponential backoff.
+
+    :param notifications: A list of tuples (subject, body).
+    """
+    config = get_config('email')
+    # Get the recipients from the configuration. We can't go any further
+    # without any.
+    recipients = config.get('notification_email_recipients')
+    if not recipients:
+        raise Exception('Error: could not find any recipients in the '
+                        'configuration file. Please configure at least one.')
+    # Check if there is a specific sender configured.
+    sender = config.get('notification_email_sender',
+                        config.get('notification_email_from', DEFAULT_SENDER))
+    host = config.get('notification_email_host', 'localhost')
+    port = config.get('notification_email_port', 25)
+    # A negative value still makes one attempt
+    retries = max(0, config.get('notification_email_retries', 3))
+    backoff = config.get('notification_email_backoff', 1)
+    message = compose(notifications, sender, recipients)
+
+    error = None
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            sleep(random.uniform(0, backoff * 2 ** (attempt - 1)))
         try:
-            sender = config['notification_email_from']
-        except:
-            sender = 'alert@swift-drive.com'
-
-        for recipient in recipients:
-            subject = '[swift-drive] - %s - %s' % (hostname, subject)
-            message = 'From: %s\r\nTo: %s\r\nSubject: %s\r\n\r\n%s' % \
-                      (sender, recipient, subject, body)
-            # Try to send an email for 3 times before raising an exception
-            for retries in range(4):
-                if retries == 3:
-                    msg = 'Failed to send an email to %s. Error: %s' % \
-                          (recipient, e)
-                    raise Exception(msg)
+            with metrics.timer('notification', plugin='email'):
+                smtp_server = smtplib.SMTP(host, port, timeout=30)
                 try:
-                    self.smtp_server.sendmail(sender, recipient, message)
-                except Exception, e:
-                    pass
+                    refused = smtp_server.sendmail(sender, list(recipients),
+                                                   message)
                 finally:
-                    break
+                    try:
+                        smtp_server.quit()
+                    except Exception:
+                        smtp_server.close()
+        except smtplib.SMTPRecipientsRefused:
+            # All the recipients were refused, retrying won't help
+            raise
+        except Exception, e:
+            error = e
+            continue
+        if refused:
+            # The others got it already, failing would send it to them again
+            # at the next attempt
+            print 'The email has not been sent to %s. Error: %s' % (
+                ', '.join(sorted(refused)), refused)
+        return
+    raise Exception('Failed to send an email to %s after %d attempts. '
+                    'Error: %s' % (', '.join(recipients), retries + 1, error))
+
+
+digest = Digest()
+atexit.register(digest.flush_quietly)
+
+
+class Notification():
+    def send_notification(self, subject, body):
+        """
+        Send a notification by email. If notification_email_window is set,
+        the notification is added to the digest and sent later.
+
+        :param subject: The notification subject.
+        :param body: The notification body.
+        """
+        window = get_config('email').get('notification_email_window', 0)
+        if window > 0:
+            digest.add(subject, body, window)
+        else:
+            deliver([(subject, body)])
+
+    def flush(self):
+        """
+        Send the notifications waiting in the digest right away.
+        """
+        digest.flush()